@@ -0,0 +1,128 @@
+"""
+Runs the offline benchmark suite and compares results against a stored baseline.
+
+Usage (from the repository root):
+    python -m benchmarks.run_benchmarks run --out benchmarks/results/current.json
+    python -m benchmarks.run_benchmarks compare benchmarks/results/baseline.json benchmarks/results/current.json
+
+The compare command exits with status 1 if a benchmark is slower than the baseline by more than the threshold.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+import torch
+
+from benchmarks.suite import BENCHMARKS, SCALES, run_benchmarks
+
+
+def benchmark_parser():
+    parser = argparse.ArgumentParser(description="Offline benchmarks of the training, decoding, data and metric hot paths.")
+    commands = parser.add_subparsers(dest="command")
+
+    run = commands.add_parser("run", help="Run the benchmarks and write the results as JSON.")
+    run.add_argument("--out", default=os.path.join("benchmarks", "results", "current.json"), type=str,
+                     help="Output JSON file. Default: benchmarks/results/current.json")
+    run.add_argument("--scale", default="default", choices=list(SCALES.keys()),
+                     help="Size of the synthetic data and model. Default: default")
+    run.add_argument("--only", default=[], nargs="+", choices=list(BENCHMARKS.keys()), metavar="NAME",
+                     help="Run only the given benchmarks: {}".format(", ".join(BENCHMARKS.keys())))
+    run.add_argument("--repeat", default=0, type=int, help="Number of timed calls. Default: depends on the scale")
+    run.add_argument("--threads", default=1, type=int, help="Number of torch threads. Default: 1")
+    run.add_argument("--seed", default=42, type=int, help="Seed of the synthetic data and model. Default: 42")
+
+    compare = commands.add_parser("compare", help="Compare results against a baseline.")
+    compare.add_argument("baseline", type=str, help="Baseline JSON file")
+    compare.add_argument("current", type=str, help="Current JSON file")
+    compare.add_argument("--threshold", default=0.1, type=float,
+                         help="Relative slowdown of the median time flagged as regression. Default: 0.1 (10%%)")
+    return parser
+
+
+def get_environment():
+    return {"python": platform.python_version(), "torch": torch.__version__, "platform": platform.platform(),
+            "processor": platform.processor(), "cpu_count": os.cpu_count()}
+
+
+def save_results(results, path, **meta):
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    meta.update({"time": time.strftime("%Y-%m-%d %H:%M:%S"), "environment": get_environment()})
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"meta": meta, "results": results}, f, indent=2)
+
+
+def load_results(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def compare_results(baseline, current, threshold=0.1):
+    """
+    Compares the median times of the benchmarks present in both results
+    :param baseline: the baseline results, as loaded by load_results
+    :param current: the current results
+    :param threshold: relative slowdown flagged as regression
+    :return: list of (name, baseline median, current median, ratio, status)
+    """
+    rows = []
+    baseline_results, current_results = baseline["results"], current["results"]
+    for name, result in current_results.items():
+        if name not in baseline_results:
+            rows.append((name, None, result["median"], None, "new"))
+            continue
+        base_time = baseline_results[name]["median"]
+        ratio = result["median"] / base_time if base_time > 0 else float("inf")
+        if ratio > 1 + threshold:
+            status = "REGRESSION"
+        elif ratio < 1 / (1 + threshold):
+            status = "faster"
+        else:
+            status = "ok"
+        rows.append((name, base_time, result["median"], ratio, status))
+    for name in baseline_results:
+        if name not in current_results:
+            rows.append((name, baseline_results[name]["median"], None, None, "missing"))
+    return rows
+
+
+def print_comparison(rows):
+    print("{:<28} {:>12} {:>12} {:>8}  {}".format("Benchmark", "Baseline (s)", "Current (s)", "Ratio", "Status"))
+    fmt = lambda value, pattern: pattern.format(value) if value is not None else "-"
+    for name, base_time, cur_time, ratio, status in rows:
+        print("{:<28} {:>12} {:>12} {:>8}  {}".format(name, fmt(base_time, "{:.4f}"), fmt(cur_time, "{:.4f}"),
+                                                      fmt(ratio, "{:.2f}x"), status))
+
+
+def main(argv=None):
+    parser = benchmark_parser()
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        results = run_benchmarks(scale=args.scale, names=args.only, repeat=args.repeat or None, seed=args.seed,
+                                 num_threads=args.threads)
+        save_results(results, args.out, scale=args.scale, threads=args.threads, seed=args.seed)
+        print("Results saved in {}".format(args.out))
+        return 0
+    elif args.command == "compare":
+        baseline, current = load_results(args.baseline), load_results(args.current)
+        if baseline["meta"].get("scale") != current["meta"].get("scale"):
+            print("Warning: the results were measured at different scales and are not comparable.")
+        if baseline["meta"].get("environment") != current["meta"].get("environment"):
+            print("Warning: the results were measured in different environments.")
+        rows = compare_results(baseline, current, threshold=args.threshold)
+        print_comparison(rows)
+        regressions = [row[0] for row in rows if row[4] == "REGRESSION"]
+        if regressions:
+            print("Regressions: {}".format(", ".join(regressions)))
+            return 1
+        return 0
+    parser.print_help()
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,257 @@
+"""
+Benchmark cases for the hot paths of training, decoding, data loading, tokenization and evaluation.
+Each case is a setup function registered with @benchmark. It receives the shared BenchmarkContext and returns
+the function to time together with the amount of work done per call, which gives the throughput.
+"""
+import os
+import shutil
+import statistics
+import tempfile
+import time
+from collections import OrderedDict
+
+import torch
+
+from benchmarks.synthetic import SyntheticCorpus, load_dataset
+from project.model.models import get_nmt_model
+from project.utils.constants import SOS_TOKEN, EOS_TOKEN, PAD_TOKEN, UNK_TOKEN
+from project.utils.datasets import Seq2SeqDataset
+from project.utils.experiment import Experiment
+from project.utils.utils_tokenizers import FastTokenizer, SplitTokenizer
+from project.utils.utils_training import get_bleu_scorer
+
+BENCHMARKS = OrderedDict()
+
+SCALES = {
+    # quick run, e.g. to check that the suite works
+    "small": dict(corpus_size=500, tokenizer_lines=2000, batch_size=16, hid_dim=32, emb_size=32, beam_sentences=5,
+                  bleu_sentences=500, repeat=3),
+    "default": dict(corpus_size=20000, tokenizer_lines=20000, batch_size=64, hid_dim=256, emb_size=256,
+                    beam_sentences=20, bleu_sentences=5000, repeat=5),
+}
+
+
+def benchmark(name, unit):
+    """
+    Registers a benchmark setup function
+    :param name: the benchmark name
+    :param unit: the unit of the work done per call, e.g. 'sentences'
+    """
+
+    def register(setup):
+        BENCHMARKS[name] = (setup, unit)
+        return setup
+
+    return register
+
+
+class BenchmarkContext(object):
+    """
+    Shared synthetic data and model, created once per suite run
+    """
+
+    def __init__(self, scale="default", seed=42):
+        self.config = SCALES[scale]
+        self.seed = seed
+        self.path = tempfile.mkdtemp(prefix="nmt_benchmarks_")
+        self._dataset = None
+        self._model = None
+        self.corpus = SyntheticCorpus(self.config["corpus_size"], seed=seed)
+        self.corpus.save(self.path)
+
+    @property
+    def dataset(self):
+        if self._dataset is None:
+            self._dataset = load_dataset(self.path)
+        return self._dataset
+
+    @property
+    def model(self):
+        if self._model is None:
+            # imported here, the training script is not needed by the other benchmarks
+            from train_model import experiment_parser
+            dataset, SRC, TRG = self.dataset
+            args = experiment_parser().parse_args(["--hs", str(self.config["hid_dim"]),
+                                                   "--emb", str(self.config["emb_size"]), "--cuda", "False"])
+            experiment = Experiment(args)
+            experiment.model_type = "custom"
+            experiment.src_vocab_size, experiment.trg_vocab_size = len(SRC.vocab), len(TRG.vocab)
+            tokens_bos_eos_pad_unk = [TRG.vocab.stoi[SOS_TOKEN], TRG.vocab.stoi[EOS_TOKEN],
+                                      TRG.vocab.stoi[PAD_TOKEN], TRG.vocab.stoi[UNK_TOKEN]]
+            torch.manual_seed(self.seed)
+            self._model = get_nmt_model(experiment, tokens_bos_eos_pad_unk)
+        return self._model
+
+    def batch(self):
+        """
+        :return: padded source and target tensors of the first examples
+        """
+        dataset, SRC, TRG = self.dataset
+        examples = dataset.examples[:self.config["batch_size"]]
+        src = SRC.process([e.src for e in examples], device="cpu")
+        trg = TRG.process([e.trg for e in examples], device="cpu")
+        return src, trg
+
+    def close(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def time_function(fn, repeat=5, warmup=1):
+    """
+    :return: list of the durations of the calls in seconds
+    """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def run_benchmarks(scale="default", names=None, repeat=None, seed=42, num_threads=1):
+    """
+    Runs the selected benchmarks
+    :param scale: 'small' or 'default'
+    :param names: benchmark names, None runs all
+    :param repeat: number of timed calls, default by scale
+    :param seed: seed of the synthetic data and model
+    :param num_threads: torch threads, fixed for comparable results
+    :return: dictionary of results by benchmark name
+    """
+    torch.set_num_threads(num_threads)
+    context = BenchmarkContext(scale, seed=seed)
+    repeat = repeat or context.config["repeat"]
+    results = OrderedDict()
+    try:
+        for name, (setup, unit) in BENCHMARKS.items():
+            if names and name not in names:
+                continue
+            torch.manual_seed(seed)
+            fn, units = setup(context)
+            times = time_function(fn, repeat=repeat)
+            median = statistics.median(times)
+            results[name] = {"unit": unit, "units": units, "repeat": repeat, "median": median, "min": min(times),
+                             "max": max(times), "throughput": units / median if median > 0 else None}
+            print("{:<28} {:>10.4f}s  {:>12.1f} {}/s".format(name, median, results[name]["throughput"] or 0, unit))
+    finally:
+        context.close()
+    return results
+
+
+############### Benchmarks ################
+
+@benchmark("encoder_forward_backward", "sentences")
+def encoder_forward_backward(context):
+    model = context.model
+    model.train()
+    src, _ = context.batch()
+
+    def run():
+        model.zero_grad()
+        outputs, _ = model.encoder(src)
+        outputs.sum().backward()
+
+    return run, src.size(1)
+
+
+@benchmark("decoder_forward_backward", "sentences")
+def decoder_forward_backward(context):
+    model = context.model
+    model.train()
+    src, trg = context.batch()
+    with torch.no_grad():
+        _, states = model.encoder(src)
+
+    def run():
+        model.zero_grad()
+        outputs, _ = model.decoder(trg, states)
+        outputs.sum().backward()
+
+    return run, trg.size(1)
+
+
+@benchmark("seq2seq_train_step", "sentences")
+def seq2seq_train_step(context):
+    model = context.model
+    model.train()
+    src, trg = context.batch()
+    criterion = torch.nn.CrossEntropyLoss(ignore_index=context.dataset[2].vocab.stoi[PAD_TOKEN])
+
+    def run():
+        model.zero_grad()
+        scores = model(src, trg)[:-1]
+        criterion(scores.reshape(-1, scores.size(2)), trg[1:].reshape(-1)).backward()
+
+    return run, src.size(1)
+
+
+def _beam_search(beam_size):
+    def setup(context):
+        model = context.model
+        model.eval()
+        dataset, SRC, _ = context.dataset
+        sentences = [SRC.process([e.src], device="cpu") for e in dataset.examples[:context.config["beam_sentences"]]]
+
+        def run():
+            with torch.no_grad():
+                for src in sentences:
+                    model.predict(src, beam_size=beam_size)
+
+        return run, len(sentences)
+
+    return setup
+
+
+for _beam in [1, 5, 10]:
+    benchmark("beam_search_{}".format(_beam), "sentences")(_beam_search(_beam))
+
+
+@benchmark("dataset_loading", "sentences")
+def dataset_loading(context):
+    _, SRC, TRG = context.dataset
+    prefix = os.path.join(context.path, "train")
+
+    def run():
+        Seq2SeqDataset(prefix, exts=(".de", ".en"), fields=(SRC, TRG), truncate=30)
+
+    return run, context.corpus.size
+
+
+def _tokenizer(tokenizer_cls, raw):
+    def setup(context):
+        tokenizer = tokenizer_cls("de")
+        lines = context.corpus.raw_lines() if raw else context.corpus.tokenized_lines()
+        lines = (lines * (context.config["tokenizer_lines"] // len(lines) + 1))[:context.config["tokenizer_lines"]]
+
+        def run():
+            for line in lines:
+                tokenizer.tokenize(line)
+
+        return run, len(lines)
+
+    return setup
+
+
+benchmark("fast_tokenizer", "lines")(_tokenizer(FastTokenizer, raw=True))
+benchmark("split_tokenizer", "lines")(_tokenizer(SplitTokenizer, raw=False))
+
+
+@benchmark("bleu", "sentences")
+def bleu(context):
+    dataset, _, TRG = context.dataset
+    examples = dataset.examples[:context.config["bleu_sentences"]]
+    references = [[TRG.vocab.stoi[w] for w in e.trg] for e in examples]
+    # hypotheses: references with every fifth token changed
+    hypotheses = [[t if i % 5 else (t + 1) % len(TRG.vocab) for i, t in enumerate(ref)] for ref in references]
+    scorer = get_bleu_scorer(TRG)
+
+    def run():
+        # a new scorer per call would measure the uncached reference n-grams, validation reuses the scorer
+        scorer.reset()
+        for hyp, ref in zip(hypotheses, references):
+            scorer.add(hyp, ref)
+        scorer.score()
+
+    return run, len(examples)
@@ -0,0 +1,117 @@
+"""
+Generates synthetic parallel corpora, so the benchmarks run without network, raw corpora or spaCy models.
+Words are drawn from a Zipf distribution over a random lexicon, which gives realistic vocabulary statistics.
+"""
+import os
+import string
+
+import numpy as np
+from torchtext.data import Field
+
+from project.utils.constants import SOS_TOKEN, EOS_TOKEN, PAD_TOKEN, UNK_TOKEN
+from project.utils.datasets import Seq2SeqDataset
+from project.utils.utils_tokenizers import SplitTokenizer
+
+PUNCTUATION = [",", ".", "?", "!", "'s", "'"]
+
+
+class SyntheticCorpus(object):
+    """
+    A reproducible random parallel corpus
+    """
+
+    def __init__(self, size, vocab_size=5000, min_len=3, max_len=30, seed=42):
+        """
+        :param size: number of sentence pairs
+        :param vocab_size: number of distinct words per language
+        :param min_len: minimal sentence length in words
+        :param max_len: maximal sentence length in words
+        :param seed: random seed
+        """
+        self.size = size
+        self.vocab_size = vocab_size
+        self.min_len = min_len
+        self.max_len = max_len
+        self.rng = np.random.RandomState(seed)
+        self.src_words = self._lexicon()
+        self.trg_words = self._lexicon()
+        self.src, self.trg = [], []
+        for _ in range(size):
+            length = self.rng.randint(min_len, max_len + 1)
+            self.src.append(self._sentence(self.src_words, length))
+            # target lengths are correlated with the source lengths
+            trg_length = int(np.clip(length + self.rng.randint(-2, 3), min_len, max_len))
+            self.trg.append(self._sentence(self.trg_words, trg_length))
+
+    def _lexicon(self):
+        letters = np.array(list(string.ascii_lowercase))
+        words = set()
+        while len(words) < self.vocab_size:
+            words.add("".join(self.rng.choice(letters, self.rng.randint(2, 11))))
+        return sorted(words)
+
+    def _sentence(self, lexicon, length):
+        ranks = np.minimum(self.rng.zipf(1.2, length), len(lexicon)) - 1
+        words = [lexicon[r] for r in ranks]
+        for i in range(1, length):
+            if self.rng.rand() < 0.08:
+                words[i - 1] += self.rng.choice(PUNCTUATION)
+        return " ".join(words) + "."
+
+    def raw_lines(self):
+        """
+        :return: the source sentences with punctuation attached to the words, as in the raw corpora
+        """
+        return self.src
+
+    def tokenized_lines(self, side="src"):
+        """
+        :return: the sentences with separated punctuation, as written by the preprocessing
+        """
+        lines = self.src if side == "src" else self.trg
+        return [_split_punctuation(line) for line in lines]
+
+    def save(self, path, prefix="train", exts=(".de", ".en")):
+        """
+        Writes the tokenized corpus as bitext
+        :param path: output directory
+        :param prefix: file prefix
+        :param exts: source and target extensions
+        :return: the file prefix, as expected by Seq2SeqDataset
+        """
+        os.makedirs(path, exist_ok=True)
+        for ext, side in zip(exts, ["src", "trg"]):
+            with open(os.path.join(path, prefix + ext), "w", encoding="utf-8") as f:
+                f.write("\n".join(self.tokenized_lines(side)) + "\n")
+        return os.path.join(path, prefix)
+
+
+def _split_punctuation(line):
+    for p in PUNCTUATION:
+        line = line.replace(p + " ", " " + p + " ")
+    return line[:-1] + " ."
+
+
+def get_fields():
+    """
+    :return: source and target fields as used by the training
+    """
+    src_tokenizer, trg_tokenizer = SplitTokenizer("de"), SplitTokenizer("en")
+    SRC = Field(tokenize=lambda s: src_tokenizer.tokenize(s), pad_token=PAD_TOKEN, unk_token=UNK_TOKEN,
+                lower=True)
+    TRG = Field(tokenize=lambda s: trg_tokenizer.tokenize(s), init_token=SOS_TOKEN, eos_token=EOS_TOKEN,
+                pad_token=PAD_TOKEN, unk_token=UNK_TOKEN, lower=True)
+    return SRC, TRG
+
+
+def load_dataset(path, prefix="train", max_len=30, min_freq=1):
+    """
+    Loads a corpus saved with SyntheticCorpus.save and builds the vocabularies
+    :return: dataset, SRC, TRG
+    """
+    SRC, TRG = get_fields()
+    dataset = Seq2SeqDataset(os.path.join(path, prefix), exts=(".de", ".en"), fields=(SRC, TRG),
+                             truncate=max_len)
+    SRC.build_vocab(dataset, min_freq=min_freq)
+    TRG.build_vocab(dataset, min_freq=min_freq)
+    return dataset, SRC, TRG
@@ -8,17 +8,150 @@ Raw files should be extracted to: data/raw/europarl/<lang_code>
 """
 import argparse
 import os
-import re
 import time
 
-from project.utils.data import custom_data_splits, persist_txt
+from project.utils.data import SplitWriter, filter_by_length, read_bitext
 from project.utils.external.tmx_to_text import Converter, FileOutput
-from project.utils.utils_functions import str2number, convert_time_unit
-from project.utils.utils_logging import Logger
+from project.utils.utils_cache import StageCache, TokenizationCache, file_fingerprint, hash_key
+from project.utils.utils_dedup import BANDS, NUM_PERM, SHINGLE_SIZE, find_duplicates, format_dedup_stats
+from project.utils.utils_functions import str2number, str2bool, convert_time_unit
 from project.utils.utils_parsers import DatasetConfigParser
-from project.utils.utils_retrieve_corpora import TmxCorpusDownloader, FileExtractor
-from project.utils.utils_tokenizers import get_custom_tokenizer, SpacyTokenizer
-from settings import DATA_DIR_RAW, DATA_DIR_PREPRO
+from project.utils.utils_retrieve_corpora import TmxCorpusDownloader, FileExtractor, download_corpora
+from project.utils.utils_tokenizers import chunk_iterator, parallel_tokenize_pairs, tokenizer_signature
+from settings import DATA_DIR_RAW, DATA_DIR_PREPRO, SEED
+
+
+def extract_stage(tmx_path, cache, workers=1):
+    """
+    Converts the TMX file to the bitext.* files, the stage key is the hash of the file
+    :return: the stage key and the directory of the bitext files
+    """
+    key = hash_key("extract", file_fingerprint(tmx_path))
+    path = cache.path("extract", key)
+    if cache.is_done("extract", key):
+        print("Extraction cached: {} lines".format(cache.get_info("extract", key)["lines"]))
+        return key, path
+    start = time.time()
+    with Converter(output=FileOutput(path)) as converter:
+        converter.convert([tmx_path], workers=workers)
+    cache.mark_done("extract", key, {"file": os.path.basename(tmx_path), "lines": converter.output_lines})
+    print("Converted lines:", converter.output_lines)
+    print("Extraction took {} minutes to complete.".format(convert_time_unit(time.time() - start)))
+    return key, path
+
+
+def tokenize_and_filter(src_path, trg_path, lang_code, cache, extract_key, min_len=2, max_len=30, workers=1,
+                        chunk_size=10000):
+    """
+    Streams the converted bitext through tokenization and length filter.
+    The tokenized chunks are cached by their content, so only new or changed chunks are tokenized.
+    :param src_path: the English bitext file
+    :param trg_path: the bitext file of the second language
+    :param lang_code: the second language
+    :param cache: the StageCache
+    :param extract_key: key of the extraction stage
+    :param min_len: minimum number of tokens
+    :param max_len: maximum number of tokens
+    :param workers: number of tokenizer processes
+    :param chunk_size: number of lines per chunk
+    :return: the stage key and the directory of the filtered.* files
+    """
+    signature = [tokenizer_signature("en"), tokenizer_signature(lang_code)]
+    key = hash_key("filter", extract_key, lang_code, signature, min_len, max_len)
+    path = cache.path("filter", key)
+    if cache.is_done("filter", key):
+        print("Tokenization and filtering cached: {} pairs".format(cache.get_info("filter", key)["filtered"]))
+        return key, path
+    print("\nTokenizing with {} worker(s) and reducing to sequences of min length {} max length {}..."
+          .format(workers, min_len, max_len))
+    start = time.time()
+    token_cache = TokenizationCache(cache, signature)
+    tokenized, filtered = 0, 0
+    with open(os.path.join(path, "filtered.en"), "w", encoding="utf8") as src_file, \
+            open(os.path.join(path, "filtered." + lang_code), "w", encoding="utf8") as trg_file:
+        for chunk in parallel_tokenize_pairs("en", lang_code, read_bitext(src_path, trg_path), workers=workers,
+                                             chunk_size=chunk_size, cache=token_cache):
+            kept = list(filter_by_length(chunk, min_len=min_len, max_len=max_len))
+            src_file.write("".join("{}\n".format(src) for src, _ in kept))
+            trg_file.write("".join("{}\n".format(trg) for _, trg in kept))
+            tokenized += len(chunk)
+            filtered += len(kept)
+            print("\r- Tokenized: {}".format(tokenized), end="")
+    cache.mark_done("filter", key, {"tokenized": tokenized, "filtered": filtered, "min_len": min_len,
+                                    "max_len": max_len, "tokenizers": signature})
+    print("\nTokenized pairs: {} ({} cached chunks, {} tokenized chunks), kept: {}".format(
+        tokenized, token_cache.hits, token_cache.misses, filtered))
+    print("Tokenization took {}".format(convert_time_unit(time.time() - start)))
+    return key, path
+
+
+def dedup_stage(src_path, trg_path, lang_code, cache, filter_key, threshold=0.7, workers=1, chunk_size=10000):
+    """
+    Removes the exact duplicates and, if the threshold is positive, the near-duplicates, see find_duplicates
+    :param src_path: the filtered English file
+    :param trg_path: the filtered file of the second language
+    :param lang_code: the second language
+    :param cache: the StageCache
+    :param filter_key: key of the filter stage
+    :param threshold: minimum estimated Jaccard similarity of near-duplicates
+    :param workers: number of processes computing the signatures
+    :param chunk_size: number of pairs per chunk
+    :return: the stage key and the directory of the dedup.* files
+    """
+    key = hash_key("dedup", filter_key, threshold, NUM_PERM, BANDS, SHINGLE_SIZE)
+    path = cache.path("dedup", key)
+    if not cache.is_done("dedup", key):
+        print("Removing duplicates...")
+        start = time.time()
+        keep, stats = find_duplicates(chunk_iterator(read_bitext(src_path, trg_path), chunk_size), path,
+                                      threshold=threshold, workers=workers)
+        with open(os.path.join(path, "dedup.en"), "w", encoding="utf8") as src_file, \
+                open(os.path.join(path, "dedup." + lang_code), "w", encoding="utf8") as trg_file:
+            for i, (src, trg) in enumerate(read_bitext(src_path, trg_path)):
+                if keep[i]:
+                    src_file.write("{}\n".format(src))
+                    trg_file.write("{}\n".format(trg))
+        cache.mark_done("dedup", key, dict(stats, threshold=threshold))
+        print("Deduplication took {}".format(convert_time_unit(time.time() - start)))
+    print(format_dedup_stats(cache.get_info("dedup", key)))
+    return key, path
+
+
+def split_stage(src_path, trg_path, lang_code, filter_key, store_path, val_samples=3000, samples=5):
+    """
+    Writes the split files, they are kept if the filtered corpus and the split parameters did not change
+    :param src_path: the filtered English file
+    :param trg_path: the filtered file of the second language
+    :param lang_code: the second language
+    :param filter_key: key of the filter stage
+    :param store_path: directory of the split files
+    :param val_samples: number of validation/test samples or their ratio, see SplitWriter
+    :param samples: number of pairs per split in the samples files, 0 to skip them
+    :return: number of pairs per split, None if the splits are up to date
+    """
+    # "shuffled": the splits written before the external shuffle of the training pairs are not reused
+    key = hash_key("split", "shuffled", filter_key, val_samples, SEED, samples)
+    key_path = os.path.join(store_path, "split.key")
+    if os.path.isfile(key_path):
+        with open(key_path, encoding="utf-8") as f:
+            up_to_date = f.read().strip() == key
+        if up_to_date:
+            print("Splits are up to date: {}".format(store_path))
+            return None
+    print("Splitting files...")
+    with SplitWriter(store_path, (".en", "." + lang_code), val_samples=val_samples, samples=samples) as split_writer:
+        for chunk in chunk_iterator(read_bitext(src_path, trg_path), 10000):
+            split_writer.write(chunk)
+    with open(key_path, "w", encoding="utf-8") as f:
+        f.write(key)
+    return split_writer.counts
+
+
+def check_lang_code(lang_code):
+    if lang_code == "en":
+        raise SystemExit("English is the default language. Please provide second language!")
+    if not lang_code:
+        raise SystemExit("Empty language not allowed!")
 
 
 def preprocess_single_dataset(config, lang_code, parser):
@@ -28,24 +161,25 @@ def preprocess_single_dataset(config, lang_code, parser):
     :param lang_code: langauge code (other than English)
     :param parser: arg parser
     """
-    if lang_code == "en":
-        raise SystemExit("English is the default language. Please provide second language!")
-    if not lang_code:
-        raise SystemExit("Empty language not allowed!")
+    check_lang_code(lang_code)
 
-    downloader = TmxCorpusDownloader(config, lang_code="fr")
+    downloader = TmxCorpusDownloader(config, lang_code=lang_code)
     file_dir = downloader.download()
-    file_extractor = FileExtractor(file_dir)
-    file_extractor.extract()
 
+    # .tmx.gz files are parsed while they are decompressed, other archives are extracted first
     path_to_raw_file_dir = os.path.join(DATA_DIR_RAW, config.dataset_name, lang_code)
-    path_to_tmx_file = [f for f in os.listdir(path_to_raw_file_dir) if f.endswith(".tmx")]
+    path_to_tmx_file = [f for f in os.listdir(path_to_raw_file_dir) if f.endswith((".tmx", ".tmx.gz"))]
+    if not path_to_tmx_file:
+        file_extractor = FileExtractor(file_dir)
+        file_extractor.extract()
+        path_to_tmx_file = [f for f in os.listdir(path_to_raw_file_dir) if f.endswith(".tmx")]
+    # an already extracted file is faster to parse
+    path_to_tmx_file = [f for f in path_to_tmx_file if f.endswith(".tmx")] or path_to_tmx_file
     assert len(path_to_tmx_file) == 1
     tmx_file_name = path_to_tmx_file[0]
 
     MAX_LEN, MIN_LEN = 30, 2  # min_len is by defaul 2 tokens
 
-    file_name = lang_code + "-" + "en" + ".tmx"
     COMPLETE_PATH = os.path.join(path_to_raw_file_dir, tmx_file_name)
     print(COMPLETE_PATH)
 
@@ -54,100 +188,37 @@ def preprocess_single_dataset(config, lang_code, parser):
 
     start = time.time()
     output_file_path = os.path.join(DATA_DIR_PREPRO, config.dataset_name, lang_code)
+    # each stage is stored under the hash of its inputs and parameters
+    cache = StageCache(os.path.join(output_file_path, "cache"))
 
     # Conversion tmx > text
-    converter = Converter(output=FileOutput(output_file_path))
-    converter.convert([COMPLETE_PATH])
-    print("Converted lines:", converter.output_lines)
-    print("Extraction took {} minutes to complete.".format(convert_time_unit(time.time() - start)))
+    extract_key, extract_path = extract_stage(COMPLETE_PATH, cache, workers=parser.workers)
 
-    target_file = "bitext.{}".format(lang_code)
-    src_lines, trg_lines = [], []
-
-    # Read converted lines for further preprocessing
-    with open(os.path.join(output_file_path, "bitext.en"), 'r', encoding="utf8") as src_file, \
-            open(os.path.join(output_file_path, target_file), 'r', encoding="utf8") as target_file:
-        for src_line, trg_line in zip(src_file, target_file):
-            src_line = src_line.strip()
-            trg_line = trg_line.strip()
-            if src_line != "" and trg_line != "":
-                src_lines.append(src_line)
-                trg_lines.append(trg_line)
-
-    ### tokenize lines ####
-    assert len(src_lines) == len(trg_lines), "Lines should have the same lengths."
-
-    TOKENIZATION_MODE = "w"
-    PREPRO_PHASE = True
-    # Get tokenizer
-    src_tokenizer, trg_tokenizer = get_custom_tokenizer("en", TOKENIZATION_MODE, prepro=PREPRO_PHASE), \
-                                   get_custom_tokenizer(lang_code, TOKENIZATION_MODE, prepro=PREPRO_PHASE)
-
-    # Creates logger to log tokenized objects
-    src_logger = Logger(output_file_path, file_name="bitext.tok.en")
-    trg_logger = Logger(output_file_path, file_name="bitext.tok.{}".format(lang_code))
-
-    temp_src_toks, temp_trg_toks = [], []
-
-    # Start the tokenisation process
-    if isinstance(src_tokenizer, SpacyTokenizer):
-        print("\nTokenization for source sequences is performed with spaCy")
-        with src_tokenizer.nlp.disable_pipes('ner'):
-            for i, doc in enumerate(src_tokenizer.nlp.pipe(src_lines, batch_size=1000)):
-                tok_doc = ' '.join([tok.text for tok in doc])
-                temp_src_toks.append(tok_doc)
-                src_logger.log(tok_doc, stdout=True if i % 100000 == 0 else False)
-    else:
-        print("\nTokenization for source sequences is performed with FastTokenizer")
-        for i, sent in enumerate(src_lines):
-            tok_sent = src_tokenizer.tokenize(sent)
-            tok_sent = ' '.join(tok_sent)
-            temp_src_toks.append(tok_sent)
-            src_logger.log(tok_sent, stdout=True if i % 100000 == 0 else False)
-
-    if isinstance(trg_tokenizer, SpacyTokenizer):
-        print("\nTokenization for target sequences is performed with spaCy")
-        with trg_tokenizer.nlp.disable_pipes('ner'):
-            for i, doc in enumerate(trg_tokenizer.nlp.pipe(trg_lines, batch_size=1000)):
-                tok_doc = ' '.join([tok.text for tok in doc])
-                temp_trg_toks.append(tok_doc)
-                trg_logger.log(tok_doc, stdout=True if i % 100000 == 0 else False)
+    # Stream the converted lines: tokenize > filter by length
+    filter_key, filter_path = tokenize_and_filter(os.path.join(extract_path, "bitext.en"),
+                                                  os.path.join(extract_path, "bitext.{}".format(lang_code)),
+                                                  lang_code, cache, extract_key, min_len=MIN_LEN, max_len=MAX_LEN,
+                                                  workers=parser.workers, chunk_size=parser.chunk_size)
+
+    # Remove duplicated pairs, they would leak between the splits
+    if parser.dedup:
+        filter_key, filter_path = dedup_stage(os.path.join(filter_path, "filtered.en"),
+                                              os.path.join(filter_path, "filtered.{}".format(lang_code)),
+                                              lang_code, cache, filter_key, threshold=parser.dedup_threshold,
+                                              workers=parser.workers, chunk_size=parser.chunk_size)
+        file_name = "dedup"
     else:
-        print("\nTokenization for target sequences is performed with FastTokenizer")
-        for i, sent in enumerate(trg_lines):
-            tok_sent = trg_tokenizer.tokenize(sent)
-            tok_sent = ' '.join(tok_sent)
-            temp_src_toks.append(tok_sent)
-            src_logger.log(tok_sent, stdout=True if i % 100000 == 0 else False)
-
-    # Reduce lines by max_len
-    filtered_src_lines, filtered_trg_lines = [], []
-    print("Reducing corpus to sequences of min length {} max length: {}".format(MIN_LEN, MAX_LEN))
-
-    filtered_src_lines, filtered_trg_lines = [], []
-    for src_l, trg_l in zip(temp_src_toks, temp_trg_toks):
-        ### remove possible duplicate spaces
-        src_l_s = re.sub(' +', ' ', src_l)
-        trg_l_s = re.sub(' +', ' ', trg_l)
-        if src_l_s != "" and trg_l_s != "":
-            src_l_spl, trg_l_spl = src_l_s.split(" "), trg_l_s.split(" ")
-            if len(src_l_spl) <= MAX_LEN and len(trg_l_spl) <= MAX_LEN:
-                if len(src_l_spl) >= MIN_LEN and len(trg_l_spl) >= MIN_LEN:
-                    filtered_src_lines.append(' '.join(src_l_spl))
-                    filtered_trg_lines.append(' '.join(trg_l_spl))
-
-        assert len(filtered_src_lines) == len(filtered_trg_lines)
-
-    src_lines, trg_lines = filtered_src_lines, filtered_trg_lines
-    print("Splitting files...")
-    train_data, val_data, test_data, samples_data = custom_data_splits(src_lines, trg_lines,
-                                                                       val_samples=parser.test_ratio)
-    persist_txt(train_data, STORE_PATH, "train.tok", exts=(".en", "." + lang_code))
-    persist_txt(val_data, STORE_PATH, "val.tok", exts=(".en", "." + lang_code))
-    persist_txt(test_data, STORE_PATH, "test.tok", exts=(".en", "." + lang_code))
-    if lang_code != "de":  # for german language sample files are versioned with the program
-        print("Generating samples files...")
-        persist_txt(samples_data, STORE_PATH, file_name="samples.tok", exts=(".en", "." + lang_code))
+        file_name = "filtered"
+
+    counts = split_stage(os.path.join(filter_path, file_name + ".en"),
+                         os.path.join(filter_path, "{}.{}".format(file_name, lang_code)), lang_code, filter_key,
+                         STORE_PATH, val_samples=parser.test_ratio,
+                         # for german language sample files are versioned with the program
+                         samples=0 if lang_code == "de" else 5)
+    if counts:
+        for split, count in counts.items():
+            print("Total {}: {}".format(split, count))
+        print("All:", sum(counts.values()))
 
     print("Total time:", convert_time_unit(time.time() - start))
 
@@ -164,14 +235,28 @@ def data_prepro_parser():
                         help="First language is English. Specifiy with 'lang_code' the second language as language code (e.g. 'de').")
     parser.add_argument("--test_ratio", help="Specify the test ratio. Standard: 3000 samples. If you pass a float, this will be split the data based on that proportion, e.g. 0.1 --> 0.8, 0.1, 0.1",
                         type=str2number, default=3000)
+    parser.add_argument("--workers", default=os.cpu_count() or 1, type=int,
+                        help="Number of processes parsing the TMX and tokenizing, each loads its own tokenizer. Default: number of CPUs")
+    parser.add_argument("--chunk_size", default=10000, type=int,
+                        help="Number of lines tokenized by a worker at once. Default: 10000")
+    parser.add_argument("--dedup", default=True, type=str2bool,
+                        help="Remove duplicated and near-duplicated sentence pairs. Default: True")
+    parser.add_argument("--dedup_threshold", default=0.7, type=float,
+                        help="Minimum similarity (estimated Jaccard of the token bigrams) of near-duplicates, "
+                             "0 removes exact duplicates only. Default: 0.7")
+    parser.add_argument("--download_workers", default=4, type=int,
+                        help="Number of corpora downloaded concurrently. Default: 4")
     return parser
 
 
 if __name__ == '__main__':
     parser = data_prepro_parser().parse_args()
-    CORPUS = parser.dataset
+    CORPORA = [parser.dataset] if isinstance(parser.dataset, str) else parser.dataset
     lang_code = parser.lang_code.lower()
-    # get corpus config
-    config = DatasetConfigParser(CORPUS)
-    # preprocess corpus
-    preprocess_single_dataset(config, lang_code, parser)
+    # get corpus configs
+    configs = [DatasetConfigParser(corpus) for corpus in CORPORA]
+    check_lang_code(lang_code)
+    # download the corpora concurrently, then preprocess them
+    download_corpora(configs, lang_code, workers=parser.download_workers)
+    for config in configs:
+        preprocess_single_dataset(config, lang_code, parser)
@@ -95,15 +95,17 @@ class Seq2Seq(nn.Module):
 
 
     #### Original code #####
-    def predict(self, src, beam_size=1, max_len=30, remove_tokens=[]):
+    def predict(self, src, beam_size=1, max_len=30, remove_tokens=[], stats=None):
         '''Predict top 1 sentence using beam search. Note that beam_size=1 is greedy search.'''
-        beam_outputs = self.beam_search(src, beam_size, max_len=max_len, remove_tokens=remove_tokens)
+        beam_outputs = self.beam_search(src, beam_size, max_len=max_len, remove_tokens=remove_tokens, stats=stats)
         top1 = beam_outputs[0][1]  # a list of word indices (as ints)
         return top1
 
-    def beam_search(self, src, beam_size, max_len, remove_tokens=[]):
+    def beam_search(self, src, beam_size, max_len, remove_tokens=[], stats=None):
         '''Returns top beam_size sentences using beam search. Works only when src has batch size 1.
+        A TranslationStats passed as stats collects the encoder and decoder step latencies and the beam occupancy.
         '''
+        if stats: start = stats.now()
         src = src.to(self.device)
         if self.reverse_input:
             inv_index = torch.arange(src.size(0) - 1, -1, -1).long()
@@ -111,6 +113,9 @@ class Seq2Seq(nn.Module):
             src = src.index_select(0, inv_index)
         # Encode
         outputs_e, states = self.encoder(src)  # batch size = 1
+        if stats:
+            decode_start = stats.now()
+            stats.add("encode", decode_start - start)
         # Start with '<sos>'
         init_lprob = -1e10
         init_sent = [self.bos_token]
@@ -118,10 +123,12 @@ class Seq2Seq(nn.Module):
         # Beam search
         k = beam_size  # store best k options
         for length in range(max_len):  # maximum target length
+            if stats: step_start, active = stats.now(), 0
             options = []  # candidates
             for lprob, sentence, current_state in best_options:
                 last_word = sentence[-1] #decoder input always last word
                 if last_word != self.eos_token:
+                    if stats: active += 1
                     last_word_input = torch.LongTensor([last_word]).view(1, 1).to(self.device)
                     outputs_d, new_state = self.decoder(last_word_input, current_state)
                     # Attend
@@ -149,6 +156,9 @@ class Seq2Seq(nn.Module):
                     options.append((lprob, sentence, current_state))
             options.sort(key=lambda x: x[0], reverse=True)  # sort by lprob
             best_options = options[:k]  # place top candidates in beam
+            if stats and active:
+                stats.add_decode_step(stats.now() - step_start, active, k)
+        if stats: stats.add("decode", stats.now() - decode_start)
         best_options.sort(key=lambda x: x[0], reverse=True)
         return best_options
 
@@ -2,8 +2,13 @@
 This file contains functions to persist and split data.
 """
 
+import hashlib
+import heapq
 import os
 import random
+import re
+import shutil
+import tempfile
 from settings import SEED
 
 
@@ -109,4 +114,170 @@ def persist_txt(lines, store_path, file_name, exts):
             lines = list(zip(lines[0], lines[1]))
             for src, trg in lines:
                 src_out_file.write("{}\n".format(src))
-                trg_out_file.write("{}\n".format(trg))
\ No newline at end of file
+                trg_out_file.write("{}\n".format(trg))
+
+
+def read_bitext(src_path, trg_path):
+    """
+    Reads the aligned lines of two bitext files one by one
+    :return: generator of (source, target) pairs, pairs with an empty side are skipped
+    """
+    with open(src_path, mode="r", encoding="utf-8") as src_file, \
+            open(trg_path, mode="r", encoding="utf-8") as trg_file:
+        for src_line, trg_line in zip(src_file, trg_file):
+            src_line, trg_line = src_line.strip(), trg_line.strip()
+            if src_line != "" and trg_line != "":
+                yield src_line, trg_line
+
+
+def filter_by_length(pairs, min_len=2, max_len=30):
+    """
+    Keeps the tokenized pairs whose sides have between min_len and max_len tokens, duplicate spaces are removed
+    :param pairs: iterable of tokenized (source, target) pairs
+    :return: generator of the kept pairs
+    """
+    for src, trg in pairs:
+        src, trg = re.sub(' +', ' ', src), re.sub(' +', ' ', trg)
+        if src != "" and trg != "":
+            src_len, trg_len = len(src.split(" ")), len(trg.split(" "))
+            if min_len <= src_len <= max_len and min_len <= trg_len <= max_len:
+                yield src, trg
+
+
+def split_hash(src, trg, seed=SEED):
+    """
+    :return: deterministic number in [0, 1) of the pair, independent of its position in the corpus
+    """
+    digest = hashlib.md5("{}\t{}\t{}".format(seed, src, trg).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") / 2 ** 64
+
+
+class SplitWriter(object):
+    """
+    Assigns the pairs of a stream to the train, validation and test splits by their hash and writes them incrementally.
+    The assignment does not depend on the order of the corpus and equal pairs always land in the same split.
+    With a number of validation/test samples, the pairs with the smallest hashes are kept in a heap of that size
+    and written at the end, all other pairs are written to the training files right away.
+    With a ratio, e.g. 0.1, the splits are 80/10/10.
+    The training pairs are shuffled externally: they are distributed by a second hash over temporary bucket files,
+    which are sorted one by one and concatenated at the end. The training files are thus in a random order, e.g. for the
+    reduction to their first lines, and only a bucket is held in memory.
+    """
+
+    def __init__(self, store_path, exts, val_samples=3000, seed=SEED, samples=5, buckets=64):
+        """
+        :param store_path: the directory of the split files
+        :param exts: tuple with the extensions of the source and target files, e.g. (".en", ".de")
+        :param val_samples: number of validation/test samples (int) or their ratio (float)
+        :param seed: the seed of the hash
+        :param samples: number of pairs per split written to samples.tok.*, 0 to skip the samples files
+        :param buckets: number of temporary files of the shuffle of the training pairs
+        """
+        self.store_path = store_path
+        self.exts = exts
+        self.val_samples = val_samples
+        self.seed = seed
+        self.samples = samples
+        self.heap = []
+        self.counts = {"train": 0, "val": 0, "test": 0}
+        self.sample_pairs = {"train": [], "val": [], "test": []}
+        self.files = {split: [open(os.path.join(store_path, split + ".tok" + ext), mode="w", encoding="utf-8")
+                              for ext in exts] for split in self.counts.keys()}
+        self.bucket_path = tempfile.mkdtemp(prefix="train_buckets", dir=store_path)
+        self.buckets = [[open(os.path.join(self.bucket_path, str(i) + ext), mode="w", encoding="utf-8") for ext in exts]
+                        for i in range(buckets)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _write(self, split, pairs):
+        if not pairs:
+            return
+        src_file, trg_file = self.files[split]
+        src_file.write("".join("{}\n".format(src) for src, _ in pairs))
+        trg_file.write("".join("{}\n".format(trg) for _, trg in pairs))
+        self.counts[split] += len(pairs)
+        missing = self.samples - len(self.sample_pairs[split])
+        if missing > 0:
+            self.sample_pairs[split].extend(pairs[:missing])
+
+    def _order_hash(self, src, trg):
+        return split_hash(src, trg, "order-{}".format(self.seed))
+
+    def _write_buckets(self, pairs):
+        buckets = dict()
+        for src, trg in pairs:
+            buckets.setdefault(int(self._order_hash(src, trg) * len(self.buckets)), []).append((src, trg))
+        for i, bucket_pairs in buckets.items():
+            src_file, trg_file = self.buckets[i]
+            src_file.write("".join("{}\n".format(src) for src, _ in bucket_pairs))
+            trg_file.write("".join("{}\n".format(trg) for _, trg in bucket_pairs))
+
+    def _write_train(self):
+        """
+        Writes the buckets sorted by the order hash to the training files, the order of the training pairs is the
+        order of their hashes
+        """
+        for i, bucket_files in enumerate(self.buckets):
+            for f in bucket_files:
+                f.close()
+            names = [os.path.join(self.bucket_path, str(i) + ext) for ext in self.exts]
+            pairs = list(read_bitext(*names))
+            pairs.sort(key=lambda pair: self._order_hash(*pair))
+            self._write("train", pairs)
+            for name in names:
+                os.remove(name)
+
+    def write(self, pairs):
+        """
+        :param pairs: iterable of (source, target) pairs
+        """
+        splits = {"train": [], "val": [], "test": []}
+        if isinstance(self.val_samples, int):
+            size = 2 * self.val_samples
+            for src, trg in pairs:
+                # max-heap on the hash, the largest hash is evicted to the training set
+                item = (-split_hash(src, trg, self.seed), src, trg)
+                if len(self.heap) < size:
+                    heapq.heappush(self.heap, item)
+                elif size > 0 and item > self.heap[0]:
+                    _, src, trg = heapq.heapreplace(self.heap, item)
+                    splits["train"].append((src, trg))
+                else:
+                    splits["train"].append((src, trg))
+        else:
+            for src, trg in pairs:
+                value = split_hash(src, trg, self.seed)
+                split = "val" if value < self.val_samples else "test" if value < 2 * self.val_samples else "train"
+                splits[split].append((src, trg))
+        self._write_buckets(splits.pop("train"))
+        for split, split_pairs in splits.items():
+            self._write(split, split_pairs)
+
+    def close(self):
+        """
+        Writes the shuffled training pairs, the held validation and test pairs, the samples files and closes the files
+        :return: the number of pairs per split
+        """
+        if self.files is None:
+            return self.counts
+        try:
+            self._write_train()
+        finally:
+            shutil.rmtree(self.bucket_path, ignore_errors=True)
+        if isinstance(self.val_samples, int):
+            held = [(src, trg) for _, src, trg in sorted(self.heap, reverse=True)]
+            self.heap = []
+            self._write("val", held[:self.val_samples])
+            self._write("test", held[self.val_samples:])
+        for split_files in self.files.values():
+            for f in split_files:
+                f.close()
+        self.files = None
+        if self.samples > 0:
+            samples = self.sample_pairs["train"] + self.sample_pairs["val"] + self.sample_pairs["test"]
+            persist_txt(list(zip(*samples)), self.store_path, file_name="samples.tok", exts=self.exts)
+        return self.counts
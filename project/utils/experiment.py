@@ -14,7 +14,10 @@ class Experiment(object):
         self.epochs = self.args.epochs
         self.batch_size = self.args.b
         self.voc_limit = self.args.v
-        self.corpus = self.args.corpus
+        # one or more corpora, a mix is named after its corpora, e.g. europarl+tatoeba
+        corpora = self.args.corpus
+        self.corpora = [corpora] if isinstance(corpora, str) else list(corpora)
+        self.corpus = "+".join(self.corpora)
         self.lang_code = self.args.lang_code
         self.reverse_lang_comb = self.args.reverse
         self.min_freq = self.args.min if self.args.min >= 0 else 5
@@ -59,6 +62,23 @@ class Experiment(object):
         self.dp = self.args.dp
         self.tok = self.args.tok
         self.val_beam_size = self.args.beam
+        # not available in the configurations of older experiments
+        self.async_val = getattr(self.args, "async_val", False)
+        self.val_metric = getattr(self.args, "val_metric", "bleu")
+        self.ppl_every = getattr(self.args, "ppl_every", 0)
+        self.bleu_every = max(1, getattr(self.args, "bleu_every", 1))
+        self.keep_checkpoints = getattr(self.args, "keep_checkpoints", 0)
+        self.checkpoint_every = getattr(self.args, "checkpoint_every", 0)
+        self.resume = getattr(self.args, "resume", "")
+        self.profile = getattr(self.args, "profile", 0)
+        self.profile_modules = getattr(self.args, "profile_modules", False)
+        self.dry_run = getattr(self.args, "dry_run", False)
+        self.memory_snapshot = getattr(self.args, "memory_snapshot", False)
+        self.bpe = getattr(self.args, "bpe", 0)
+        self.pretrained = getattr(self.args, "pretrained", "")
+        self.freeze_emb = getattr(self.args, "freeze_emb", False)
+        self.corpus_weights = getattr(self.args, "corpus_weights", None)
+        self.temperature = getattr(self.args, "temperature", 1.0)
 
     def get_args(self):
         return self.args
@@ -43,8 +43,11 @@ with subclasses of the Tokenizer or Filter objects.
 '''
 
 import os
-import codecs
+import gzip
+import io
 import logging
+import multiprocessing
+from collections import deque
 #logging.basicConfig(filename='converter.log',level=logging.DEBUG)
 from xml.etree import ElementTree
 
@@ -56,6 +59,12 @@ except ModuleNotFoundError:
     unescape = html.unescape
 
 
+# buffer size of the output files
+WRITE_BUFFER_SIZE = 1 << 20
+# bytes of decompressed TMX parsed by a worker at once
+SHARD_SIZE = 16 << 20
+
+
 class FileOutput(object):
     def __init__(self, path=os.getcwd()):
         self.files = {}
@@ -64,13 +73,15 @@ class FileOutput(object):
 
     def init(self, language):
         if language not in self.files:
-            self.files[language] = codecs.open(os.path.join(
-                self.path, 'bitext.' + language), 'w', encoding='utf-8')
+            self.files[language] = open(os.path.join(self.path, 'bitext.' + language), 'w', encoding='utf-8',
+                                        buffering=WRITE_BUFFER_SIZE)
 
     def write(self, language, content):
-        out_file = self.files[language]
-        out_file.write(content)
-        out_file.write('\n')
+        self.files[language].write(content + '\n')
+
+    def flush(self):
+        for out_file in self.files.values():
+            out_file.flush()
 
     def cleanup(self):
         for out_file in self.files.values():
@@ -94,18 +105,44 @@ class Converter(object):
     def __exit__(self, type, value, traceback):
         self.output.cleanup()
 
-    def convert(self, files):
+    def convert(self, files, workers=1, shard_size=SHARD_SIZE):
+        """
+        :param files: the .tmx or .tmx.gz files
+        :param workers: number of processes, with more than 1 the files are parsed in shards, see iter_tmx_shards
+        :param shard_size: approximate number of bytes of a shard
+        """
         self.suppress_count = 0
         self.output_lines = 0
         for tmx in files:
             print('Extracting %s' % os.path.basename(tmx))
-            for bitext in extract_tmx(tmx):
-                self.__output(bitext)
+            if workers > 1:
+                self.__convert_shards(tmx, workers, shard_size)
+            else:
+                for bitext in extract_tmx(tmx):
+                    self.__output(bitext)
+        self.output.flush()
         logging.debug('Output %d pairs', self.output_lines)
         if self.suppress_count:
             logging.debug('Suppressed %d pairs', self.suppress_count)
         return True
 
+    def __convert_shards(self, tmx, workers, shard_size):
+        # at most 2 shards per worker are in flight, the outputs are written in the order of the shards
+        with multiprocessing.Pool(workers) as pool:
+            pending = deque()
+            for shard in iter_tmx_shards(tmx, shard_size):
+                pending.append(pool.apply_async(extract_shard, (shard,)))
+                if len(pending) >= 2 * workers:
+                    self.__output_shard(*pending.popleft().get())
+            while pending:
+                self.__output_shard(*pending.popleft().get())
+
+    def __output_shard(self, count, lines):
+        for lang, text in lines.items():
+            self.output.init(lang)
+            self.output.write(lang, text)
+        self.output_lines += count
+
     def __output(self, bitext):
 
         for lang in bitext.keys():
@@ -124,14 +161,113 @@ def get_files(path, ext):
                 yield os.path.join(root, a_file)
 
 
+def open_tmx(tmx):
+    """
+    Opens a .tmx or a gzip compressed .tmx.gz file, the latter is decompressed while it is read
+    """
+    if tmx.endswith('.gz'):
+        return gzip.open(tmx, 'rb')
+    return open(tmx, 'rb')
+
+
 def extract_tmx(tmx):
-    for event, elem in ElementTree.iterparse(tmx):
+    """
+    Streams the translation units of the file, each unit is removed from the tree once extracted,
+    so the memory does not grow with the file size
+    """
+    with open_tmx(tmx) as tmx_file:
+        for bitext in extract_units(tmx_file):
+            yield bitext
+
+
+def extract_units(tmx_file):
+    parent = None
+    for event, elem in ElementTree.iterparse(tmx_file, events=('start', 'end')):
+        if event == 'start':
+            if elem.tag == 'body':
+                parent = elem
+            continue
         if elem.tag == 'tu':
             bitext = extract_tu(elem)
+            elem.clear()
+            if parent is not None:
+                # the cleared units are still children of <body>
+                del parent[:]
             if bitext:
                 yield bitext
 
 
+def _is_tu_tag(buffer, pos):
+    # excludes '<tuv' and tags cut at the end of the buffer
+    return buffer[pos + 3:pos + 4] in (b' ', b'>', b'\t', b'\n', b'\r')
+
+
+def _find_first_tu(buffer):
+    """
+    :return: position of the first complete '<tu' start tag in the buffer, -1 if none
+    """
+    pos = buffer.find(b'<tu')
+    while pos >= 0 and not _is_tu_tag(buffer, pos):
+        pos = buffer.find(b'<tu', pos + 1)
+    return pos
+
+
+def _find_last_tu(buffer):
+    """
+    :return: position of the last complete '<tu' start tag in the buffer, -1 if none
+    """
+    pos = buffer.rfind(b'<tu')
+    while pos >= 0 and not _is_tu_tag(buffer, pos):
+        pos = buffer.rfind(b'<tu', 0, pos)
+    return pos
+
+
+def iter_tmx_shards(tmx, shard_size=SHARD_SIZE):
+    """
+    Reads the decompressed TMX sequentially and cuts it into byte ranges aligned on <tu> start tags.
+    The header before the first unit and the closing tags after </body> are left out.
+    Markup in segments is escaped, so '<tu' only occurs as a tag.
+    :param tmx: the .tmx or .tmx.gz file
+    :param shard_size: approximate number of bytes of a shard, a shard holds at least one unit
+    :return: generator of the shards as bytes
+    """
+    with open_tmx(tmx) as tmx_file:
+        buffer, started = b'', False
+        while True:
+            block = tmx_file.read(shard_size)
+            buffer += block
+            if not started:
+                first = _find_first_tu(buffer)
+                if first < 0:
+                    if not block:
+                        return
+                    continue
+                buffer, started = buffer[first:], True
+            if not block:
+                end = buffer.rfind(b'</body>')
+                shard = buffer[:end] if end >= 0 else buffer
+                if shard.strip():
+                    yield shard
+                return
+            last = _find_last_tu(buffer)
+            if last > 0:
+                yield buffer[:last]
+                buffer = buffer[last:]
+
+
+def extract_shard(shard):
+    """
+    Extracts the translation units of a shard, see iter_tmx_shards. The TMX is expected to be UTF-8 encoded.
+    :return: number of units and dictionary of the lines of each language, joined by new lines
+    """
+    lines, count = {}, 0
+    for bitext in extract_units(io.BytesIO(b'<body>' + shard + b'</body>')):
+        for lang, text in bitext.items():
+            lines.setdefault(lang, []).append(text)
+        count += 1
+    return count, {lang: '\n'.join(texts) for lang, texts in lines.items()}
+
+
 def extract_tu(tu):
     bitext = {}
     for tuv in tu.findall('tuv'):
@@ -201,10 +337,10 @@ def convert(paths,output=None):
     files = set()
     for path in sorted(set(os.path.abspath(p) for p in paths)):
         if os.path.isdir(path):
-            tmxs = set(get_files(path, '.tmx'))
+            tmxs = set(get_files(path, ('.tmx', '.tmx.gz')))
             logging.info('Queuing %d TMX(s) in %s', len(tmxs), path)
             files |= tmxs
-        elif os.path.isfile(path) and path.endswith('.tmx'):
+        elif os.path.isfile(path) and path.endswith(('.tmx', '.tmx.gz')):
             files.add(path)
     if files:
         with Converter(output or FileOutput()) as converter:
@@ -0,0 +1,199 @@
+"""
+This file contains the asynchronous successive halving (ASHA, https://arxiv.org/abs/1810.05934) of the trials of a sweep.
+The trials are trained in rungs of increasing numbers of epochs, e.g. 2, 6, 18 and 54 with 2 minimal epochs and
+a reduction factor of 3. A trial is promoted to the next rung if its validation score is in the top third of the trials
+which finished the rung, the training then continues from its last checkpoint. The other trials stay paused,
+a free worker starts a new trial if no trial can be promoted.
+"""
+import copy
+import functools
+import json
+import os
+from collections import deque
+
+from project.utils.utils_sweep import SweepPool
+
+
+def get_rungs(max_epochs, min_epochs=1, eta=3):
+    """
+    :return: list of the numbers of epochs of the rungs, the last one is max_epochs
+    """
+    rungs, epochs = [], max(1, min_epochs)
+    while epochs < max_epochs:
+        rungs.append(epochs)
+        epochs *= eta
+    return rungs + [max_epochs]
+
+
+def read_validation_scores(path, metric="bleu", file_name="metrics.jsonl"):
+    """
+    :param path: the experiment directory
+    :param metric: 'bleu' or 'ppl'
+    :return: list of (epoch, score) of the validations logged in the metrics file of the experiment
+    """
+    scores = []
+    metrics_file = os.path.join(path, file_name)
+    if not os.path.isfile(metrics_file):
+        return scores
+    with open(metrics_file, encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            score = record.get("val_" + metric)
+            if score is not None and "epoch" in record:
+                scores.append((record["epoch"], score))
+    return scores
+
+
+def best_score(scores, epochs, lower_is_better=False):
+    """
+    :param scores: list of (epoch, score), see read_validation_scores
+    :return: the best score of the first epochs, None without validation
+    """
+    scores = [score for epoch, score in scores if epoch <= epochs]
+    if not scores:
+        return None
+    return min(scores) if lower_is_better else max(scores)
+
+
+class SuccessiveHalving(object):
+    """
+    Decides which trial is trained next and for how many epochs, independently of the training
+    """
+
+    def __init__(self, num_trials, rungs, eta=3, lower_is_better=False):
+        """
+        :param num_trials: number of trials
+        :param rungs: numbers of epochs of the rungs, see get_rungs
+        :param eta: reduction factor, the top 1/eta of the trials of a rung are promoted
+        :param lower_is_better: True for the perplexity
+        """
+        self.rungs = rungs
+        self.eta = eta
+        self.lower_is_better = lower_is_better
+        self.waiting = deque(range(num_trials))
+        # rung -> {trial: score}
+        self.scores = [dict() for _ in rungs]
+        self.promoted = [set() for _ in rungs]
+
+    def next_job(self):
+        """
+        :return: (trial, rung) to train the trial up to the epochs of the rung, or None if no trial can be trained now
+        """
+        for rung in reversed(range(len(self.rungs) - 1)):
+            for trial in self.top_trials(rung):
+                if trial not in self.promoted[rung]:
+                    self.promoted[rung].add(trial)
+                    return trial, rung + 1
+        if self.waiting:
+            return self.waiting.popleft(), 0
+        return None
+
+    def top_trials(self, rung):
+        """
+        :return: the top 1/eta of the trials which finished the rung, best first
+        """
+        scores = self.scores[rung]
+        ranked = sorted(scores, key=lambda trial: scores[trial], reverse=not self.lower_is_better)
+        return ranked[:len(ranked) // self.eta]
+
+    def report(self, trial, rung, score, final=False):
+        """
+        Records the validation score of the trial at the end of the rung, failed trials are not reported
+        :param final: True if the trial cannot be trained further, e.g. stopped early, it is never promoted
+        but its score still ranks the other trials of the rung
+        """
+        if score is not None:
+            self.scores[rung][trial] = score
+        if final:
+            self.promoted[rung].add(trial)
+
+    def last_rung(self, trial):
+        """
+        :return: the highest rung finished by the trial, -1 if none
+        """
+        finished = [rung for rung, scores in enumerate(self.scores) if trial in scores]
+        return finished[-1] if finished else -1
+
+
+def _run_trial(run, experiment, data, path_suffix, epochs, resume="", evaluate=False):
+    """
+    Trains the trial up to the given epochs, from its last checkpoint if resume is its experiment directory
+    """
+    experiment = copy.copy(experiment)
+    experiment.epochs = epochs
+    experiment.resume = resume
+    # the training of a paused trial is continued from its checkpoint
+    experiment.keep_checkpoints = max(1, experiment.keep_checkpoints)
+    return run(experiment, data, path_suffix, evaluate=evaluate)
+
+
+def run_asha(experiments, run, load, workers=1, threads=None, min_epochs=1, eta=3, on_result=None):
+    """
+    Runs the trials of a sweep with asynchronous successive halving, see SuccessiveHalving.
+    The maximal number of epochs is the one of the experiments, the test of the model is run for the trials
+    trained up to it. The trials stopped early by the training are not promoted.
+    :param experiments: list of Experiment, with the same validation metric
+    :param run: function(experiment, data, path_suffix, evaluate) training the experiment and returning
+    its directory as "path" and optionally "stopped_early", see train_model.run_experiment
+    :param load: function(experiment) loading the data of the experiment, see get_vocabularies_and_iterators
+    :param min_epochs: number of epochs of the first rung
+    :param eta: reduction factor
+    :param on_result: optional function called with the result of each rung of a trial when it is finished
+    :return: list of the summaries of the trials, in the order of the experiments
+    """
+    metrics = set(experiment.val_metric for experiment in experiments)
+    if len(metrics) > 1:
+        raise ValueError("The trials are compared with their validation metric, use the same for all: {}".format(
+            ", ".join(sorted(metrics))))
+    metric = metrics.pop()
+    lower_is_better = metric == "ppl"
+    rungs = get_rungs(max(experiment.epochs for experiment in experiments), min_epochs, eta)
+    scheduler = SuccessiveHalving(len(experiments), rungs, eta=eta, lower_is_better=lower_is_better)
+    trials = [{"index": i, "status": "waiting", "path": None, "epochs": 0, "score": None, "results": None,
+               "stopped_early": False} for i in range(len(experiments))]
+    print("ASHA rungs (epochs): {}".format(", ".join(str(epochs) for epochs in rungs)))
+
+    with SweepPool(experiments, functools.partial(_run_trial, run), load, workers=workers, threads=threads) as pool:
+        jobs = dict()
+        while True:
+            while len(jobs) < pool.workers:
+                job = scheduler.next_job()
+                if job is None:
+                    break
+                trial, rung = job
+                # the budget of a trial is limited by its own number of epochs
+                epochs = min(rungs[rung], experiments[trial].epochs)
+                evaluate = epochs == experiments[trial].epochs
+                pool.submit(trial, epochs=epochs, resume=trials[trial]["path"] or "", evaluate=evaluate)
+                jobs[trial] = (rung, epochs)
+                trials[trial]["status"] = "running"
+            if not jobs:
+                break
+            result = pool.get()
+            trial = result["index"]
+            rung, epochs = jobs.pop(trial)
+            summary = trials[trial]
+            if result["status"] == "done":
+                summary["path"] = result["results"]["path"]
+                summary["epochs"] = epochs
+                summary["score"] = best_score(read_validation_scores(summary["path"], metric), epochs,
+                                              lower_is_better=lower_is_better)
+                summary["results"] = result["results"]
+                summary["stopped_early"] = bool(result["results"].get("stopped_early"))
+                # a trial at the end of its epochs is finished, it is not promoted
+                if epochs == experiments[trial].epochs:
+                    summary["status"] = "completed"
+                elif summary["stopped_early"]:
+                    summary["status"] = "stopped"
+                    scheduler.report(trial, rung, summary["score"], final=True)
+                else:
+                    summary["status"] = "paused"
+                    scheduler.report(trial, rung, summary["score"])
+            else:
+                summary["status"] = "failed"
+            if on_result:
+                on_result(dict(result, rung=rung, epochs=epochs, score=summary["score"]))
+    for summary in trials:
+        if summary["status"] == "paused":
+            summary["status"] = "stopped"
+    return trials
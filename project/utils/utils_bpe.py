@@ -0,0 +1,263 @@
+"""
+This file contains the byte pair encoding (BPE) of words into subwords, see https://arxiv.org/abs/1508.07909.
+The merges are learned with a heap of the pair counts, after each merge only the counts of the pairs
+in the words containing the merged pair are updated, instead of counting all pairs again.
+The codes file is compatible with subword-nmt: a merge per line, the last symbol of a word ends with '</w>'.
+"""
+import heapq
+import itertools
+import os
+import re
+from collections import Counter, defaultdict
+
+from project.utils.utils_cache import StageCache, file_fingerprint, hash_key
+
+END_OF_WORD = "</w>"
+SEPARATOR = "@@"
+CODES_HEADER = "#version: 0.2"
+# name of the codes in the experiment directory
+BPE_CODES_FILE = "bpe.codes"
+
+
+def get_word_counts(paths, lower=True, max_lines=0):
+    """
+    :param paths: tokenized text files, the tokens are separated by spaces
+    :param lower: True to count the lowercased words
+    :param max_lines: number of lines read from the start of each file, 0 for all lines
+    :return: Counter of the words of all files
+    """
+    counts = Counter()
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in itertools.islice(f, max_lines or None):
+                counts.update((line.lower() if lower else line).split())
+    return counts
+
+
+def _merge_symbols(symbols, pair, merged):
+    """
+    :return: tuple of the symbols with all occurrences of the pair replaced by the merged symbol
+    """
+    result, i, last = [], 0, len(symbols) - 1
+    while i <= last:
+        if i < last and symbols[i] == pair[0] and symbols[i + 1] == pair[1]:
+            result.append(merged)
+            i += 2
+        else:
+            result.append(symbols[i])
+            i += 1
+    return tuple(result)
+
+
+def word_to_symbols(word):
+    return tuple(word[:-1]) + (word[-1] + END_OF_WORD,)
+
+
+def learn_bpe(word_counts, num_symbols, min_frequency=2):
+    """
+    Learns the merge operations from the word frequencies
+    :param word_counts: dictionary word -> frequency
+    :param num_symbols: maximum number of merges
+    :param min_frequency: stops when the most frequent pair occurs less often
+    :return: list of the merged pairs, in merge order
+    """
+    words = [(word_to_symbols(word), count) for word, count in word_counts.items() if word]
+    pair_counts = Counter()
+    # pair -> indices of the words containing it, may contain words that lost the pair
+    index = defaultdict(set)
+    for i, (symbols, count) in enumerate(words):
+        for pair in zip(symbols, symbols[1:]):
+            pair_counts[pair] += count
+            index[pair].add(i)
+    # entries whose count differs from pair_counts are outdated and skipped
+    heap = [(-count, pair) for pair, count in pair_counts.items()]
+    heapq.heapify(heap)
+
+    merges = []
+    while heap and len(merges) < num_symbols:
+        count, pair = heapq.heappop(heap)
+        count = -count
+        if pair_counts.get(pair) != count:
+            continue
+        if count < min_frequency:
+            break
+        merges.append(pair)
+        merged = pair[0] + pair[1]
+        changed = set()
+        for i in index.pop(pair):
+            symbols, freq = words[i]
+            new_symbols = _merge_symbols(symbols, pair, merged)
+            if len(new_symbols) == len(symbols):
+                continue
+            for old in zip(symbols, symbols[1:]):
+                pair_counts[old] -= freq
+                changed.add(old)
+            for new in zip(new_symbols, new_symbols[1:]):
+                pair_counts[new] += freq
+                index[new].add(i)
+                changed.add(new)
+            words[i] = (new_symbols, freq)
+        changed.discard(pair)
+        del pair_counts[pair]
+        for changed_pair in changed:
+            changed_count = pair_counts[changed_pair]
+            if changed_count > 0:
+                heapq.heappush(heap, (-changed_count, changed_pair))
+            else:
+                del pair_counts[changed_pair]
+                index.pop(changed_pair, None)
+    return merges
+
+
+class BPE(object):
+    """
+    Segments words with the learned merges. The segmentation of each word is cached,
+    a corpus is segmented with about one dictionary lookup per token.
+    Subwords followed by another subword of the same word end with the separator '@@'.
+    """
+
+    def __init__(self, merges, separator=SEPARATOR, cache_size=200000, vocabulary=None):
+        """
+        :param merges: list of pairs of symbols, in merge order
+        :param separator: suffix of the subwords continued by the next one
+        :param cache_size: maximum number of cached words, the cache is emptied when it is full
+        :param vocabulary: optional subwords of the training data, see set_vocabulary
+        """
+        self.merges = [tuple(pair) for pair in merges]
+        self.ranks = {pair: rank for rank, pair in enumerate(self.merges)}
+        # merged symbol -> the pair it was first merged from
+        self.parts = dict()
+        for pair in self.merges:
+            self.parts.setdefault(pair[0] + pair[1], pair)
+        self.separator = separator
+        self.cache_size = cache_size
+        self.cache = dict()
+        self.separator_regex = re.compile(re.escape(separator) + r"(?: |$)")
+        self.vocabulary = None
+        self.set_vocabulary(vocabulary)
+
+    def set_vocabulary(self, vocabulary):
+        """
+        Restricts the subwords to the given ones: the subwords of an unseen word that are not in the vocabulary,
+        e.g. intermediate merges, are split again into their parts. Only unseen characters stay unknown.
+        :param vocabulary: iterable of subwords, None to allow all subwords
+        """
+        self.vocabulary = set(vocabulary) if vocabulary is not None else None
+        self.cache = dict()
+
+    def __len__(self):
+        return len(self.merges)
+
+    def __getstate__(self):
+        # the cache is not sent to the tokenization workers
+        state = dict(self.__dict__)
+        state["cache"] = dict()
+        return state
+
+    def segment_word(self, word):
+        """
+        :return: list of the subwords of the word
+        """
+        segments = self.cache.get(word)
+        if segments is not None:
+            return segments
+        symbols = word_to_symbols(word)
+        ranks = self.ranks
+        while len(symbols) > 1:
+            pair = min(zip(symbols, symbols[1:]), key=lambda p: ranks.get(p, len(ranks)))
+            if pair not in ranks:
+                break
+            symbols = _merge_symbols(symbols, pair, pair[0] + pair[1])
+        if self.vocabulary is not None:
+            symbols = [part for i, symbol in enumerate(symbols)
+                       for part in self._split_unknown(symbol, i == len(symbols) - 1)]
+        segments = [symbol + self.separator for symbol in symbols[:-1]] + [symbols[-1][:-len(END_OF_WORD)]]
+        if len(self.cache) >= self.cache_size:
+            self.cache.clear()
+        self.cache[word] = segments
+        return segments
+
+    def get_vocabulary(self, words):
+        """
+        :param words: the training words
+        :return: set of their subwords and of their characters, as final and as continued subwords
+        """
+        characters = set(character for word in words for character in word)
+        subwords = set(subword for word in words for subword in self.segment_word(word))
+        return subwords | characters | set(character + self.separator for character in characters)
+
+    def _split_unknown(self, symbol, final):
+        subword = symbol[:-len(END_OF_WORD)] if final else symbol + self.separator
+        if subword in self.vocabulary or symbol not in self.parts:
+            return [symbol]
+        first, second = self.parts[symbol]
+        return self._split_unknown(first, False) + self._split_unknown(second, final)
+
+    def segment(self, tokens):
+        """
+        :param tokens: list of words
+        :return: list of subwords
+        """
+        segment_word = self.segment_word
+        return [subword for token in tokens if token for subword in segment_word(token)]
+
+    def decode(self, subwords):
+        """
+        :param subwords: list of subwords, e.g. a translation
+        :return: the text with the subwords of each word joined
+        """
+        return self.separator_regex.sub("", " ".join(subwords))
+
+    def save(self, path):
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(CODES_HEADER + "\n")
+            for first, second in self.merges:
+                f.write("{} {}\n".format(first, second))
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        merges = []
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("#version"):
+                    continue
+                pair = line.rstrip("\n").split(" ")
+                if len(pair) == 2:
+                    merges.append(tuple(pair))
+        return cls(merges, **kwargs)
+
+
+def bpe_codes_path(data_dir, num_symbols):
+    return os.path.join(data_dir, "bpe.{}.codes".format(num_symbols))
+
+
+def get_joint_bpe(data_dir, file_names, num_symbols, min_frequency=2, lower=True, max_lines=0):
+    """
+    Loads the joint BPE of the given files from the cache of the data directory, the merges are learned if missing.
+    The codes are cached by the content of the files and the parameters, see StageCache.
+    The subwords are restricted to the ones of the training words, so the segmented words are in the vocabulary.
+    :param data_dir: directory of the files, the codes are stored in its cache as bpe.<num_symbols>.codes
+    :param file_names: the training files of both languages
+    :param num_symbols: number of merges
+    :param min_frequency: minimum frequency of a merged pair
+    :param lower: True to learn the merges on lowercased text
+    :param max_lines: number of training lines of each file, e.g. the ones the model is trained on, 0 for all lines
+    :return: the BPE and the path of its codes
+    """
+    paths = [os.path.join(data_dir, name) for name in file_names]
+    cache = StageCache(os.path.join(data_dir, "cache"))
+    key = hash_key("bpe", [file_fingerprint(path) for path in paths], num_symbols, min_frequency, lower, max_lines)
+    path = bpe_codes_path(cache.path("bpe", key), num_symbols)
+    counts = get_word_counts(paths, lower=lower, max_lines=max_lines)
+    if cache.is_done("bpe", key):
+        print("Loading BPE codes from {}".format(path))
+        bpe = BPE.from_file(path)
+    else:
+        print("Learning {} BPE merges from {}...".format(num_symbols, ", ".join(file_names)))
+        bpe = BPE(learn_bpe(counts, num_symbols, min_frequency=min_frequency))
+        bpe.save(path)
+        cache.mark_done("bpe", key, {"files": file_names, "merges": len(bpe), "max_lines": max_lines})
+        print("BPE codes stored in {}".format(path))
+    bpe.set_vocabulary(bpe.get_vocabulary(counts))
+    return bpe, path
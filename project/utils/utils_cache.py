@@ -0,0 +1,129 @@
+"""
+This file contains the content-addressed cache of the preprocessing stages.
+The output of a stage is stored under a key hashing its inputs and parameters,
+so a rerun only recomputes the stages whose inputs or parameters changed.
+"""
+import hashlib
+import json
+import os
+
+from project.utils.utils_retrieve_corpora import read_checksum
+
+# change it when the output of a stage changes for the same inputs
+CACHE_VERSION = 1
+
+
+def hash_key(*parts):
+    """
+    :param parts: JSON serializable inputs and parameters
+    :return: hex digest identifying them
+    """
+    data = json.dumps([CACHE_VERSION] + list(parts), sort_keys=True, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def file_fingerprint(path, chunk_size=1 << 20):
+    """
+    :return: the SHA-256 of the file, the one stored by the downloader if available
+    """
+    checksum = read_checksum(path)
+    if checksum is not None:
+        return checksum
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class StageCache(object):
+    """
+    Stores the outputs of each stage in <root>/<stage>/<key>/.
+    An entry is complete once its manifest is written, interrupted stages are recomputed.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, stage, key):
+        """
+        :return: the directory of the entry, created if missing
+        """
+        path = os.path.join(self.root, stage, key)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def _manifest(self, stage, key):
+        return os.path.join(self.root, stage, key, "manifest.json")
+
+    def is_done(self, stage, key):
+        return os.path.isfile(self._manifest(stage, key))
+
+    def mark_done(self, stage, key, info=None):
+        """
+        Completes the entry
+        :param info: dictionary stored in the manifest, e.g. the stage parameters or counts
+        """
+        path = self._manifest(stage, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(dict(info or {}, stage=stage, key=key), f)
+        os.replace(path + ".tmp", path)
+
+    def get_info(self, stage, key):
+        with open(self._manifest(stage, key), encoding="utf-8") as f:
+            return json.load(f)
+
+
+class TokenizationCache(object):
+    """
+    Caches tokenized chunks by the hash of their raw lines and the tokenizers.
+    The chunks of a corpus with appended lines are unchanged, only the new lines are tokenized.
+    """
+
+    def __init__(self, cache, signature):
+        """
+        :param cache: the StageCache
+        :param signature: identifies the tokenizers, see tokenizer_signature
+        """
+        self.cache = cache
+        self.signature = signature
+        self.hits, self.misses = 0, 0
+
+    def key(self, columns):
+        hasher = hashlib.sha256(hash_key("tokenize", self.signature).encode("utf-8"))
+        for column in columns:
+            hasher.update("\n".join(column).encode("utf-8"))
+            hasher.update(b"\0")
+        return hasher.hexdigest()
+
+    def contains(self, key):
+        """
+        :return: True if the chunk is cached, the hits and misses are counted
+        """
+        if self.cache.is_done("tokenize", key):
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def load(self, key):
+        """
+        :return: the tokenized columns of the chunk, None if not cached
+        """
+        if not self.cache.is_done("tokenize", key):
+            return None
+        path = self.cache.path("tokenize", key)
+        columns, index = [], 0
+        while os.path.isfile(os.path.join(path, str(index))):
+            with open(os.path.join(path, str(index)), encoding="utf-8") as f:
+                columns.append(f.read().split("\n")[:-1])
+            index += 1
+        return columns
+
+    def store(self, key, columns):
+        path = self.cache.path("tokenize", key)
+        for index, column in enumerate(columns):
+            with open(os.path.join(path, str(index)), "w", encoding="utf-8") as f:
+                f.write("".join("{}\n".format(line) for line in column))
+        self.cache.mark_done("tokenize", key, {"lines": len(columns[0]) if columns else 0})
@@ -0,0 +1,167 @@
+"""
+This file contains utilities to save and restore resumable training checkpoints.
+A checkpoint contains the model, optimizer and scheduler states, the random states,
+the position of the training iterator and the counters of the training loop.
+"""
+import os
+import queue
+import random
+import threading
+
+import numpy as np
+import torch
+
+CHECKPOINT_PREFIX = "checkpoint_"
+CHECKPOINT_EXT = ".pkl"
+
+
+class CheckpointSaver(object):
+    """
+    Writes checkpoints from a background thread.
+    Each file is written to a temporary file and renamed, so a checkpoint is either complete or missing.
+    Only the last 'keep' checkpoints are kept in the directory.
+    """
+
+    def __init__(self, path, keep=2):
+        """
+        :param path: the experiment directory
+        :param keep: number of checkpoints to keep
+        """
+        self.path = path
+        self.keep = keep
+        self.error = None
+        self.queue = queue.Queue()
+        # set while no checkpoint is being written
+        self.idle = threading.Event()
+        self.idle.set()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def save(self, state, step):
+        """
+        Queues the given state for saving. The tensors are copied before returning,
+        so training can go on while the checkpoint is written.
+        Blocks until the previous checkpoint is written, so at most one copy of the state is held in memory.
+        :param state: the checkpoint dictionary
+        :param step: the training step, used in the file name
+        """
+        self.idle.wait()
+        self._check()
+        self.idle.clear()
+        self.queue.put((copy_to_cpu(state), step))
+
+    def close(self):
+        """
+        Waits for the pending checkpoint and stops the thread
+        """
+        self.queue.put(None)
+        self.thread.join()
+        self._check()
+
+    def _check(self):
+        if self.error:
+            raise RuntimeError("Checkpoint could not be saved: {}".format(self.error))
+
+    def _run(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                break
+            state, step = task
+            try:
+                file = os.path.join(self.path, "{}{:09d}{}".format(CHECKPOINT_PREFIX, step, CHECKPOINT_EXT))
+                tmp_file = file + ".tmp"
+                torch.save(state, tmp_file)
+                os.replace(tmp_file, file)
+                for old_file in list_checkpoints(self.path)[:-self.keep]:
+                    os.remove(old_file)
+            except Exception as e:
+                self.error = e
+            finally:
+                # the written state is released before the next one is copied
+                del task, state
+                self.idle.set()
+
+
+def list_checkpoints(path):
+    """
+    Lists the checkpoints in the given directory, from the oldest to the latest
+    :param path: the experiment directory
+    :return: list of paths
+    """
+    files = [f for f in os.listdir(path) if f.startswith(CHECKPOINT_PREFIX) and f.endswith(CHECKPOINT_EXT)]
+    return [os.path.join(path, f) for f in sorted(files)]
+
+
+def load_latest_checkpoint(path, device="cpu"):
+    """
+    Loads the latest checkpoint
+    :param path: the experiment directory or the path to a checkpoint file
+    :param device: the device to map the tensors to
+    :return: the checkpoint dictionary or None, if no checkpoint was found
+    """
+    if os.path.isdir(path):
+        checkpoints = list_checkpoints(path)
+        if not checkpoints:
+            return None
+        path = checkpoints[-1]
+    print("Loading checkpoint: {}".format(path))
+    return torch.load(path, map_location=device)
+
+
+def copy_to_cpu(obj):
+    """
+    Recursively copies the tensors of the given object to the CPU
+    :param obj: a tensor or a (nested) dictionary, list or tuple
+    :return: the copy
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().cpu().clone()
+    if isinstance(obj, dict):
+        return type(obj)((k, copy_to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(copy_to_cpu(v) for v in obj)
+    return obj
+
+
+def get_rng_state():
+    """
+    Collects the random states of python, numpy and torch.
+    Numpy arrays are stored as lists, so the state can be loaded with weights_only=True.
+    """
+    np_state = np.random.get_state()
+    state = {"python": random.getstate(),
+             "numpy": (np_state[0], np_state[1].tolist()) + tuple(np_state[2:]),
+             "torch": torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    """
+    Restores the random states collected by get_rng_state
+    """
+    python_state = state["python"]
+    random.setstate((python_state[0], tuple(python_state[1]), python_state[2]))
+    np_state = state["numpy"]
+    np.random.set_state((np_state[0], np.array(np_state[1], dtype=np.uint32)) + tuple(np_state[2:]))
+    torch.set_rng_state(state["torch"].cpu())
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([s.cpu() for s in state["cuda"]])
+
+
+def get_iterator_state(data_iter, end_of_epoch=False):
+    """
+    Returns the position of the torchtext iterator
+    :param data_iter: the iterator
+    :param end_of_epoch: True at the end of an epoch, the state then refers to the beginning of the next epoch
+    :return: the state dictionary, to be restored with data_iter.load_state_dict
+    """
+    if getattr(data_iter, "streaming", False):
+        # the streamed mix of corpora keeps its own position, see utils_mixing.MixedBucketIterator
+        return data_iter.state_dict(end_of_epoch=end_of_epoch)
+    if end_of_epoch:
+        return {"iterations": 0, "iterations_this_epoch": 0,
+                "random_state_this_epoch": data_iter.random_shuffler.random_state}
+    return data_iter.state_dict()
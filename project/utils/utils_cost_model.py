@@ -0,0 +1,182 @@
+"""
+This file contains an analytical cost model of the Seq2Seq model.
+It estimates parameters, memory and FLOPs of an experiment configuration without loading any data,
+and predicts the training throughput from the FLOP rate measured on this host with a short microbenchmark.
+"""
+import time
+from argparse import Namespace
+
+import torch
+import torch.nn as nn
+
+from project.model.models import get_nmt_model
+from project.utils.experiment import Experiment
+
+BYTES_PER_FLOAT = 4
+# weights, gradients and the two Adam moments
+OPTIMIZER_COPIES = 4
+# the backward pass costs about twice the forward pass
+TRAIN_FLOPS_FACTOR = 3
+SPECIAL_TOKENS = 4  # <sos>, <eos>, <pad>, <unk>
+DEFAULT_VOCAB_SIZE = 30000
+
+
+def _rnn_layers(input_size, hidden_size, num_layers, directions):
+    """
+    :return: list of input sizes of the RNN layers, one per layer and direction
+    """
+    return [input_size if layer == 0 else hidden_size * directions
+            for layer in range(num_layers) for _ in range(directions)]
+
+
+def _gates(rnn_type):
+    return 4 if rnn_type.lower() == "lstm" else 3
+
+
+def get_vocab_sizes(experiment):
+    """
+    The vocabulary size is limited by --v, the exact size is only known after loading the data
+    :return: source and target vocabulary sizes
+    """
+    if experiment.src_vocab_size and experiment.trg_vocab_size:
+        return experiment.src_vocab_size, experiment.trg_vocab_size
+    size = (experiment.voc_limit if experiment.voc_limit > 0 else DEFAULT_VOCAB_SIZE) + SPECIAL_TOKENS
+    return size, size
+
+
+def estimate_cost(experiment, src_vocab_size, trg_vocab_size, src_len, trg_len, batch_size):
+    """
+    Estimates parameters, FLOPs and training memory of the model described by the experiment
+    :param experiment: the Experiment
+    :param src_vocab_size: source vocabulary size
+    :param trg_vocab_size: target vocabulary size
+    :param src_len: source sequence length
+    :param trg_len: target sequence length, including <sos>
+    :param batch_size: the batch size
+    :return: dictionary with the estimates
+    """
+    E, H = experiment.emb_size, experiment.hid_dim
+    G = _gates(experiment.rnn_type)
+    enc_directions = 2 if experiment.bi else 1
+    dec_layers = experiment.nlayers * enc_directions
+    attention = experiment.attn != "none"
+    pre_in = 2 * H if attention else H
+
+    encoder_layers = _rnn_layers(E, H, experiment.nlayers, enc_directions)
+    decoder_layers = _rnn_layers(E, H, dec_layers, 1)
+    # PyTorch RNNs have an input and a hidden bias
+    rnn_params = lambda layers: sum(G * H * (n_in + H) + 2 * G * H for n_in in layers)
+    params = {"encoder.embedding": src_vocab_size * E, "encoder.rnn": rnn_params(encoder_layers),
+              "decoder.embedding": trg_vocab_size * E, "decoder.rnn": rnn_params(decoder_layers),
+              "preoutput": pre_in * E + E, "output": E * trg_vocab_size + trg_vocab_size}
+    if experiment.tied:
+        # the output layer shares the weight of the decoder embedding
+        params["output"] -= E * trg_vocab_size
+    total_params = sum(params.values())
+
+    # forward FLOPs of one sentence pair, a multiply-add counts as 2
+    rnn_flops = lambda layers: sum(2 * G * H * (n_in + H) for n_in in layers)
+    flops = {"encoder.rnn": src_len * rnn_flops(encoder_layers),
+             "decoder.rnn": trg_len * rnn_flops(decoder_layers),
+             "attention": 4 * src_len * trg_len * H if attention else 0,
+             "preoutput": trg_len * 2 * pre_in * E,
+             "output": trg_len * 2 * E * trg_vocab_size}
+    forward_flops = sum(flops.values())
+    train_flops_per_token = TRAIN_FLOPS_FACTOR * forward_flops / trg_len
+
+    # activations kept for the backward pass, per sentence pair
+    activations = (src_len + trg_len) * E \
+                  + src_len * len(encoder_layers) * (G + 2) * H \
+                  + trg_len * len(decoder_layers) * (G + 2) * H \
+                  + (2 * src_len * trg_len + trg_len * H if attention else 0) \
+                  + trg_len * (pre_in + 3 * E) \
+                  + 3 * trg_len * trg_vocab_size  # logits, log-softmax and their gradient
+    activation_bytes = activations * batch_size * BYTES_PER_FLOAT
+    parameter_bytes = total_params * BYTES_PER_FLOAT * OPTIMIZER_COPIES
+
+    return {"params": total_params, "params_by_module": params,
+            "forward_flops_by_module": flops, "train_flops_per_token": train_flops_per_token,
+            "activation_bytes": activation_bytes, "parameter_bytes": parameter_bytes,
+            "train_memory_bytes": activation_bytes + parameter_bytes}
+
+
+def calibrate(device="cpu", steps=3, hid_dim=256, emb_size=256, vocab_size=10000, batch_size=32, seq_len=20):
+    """
+    Measures the FLOP rate of training steps of a small reference model on random data
+    :return: achieved training FLOPs per second
+    """
+    args = Namespace(epochs=1, b=batch_size, v=vocab_size, corpus="", lang_code="de", reverse=True, min=1,
+                     tied=False, attn="dot", bi=True, reverse_input=False, max_len=seq_len, data_dir=None,
+                     cuda=torch.device(device).type == "cuda", lr=1e-3, train=0, val=0, test=0, hs=hid_dim,
+                     emb=emb_size, rnn="lstm", num_layers=1, dp=0., tok="", beam=1)
+    experiment = Experiment(args)
+    experiment.model_type = "custom"
+    experiment.src_vocab_size = experiment.trg_vocab_size = vocab_size
+    model = get_nmt_model(experiment, [0, 1, 2, 3]).to(device)
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+    criterion = nn.CrossEntropyLoss()
+    src = torch.randint(4, vocab_size, (seq_len, batch_size), device=device)
+    trg = torch.randint(4, vocab_size, (seq_len + 1, batch_size), device=device)
+
+    def step():
+        optimizer.zero_grad()
+        scores = model(src, trg)[:-1]
+        criterion(scores.reshape(-1, scores.size(2)), trg[1:].reshape(-1)).backward()
+        optimizer.step()
+
+    step()  # warmup
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(steps):
+        step()
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize()
+    elapsed = (time.perf_counter() - start) / steps
+    cost = estimate_cost(experiment, vocab_size, vocab_size, seq_len, seq_len + 1, batch_size)
+    return cost["train_flops_per_token"] * (seq_len + 1) * batch_size / elapsed
+
+
+def plan_experiment(experiment, flops_per_second=None, avg_len=None):
+    """
+    Estimates cost and throughput of the experiment, the sequence length is the truncation length
+    :param experiment: the Experiment
+    :param flops_per_second: the calibrated FLOP rate, measured if not given
+    :param avg_len: average sentence length for the throughput, default 2/3 of the truncation length
+    :return: dictionary with the estimates
+    """
+    src_vocab_size, trg_vocab_size = get_vocab_sizes(experiment)
+    max_len = experiment.truncate
+    avg_len = avg_len or max(1, int(round(max_len * 2 / 3)))
+    # memory peaks at the longest batch, <sos> is prepended and <eos> appended to the target
+    cost = estimate_cost(experiment, src_vocab_size, trg_vocab_size, max_len, max_len + 2, experiment.batch_size)
+    average = estimate_cost(experiment, src_vocab_size, trg_vocab_size, avg_len, avg_len + 2,
+                            experiment.batch_size)
+    if flops_per_second is None:
+        flops_per_second = calibrate(experiment.get_device())
+    tokens_per_sec = flops_per_second / average["train_flops_per_token"]
+    plan = dict(cost, src_vocab_size=src_vocab_size, trg_vocab_size=trg_vocab_size, max_len=max_len,
+                avg_len=avg_len, train_flops_per_token=average["train_flops_per_token"],
+                calibrated_flops_per_second=flops_per_second, tokens_per_sec=tokens_per_sec)
+    if experiment.train_samples > 0:
+        # target tokens including <eos>
+        epoch_time = experiment.train_samples * (avg_len + 1) / tokens_per_sec
+        plan.update({"epoch_time": epoch_time, "total_time": epoch_time * experiment.epochs})
+    return plan
+
+
+def format_plan(plan):
+    mb = lambda value: "{:,.1f} MB".format(value / 2 ** 20)
+    lines = ["Vocabulary (src/trg): {:,} / {:,} | Sequence length: max {}, avg {}".format(
+        plan["src_vocab_size"], plan["trg_vocab_size"], plan["max_len"], plan["avg_len"]),
+        "Parameters: {:,} ({})".format(plan["params"], ", ".join(
+            "{}: {:,}".format(name, value) for name, value in plan["params_by_module"].items())),
+        "Training memory: {} (parameters, gradients and Adam: {}, activations: {})".format(
+            mb(plan["train_memory_bytes"]), mb(plan["parameter_bytes"]), mb(plan["activation_bytes"])),
+        "Training FLOPs per target token: {:,.0f}".format(plan["train_flops_per_token"]),
+        "Calibrated FLOP rate: {:.2f} GFLOP/s | Expected throughput: {:,.0f} tokens/s".format(
+            plan["calibrated_flops_per_second"] / 1e9, plan["tokens_per_sec"])]
+    if "epoch_time" in plan:
+        lines.append("Expected time: {:.1f} min per epoch, {:.1f} h in total".format(
+            plan["epoch_time"] / 60, plan["total_time"] / 3600))
+    return "\n".join(lines)
@@ -0,0 +1,151 @@
+"""
+This file contains the deduplication of parallel corpora.
+Exact duplicates are found by hashing the sentence pairs, near-duplicates with MinHash signatures
+of the token shingles and locality-sensitive hashing (LSH): pairs sharing a band of their signature
+are candidates, a candidate is removed if the estimated Jaccard similarity reaches the threshold.
+The first occurrence of a pair is kept.
+"""
+import hashlib
+import os
+import zlib
+
+import numpy as np
+
+from project.utils.utils_functions import ordered_pool_map
+
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+NUM_PERM = 64
+BANDS = 16  # the rows per band are NUM_PERM // BANDS
+SHINGLE_SIZE = 2
+
+
+def pair_digest(src, trg):
+    """
+    :return: 64 bit hash of the sentence pair
+    """
+    return int.from_bytes(hashlib.blake2b("{}\t{}".format(src, trg).encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def get_permutations(num_perm=NUM_PERM, seed=1):
+    """
+    :return: the parameters a and b of the hash functions (a * x + b) % prime
+    """
+    generator = np.random.RandomState(seed)
+    a = generator.randint(1, int(MERSENNE_PRIME), size=num_perm, dtype=np.uint64)
+    b = generator.randint(0, int(MERSENNE_PRIME), size=num_perm, dtype=np.uint64)
+    return a, b
+
+
+def shingles(src, trg, size=SHINGLE_SIZE):
+    """
+    :return: set of the lowercased token n-grams of both sides, the side is part of the shingle
+    """
+    result = set()
+    for side, sentence in (("s", src), ("t", trg)):
+        tokens = sentence.lower().split(" ")
+        if len(tokens) < size:
+            result.add("{}:{}".format(side, " ".join(tokens)))
+        for i in range(len(tokens) - size + 1):
+            result.add("{}:{}".format(side, " ".join(tokens[i:i + size])))
+    return result
+
+
+def minhash(shingle_set, a, b):
+    """
+    :return: the MinHash signature of the shingles as uint32 array
+    """
+    hashes = np.fromiter((zlib.crc32(shingle.encode("utf-8")) for shingle in shingle_set), dtype=np.uint64,
+                         count=len(shingle_set))
+    values = (hashes[:, None] * a + b) % MERSENNE_PRIME & MAX_HASH
+    return values.min(axis=0).astype(np.uint32)
+
+
+def band_keys(signatures, bands=BANDS):
+    """
+    :param signatures: array (pairs, num_perm)
+    :return: array (pairs, bands) with a 64 bit hash of each band
+    """
+    rows = signatures.reshape(signatures.shape[0], bands, -1).astype(np.uint64)
+    keys = np.zeros(rows.shape[:2], dtype=np.uint64)
+    for r in range(rows.shape[2]):
+        # polynomial hash, the multiplication wraps around
+        keys = keys * np.uint64(1000003) + rows[:, :, r]
+    return keys
+
+
+def _signature_chunk(args):
+    pairs, num_perm, bands, shingle_size, near = args
+    digests = np.array([pair_digest(src, trg) for src, trg in pairs], dtype=np.uint64)
+    if not near:
+        return digests, None, None
+    a, b = get_permutations(num_perm)
+    signatures = np.stack([minhash(shingles(src, trg, shingle_size), a, b) for src, trg in pairs])
+    return digests, signatures, band_keys(signatures, bands)
+
+
+def find_duplicates(chunks, path, threshold=0.7, num_perm=NUM_PERM, bands=BANDS, shingle_size=SHINGLE_SIZE,
+                    workers=1):
+    """
+    Finds the duplicates of a stream of sentence pairs in two passes:
+    the hashes and signatures are computed chunk by chunk in a process pool and stored in files,
+    then the duplicates are found with numpy, the memory grows by a few bytes per pair only.
+    :param chunks: iterable of lists of (source, target) pairs
+    :param path: directory of the temporary signature files
+    :param threshold: minimum estimated Jaccard similarity of near-duplicates, 0 to only remove exact duplicates
+    :param num_perm: number of MinHash permutations
+    :param bands: number of LSH bands, num_perm must be a multiple
+    :param shingle_size: number of tokens of a shingle
+    :param workers: number of processes
+    :return: boolean array, True for the pairs to keep, and dictionary with the number of exact and near duplicates
+    """
+    assert num_perm % bands == 0, "The number of permutations must be a multiple of the bands"
+    near = threshold > 0
+    items = ((chunk, num_perm, bands, shingle_size, near) for chunk in chunks)
+    results = ordered_pool_map(_signature_chunk, items, workers) if workers > 1 else map(_signature_chunk, items)
+    digest_list = []
+    signature_path, band_path = os.path.join(path, "signatures.bin"), os.path.join(path, "bands.bin")
+    with open(signature_path, "wb") as signature_file, open(band_path, "wb") as band_file:
+        for digests, signatures, keys in results:
+            digest_list.append(digests)
+            if near:
+                signature_file.write(signatures.tobytes())
+                band_file.write(keys.tobytes())
+    digests = np.concatenate(digest_list) if digest_list else np.zeros(0, dtype=np.uint64)
+    num_pairs = len(digests)
+
+    # exact duplicates: all but the first occurrence of each hash
+    keep = np.zeros(num_pairs, dtype=bool)
+    keep[np.unique(digests, return_index=True)[1]] = True
+    stats = {"pairs": num_pairs, "exact": int(num_pairs - keep.sum()), "near": 0}
+
+    if near and num_pairs:
+        signatures = np.memmap(signature_path, dtype=np.uint32, mode="r", shape=(num_pairs, num_perm))
+        keys = np.memmap(band_path, dtype=np.uint64, mode="r", shape=(num_pairs, bands))
+        for band in range(bands):
+            candidates = np.flatnonzero(keep)
+            column = keys[candidates, band]
+            order = np.argsort(column, kind="stable")
+            sorted_keys, sorted_pairs = column[order], candidates[order]
+            # each pair is compared with the first pair of its bucket
+            starts = np.r_[0, np.flatnonzero(sorted_keys[1:] != sorted_keys[:-1]) + 1]
+            first = sorted_pairs[starts[np.searchsorted(starts, np.arange(len(order)), side="right") - 1]]
+            others = np.flatnonzero(first != sorted_pairs)
+            if len(others) == 0:
+                continue
+            pairs, firsts = sorted_pairs[others], first[others]
+            similarity = (np.asarray(signatures[pairs]) == np.asarray(signatures[firsts])).mean(axis=1)
+            duplicates = pairs[similarity >= threshold]
+            keep[duplicates] = False
+            stats["near"] += len(duplicates)
+        del signatures, keys
+    os.remove(signature_path)
+    os.remove(band_path)
+    stats["kept"] = int(keep.sum())
+    return keep, stats
+
+
+def format_dedup_stats(stats):
+    removed = stats["pairs"] - stats["kept"]
+    return "Deduplication: {:,} > {:,} pairs, removed {:,} ({:.2%}): {:,} exact and {:,} near duplicates".format(
+        stats["pairs"], stats["kept"], removed, removed / max(1, stats["pairs"]), stats["exact"], stats["near"])
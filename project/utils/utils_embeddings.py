@@ -0,0 +1,146 @@
+"""
+This file contains the initialization of the embeddings with pretrained word vectors, e.g. fastText.
+The .vec.gz file is streamed once per vocabulary, only the rows of the vocabulary are kept.
+The extracted matrix is cached as .npy file, later runs load it memory-mapped.
+"""
+import gzip
+import os
+
+import numpy as np
+import torch
+
+from project.utils.utils_bpe import SEPARATOR
+from project.utils.utils_cache import StageCache, hash_key
+from project.utils.utils_parsers import LanguageModelConfigParser
+from project.utils.utils_retrieve_corpora import download_file
+from settings import DATA_DIR_RAW, SEED
+
+EMBEDDINGS_DIR = os.path.join(DATA_DIR_RAW, "embeddings")
+
+
+def get_embedding_url(embedding, lang_code):
+    """
+    :param embedding: name of the embeddings section in config/lm.cfg, e.g. fasttext
+    :return: the url of the vectors of the language
+    """
+    url = LanguageModelConfigParser().get_pretrained_embedding_url(embedding, lang_code)
+    if not url.startswith("http"):
+        raise ValueError(url)
+    return url
+
+
+def download_vectors(url, path=EMBEDDINGS_DIR):
+    """
+    Downloads the vectors file, an existing download is reused or resumed
+    :return: the path of the file
+    """
+    os.makedirs(path, exist_ok=True)
+    destination = os.path.join(path, url.split("/")[-1])
+    download_file(url, destination)
+    return destination
+
+
+def open_vectors(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", errors="replace")
+    return open(path, encoding="utf-8", errors="replace")
+
+
+def lookup_key(token, lower=True):
+    """
+    :return: the word of the vectors file for the token, a BPE subword is looked up without separator
+    """
+    if token.endswith(SEPARATOR) and len(token) > len(SEPARATOR):
+        token = token[:-len(SEPARATOR)]
+    return token.lower() if lower else token
+
+
+def extract_vectors(path, itos, lower=True):
+    """
+    Streams the vectors file and keeps the vectors of the vocabulary.
+    The file is sorted by frequency, a token gets the vector of its most frequent spelling.
+    :param path: .vec or .vec.gz file, the first line holds the number of words and the dimension
+    :param itos: the vocabulary, list of tokens
+    :param lower: True for a lowercased vocabulary
+    :return: float32 matrix (len(itos), dimension) and boolean array, True for the rows found in the file
+    """
+    rows = dict()
+    for index, token in enumerate(itos):
+        rows.setdefault(lookup_key(token, lower), []).append(index)
+    with open_vectors(path) as f:
+        dim = int(f.readline().split()[1])
+        vectors = np.zeros((len(itos), dim), dtype=np.float32)
+        found = np.zeros(len(itos), dtype=bool)
+        missing = len(rows)
+        for line in f:
+            word, _, values = line.partition(" ")
+            if lower:
+                word = word.lower()
+            indices = rows.pop(word, None)
+            if indices is None:
+                continue
+            # only the lines of the vocabulary are parsed
+            vectors[indices] = np.array(values.split(), dtype=np.float32)
+            found[indices] = True
+            missing -= 1
+            if missing == 0:
+                break
+    # the missing rows are initialized at the scale of the pretrained vectors
+    std = vectors[found].std() if found.any() else 1.0
+    generator = np.random.RandomState(SEED)
+    vectors[~found] = generator.normal(0, std, size=(int((~found).sum()), dim))
+    return vectors, found
+
+
+def load_pretrained_vectors(itos, url, path=EMBEDDINGS_DIR, lower=True):
+    """
+    Extracts the vectors of the vocabulary, or loads them from the cache.
+    The vectors file is only downloaded and read if the vocabulary is not cached.
+    :param itos: the vocabulary, list of tokens
+    :param url: url of the vectors file
+    :param path: directory of the vectors files and of the cache, see StageCache
+    :return: memory-mapped float32 matrix (len(itos), dimension) and the cache info with the coverage
+    """
+    cache = StageCache(os.path.join(path, "cache"))
+    file_name = url.split("/")[-1]
+    key = hash_key("embeddings", file_name, lower, list(itos))
+    matrix_path = os.path.join(cache.path("embeddings", key), "vectors.npy")
+    if not cache.is_done("embeddings", key):
+        vectors, found = extract_vectors(download_vectors(url, path), itos, lower=lower)
+        np.save(matrix_path, vectors)
+        cache.mark_done("embeddings", key, {"vectors": file_name, "size": len(itos), "found": int(found.sum())})
+    return np.load(matrix_path, mmap_mode="r"), cache.get_info("embeddings", key)
+
+
+def init_embedding(embedding, vectors, freeze=False):
+    """
+    Copies the vectors into the embedding layer
+    :param embedding: nn.Embedding, e.g. Encoder.embedding
+    :param vectors: matrix (vocabulary size, embedding size)
+    :param freeze: True to keep the vectors fixed during training
+    """
+    if tuple(vectors.shape) != tuple(embedding.weight.shape):
+        raise ValueError("Pretrained vectors of shape {} do not fit the embedding of shape {}. "
+                         "Set the embedding size to {}.".format(tuple(vectors.shape), tuple(embedding.weight.shape),
+                                                               vectors.shape[1]))
+    with torch.no_grad():
+        embedding.weight.copy_(torch.from_numpy(np.array(vectors)))
+    embedding.weight.requires_grad = not freeze
+
+
+def init_pretrained_embeddings(model, SRC, TRG, src_lang, trg_lang, embedding="fasttext", freeze=False, logger=None):
+    """
+    Initializes the encoder and decoder embeddings of the model with the pretrained vectors of each language
+    :return: dictionary with the share of the vocabulary found in the vectors, per side
+    """
+    coverage = dict()
+    for side, field, lang, layer in (("src", SRC, src_lang, model.encoder.embedding),
+                                     ("trg", TRG, trg_lang, model.decoder.embedding)):
+        vectors, info = load_pretrained_vectors(field.vocab.itos, get_embedding_url(embedding, lang))
+        init_embedding(layer, vectors, freeze=freeze)
+        coverage[side] = info["found"] / max(1, info["size"])
+        if logger:
+            logger.log("{} embeddings initialized from {}: {:,} of {:,} tokens found ({:.2%}){}".format(
+                side.upper(), info["vectors"], info["found"], info["size"], coverage[side],
+                ", frozen" if freeze else ""))
+    return coverage
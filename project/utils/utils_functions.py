@@ -1,5 +1,7 @@
 import argparse
+import multiprocessing
 import time
+from collections import deque
 
 import torch
 import numpy as np
@@ -15,6 +17,22 @@ def convert_time_unit(seconds):
     return time.strftime("%H:%M:%S", time.gmtime(seconds))
 
 
+def ordered_pool_map(func, items, workers, initializer=None, initargs=()):
+    """
+    Applies the function to the items in a process pool. At most 2 items per worker are in flight,
+    so the items can be a stream of any size.
+    :return: generator of the results, in the input order
+    """
+    with multiprocessing.Pool(workers, initializer=initializer, initargs=initargs) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.apply_async(func, (item,)))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
 def str2number(param):
     try:
         number = int(param)
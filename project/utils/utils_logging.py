@@ -1,21 +1,88 @@
+import atexit
+import json
 import os
+import threading
+import time
 
 import dill
 import numpy as np
 import torch
 
+FLUSH_INTERVAL = 2.0  # seconds
+
+
+class BufferedFileWriter(object):
+    """
+    Appends text to a file through an in-memory buffer.
+    All writers are flushed by a shared background thread every FLUSH_INTERVAL seconds and at exit.
+    """
+    _writers = []
+    _lock = threading.Lock()
+    _thread = None
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.buffer = []
+        self.buffer_lock = threading.Lock()
+        with BufferedFileWriter._lock:
+            BufferedFileWriter._writers.append(self)
+            if BufferedFileWriter._thread is None:
+                BufferedFileWriter._thread = threading.Thread(target=BufferedFileWriter._run, daemon=True)
+                BufferedFileWriter._thread.start()
+                atexit.register(BufferedFileWriter.flush_all)
+
+    def write(self, text):
+        with self.buffer_lock:
+            self.buffer.append(text)
+
+    def flush(self):
+        with self.buffer_lock:
+            if not self.buffer:
+                return
+            text, self.buffer = "".join(self.buffer), []
+            with open(self.file_path, "a", encoding="utf8") as f:
+                f.write(text)
+
+    def close(self):
+        self.flush()
+        with BufferedFileWriter._lock:
+            if self in BufferedFileWriter._writers:
+                BufferedFileWriter._writers.remove(self)
+
+    @staticmethod
+    def flush_all():
+        with BufferedFileWriter._lock:
+            writers = list(BufferedFileWriter._writers)
+        for writer in writers:
+            writer.flush()
+
+    @staticmethod
+    def _run():
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            BufferedFileWriter.flush_all()
+
 
 class Logger():
     """
     The Logger objects logs information, pickles experiment objects and the model
     """
 
-    def __init__(self, path, file_name="log.log"):
+    def __init__(self, path, file_name="log.log", buffered=False):
+        """
+        :param path: the directory of the log file
+        :param file_name: the log file name
+        :param buffered: True to write the log in the background, see BufferedFileWriter.
+        Use it for loggers called in loops, e.g. translations or tokenized lines.
+        """
         if os.path.exists(path):
             self.path = path
             self.file_name = file_name
         else:
             raise Exception('path does not exist')
+        self.buffered = buffered
+        self.writer = BufferedFileWriter(os.path.join(path, file_name)) if buffered else None
+        self.metrics_writers = dict()
 
     def log(self, info, stdout=True):
         """
@@ -23,11 +90,47 @@ class Logger():
         :param info: The info to log
         :param stdout: True if info should be displayed
         """
-        with open(os.path.join(self.path, self.file_name), "a", encoding="utf8") as f:
-            print(info, file=f)
+        if self.writer:
+            self.writer.write("{}\n".format(info))
+        else:
+            with open(os.path.join(self.path, self.file_name), "a", encoding="utf8") as f:
+                print(info, file=f)
         if stdout:
             print(info)
 
+    def log_metrics(self, metrics, file_name="metrics.jsonl"):
+        """
+        Appends the given metrics as a JSON line to the metrics file, a timestamp is added
+        :param metrics: dictionary, e.g. {"epoch": 1, "train_loss": 4.2}
+        :param file_name: the metrics file in the logger path
+        """
+        record = dict({"time": time.time()}, **metrics)
+        line = json.dumps(record, default=float) + "\n"
+        if self.buffered:
+            if file_name not in self.metrics_writers:
+                self.metrics_writers[file_name] = BufferedFileWriter(os.path.join(self.path, file_name))
+            self.metrics_writers[file_name].write(line)
+        else:
+            with open(os.path.join(self.path, file_name), "a", encoding="utf8") as f:
+                f.write(line)
+
+    def flush(self):
+        """
+        Writes the buffered log lines to the files
+        """
+        for writer in [self.writer] + list(self.metrics_writers.values()):
+            if writer:
+                writer.flush()
+
+    def close(self):
+        """
+        Writes the buffered log lines and unregisters the writers from the background flush
+        """
+        for writer in [self.writer] + list(self.metrics_writers.values()):
+            if writer:
+                writer.close()
+        self.metrics_writers = dict()
+
     def save_model(self, model_dict):
         """
         Saves the model at the path
@@ -0,0 +1,223 @@
+"""
+This file contains utilities to track the memory used by the training:
+process RSS, CUDA memory, sizes of data, vocabularies, model and optimizer and the largest tensors.
+"""
+import gc
+import os
+import sys
+import tracemalloc
+import warnings
+
+import torch
+from torchtext.data import Batch
+
+from project.utils.utils_checkpoints import get_rng_state, set_rng_state
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+MB = 2 ** 20
+
+
+def get_rss():
+    """
+    :return: the current resident set size of the process in bytes, None if unknown
+    """
+    try:
+        import psutil
+        return psutil.Process(os.getpid()).memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def get_peak_rss():
+    """
+    :return: the highest resident set size of the process so far in bytes, None if unknown
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def tensor_bytes(obj):
+    """
+    :param obj: a tensor or a (nested) dictionary, list or tuple of tensors, e.g. a state dict
+    :return: the bytes of all tensors
+    """
+    if torch.is_tensor(obj):
+        return obj.numel() * obj.element_size()
+    if isinstance(obj, dict):
+        return sum(tensor_bytes(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(tensor_bytes(v) for v in obj)
+    return 0
+
+
+def largest_tensors(k=5):
+    """
+    Finds the largest tensors alive in the process, tensors sharing the same storage are counted once
+    :param k: number of tensors
+    :return: list of dictionaries with shape, dtype, device and bytes
+    """
+    tensors = dict()
+    with warnings.catch_warnings():
+        # the type check touches deprecated torch objects
+        warnings.simplefilter("ignore")
+        for obj in gc.get_objects():
+            try:
+                if not torch.is_tensor(obj) or obj.is_sparse:
+                    continue
+                key = (obj.device.type, obj.untyped_storage().data_ptr())
+                size = obj.untyped_storage().nbytes()
+            except Exception:
+                continue
+            if size > tensors.get(key, (0, None))[0]:
+                tensors[key] = (size, obj)
+    largest = sorted(tensors.values(), key=lambda item: item[0], reverse=True)[:k]
+    return [{"shape": list(t.shape), "dtype": str(t.dtype).replace("torch.", ""), "device": str(t.device),
+             "bytes": size} for size, t in largest]
+
+
+def _object_bytes(obj):
+    if isinstance(obj, (list, tuple)):
+        return sys.getsizeof(obj) + sum(_object_bytes(item) for item in obj)
+    return sys.getsizeof(obj)
+
+
+def dataset_memory(dataset, sample=1000):
+    """
+    Estimates the memory of the tokenized examples from a sample
+    :param dataset: a torchtext dataset
+    :param sample: number of examples measured
+    :return: dictionary with examples, tokens and estimated bytes
+    """
+    examples = dataset.examples
+    if not examples:
+        return {"examples": 0, "tokens": 0, "bytes": 0}
+    tokens = sum(len(getattr(e, name)) for e in examples for name in dataset.fields)
+    measured = examples[:sample]
+    measured_bytes = sum(sys.getsizeof(e) + sum(_object_bytes(getattr(e, name)) for name in dataset.fields)
+                         for e in measured)
+    return {"examples": len(examples), "tokens": tokens,
+            "bytes": int(measured_bytes * len(examples) / len(measured))}
+
+
+def vocab_memory(field):
+    """
+    :param field: a torchtext Field with a vocabulary
+    :return: dictionary with the vocabulary size and its bytes (itos, stoi and frequencies)
+    """
+    vocab = field.vocab
+    string_bytes = sum(sys.getsizeof(token) for token in vocab.itos)
+    size = sys.getsizeof(vocab.itos) + sys.getsizeof(vocab.stoi) + string_bytes
+    if getattr(vocab, "freqs", None):
+        size += sys.getsizeof(vocab.freqs) + sum(sys.getsizeof(token) for token in vocab.freqs)
+    return {"size": len(vocab.itos), "bytes": size}
+
+
+def memory_stats(model=None, optimizer=None, device="cpu", k=5):
+    """
+    Collects the current memory usage
+    :param model: the model, its parameters and buffers are measured
+    :param optimizer: the optimizer, its state is measured
+    :param device: the training device
+    :param k: number of largest tensors reported
+    :return: dictionary of the statistics
+    """
+    rss, peak_rss = get_rss(), get_peak_rss()
+    # the peak is updated by the kernel with a delay
+    stats = {"rss": rss, "peak_rss": max(rss, peak_rss) if rss and peak_rss else peak_rss}
+    if model is not None:
+        stats["model_bytes"] = tensor_bytes(model.state_dict())
+        stats["grad_bytes"] = sum(tensor_bytes(p.grad) for p in model.parameters() if p.grad is not None)
+    if optimizer is not None:
+        stats["optimizer_bytes"] = tensor_bytes(optimizer.state_dict()["state"])
+    if torch.device(device).type == "cuda" and torch.cuda.is_available():
+        stats["cuda_allocated"] = torch.cuda.memory_allocated()
+        stats["cuda_peak"] = torch.cuda.max_memory_allocated()
+        torch.cuda.reset_peak_memory_stats()
+    if k > 0:
+        stats["largest_tensors"] = largest_tensors(k)
+    return stats
+
+
+MEMORY_LABELS = [("rss", "RSS"), ("peak_rss", "Peak RSS"), ("forward_rss_increase", "Forward RSS increase"),
+                 ("backward_rss_increase", "Backward RSS increase"), ("python_peak", "Python peak"),
+                 ("model_bytes", "Model"), ("grad_bytes", "Gradients"), ("optimizer_bytes", "Optimizer"),
+                 ("cuda_allocated", "CUDA"), ("cuda_peak", "CUDA peak")]
+
+
+def format_memory(stats):
+    """
+    :return: the available memory statistics in MB, as a single line
+    """
+    return " | ".join("{}: {:.1f} MB".format(label, stats[key] / MB) for key, label in MEMORY_LABELS
+                      if stats.get(key) is not None)
+
+
+def get_largest_batch(dataset, batch_size, device="cpu"):
+    """
+    Builds the batch of the longest examples, the worst case of the bucket iterator
+    :return: the torchtext Batch
+    """
+    examples = sorted(dataset.examples, key=lambda x: (len(x.src), len(x.trg)), reverse=True)[:batch_size]
+    return Batch(examples, dataset, device)
+
+
+def snapshot_largest_batch(dataset, batch_size, model, criterion, device, path, top=20):
+    """
+    Runs forward and backward of the largest batch with tracemalloc and, on CUDA, the torch memory history.
+    tracemalloc sees the Python allocations only, the tensor memory is given by the RSS and CUDA peaks.
+    The gradients and the random states are restored, so the training is not affected.
+    Writes memory_snapshot.log and, on CUDA, memory_snapshot.pickle (see https://pytorch.org/memory_viz).
+    :return: dictionary with the batch shape and the memory peaks
+    """
+    batch = get_largest_batch(dataset, batch_size, device)
+    rng_state = get_rng_state()
+    cuda = torch.device(device).type == "cuda" and torch.cuda.is_available()
+    record_history = cuda and hasattr(torch.cuda.memory, "_record_memory_history")
+    was_training = model.training
+    model.train()
+    rss_before = get_rss()
+    if cuda:
+        torch.cuda.reset_peak_memory_stats()
+    if record_history:
+        torch.cuda.memory._record_memory_history()
+    tracemalloc.start()
+    scores = model(batch.src, batch.trg)[:-1]
+    loss = criterion(scores.reshape(-1, scores.size(2)), batch.trg[1:].reshape(-1))
+    forward_rss = get_rss()
+    loss.backward()
+    snapshot = tracemalloc.take_snapshot()
+    _, python_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    stats = {"batch_size": batch.batch_size, "src_len": batch.src.size(0), "trg_len": batch.trg.size(0),
+             "python_peak": python_peak, "peak_rss": get_peak_rss()}
+    if rss_before is not None:
+        stats.update({"forward_rss_increase": forward_rss - rss_before, "backward_rss_increase": get_rss() - rss_before})
+    if cuda:
+        stats["cuda_peak"] = torch.cuda.max_memory_allocated()
+    if record_history:
+        torch.cuda.memory._dump_snapshot(os.path.join(path, "memory_snapshot.pickle"))
+        torch.cuda.memory._record_memory_history(enabled=None)
+    del scores, loss
+    model.zero_grad()
+    model.train(was_training)
+    set_rng_state(rng_state)
+
+    with open(os.path.join(path, "memory_snapshot.log"), "w", encoding="utf8") as f:
+        f.write("Largest batch: {}\n".format(stats))
+        f.write("Top {} Python allocations during forward and backward:\n".format(top))
+        for stat in snapshot.statistics("lineno")[:top]:
+            f.write("{}\n".format(stat))
+    return stats
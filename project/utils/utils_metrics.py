@@ -1,3 +1,6 @@
+import math
+
+
 class Metric(object):
     def __init__(self, name, values):
         """
@@ -31,4 +34,129 @@ class AverageMeter():
         self.val = val
         self.sum = self.sum + val * n
         self.count = self.count + n
-        self.avg = self.sum / self.count
\ No newline at end of file
+        self.avg = self.sum / self.count
+
+class BleuScorer(object):
+    """
+    Corpus BLEU computed directly on token id sequences.
+    Reproduces NLTK corpus_bleu with SmoothingFunction().method4, without converting ids to strings.
+    The n-gram statistics of the references are cached by their id sequence, so that a split is
+    processed only once, even if the iterator is shuffled at every epoch.
+    """
+
+    def __init__(self, max_n=4, k=5, remove_tokens=None):
+        """
+        :param max_n: maximal n-gram order (uniform weights 1/max_n)
+        :param k: smoothing constant of method4 (NLTK default: 5)
+        :param remove_tokens: token ids to strip from hypotheses and references, e.g. pad, sos, eos
+        """
+        self.max_n = max_n
+        self.k = k
+        self.remove_tokens = set(remove_tokens) if remove_tokens else set()
+        self.ref_cache = dict()
+        self.reset()
+
+    def reset(self):
+        """
+        Resets the corpus statistics, the reference cache is kept
+        """
+        self.numerators = [0] * self.max_n
+        self.denominators = [0] * self.max_n
+        self.hyp_len = 0
+        self.ref_len = 0
+        self.count = 0
+
+    def clean(self, ids):
+        return tuple(int(w) for w in ids if int(w) not in self.remove_tokens)
+
+    def ngram_counts(self, ids):
+        """
+        Counts all n-grams of order 1..max_n
+        :param ids: tuple of token ids
+        :return: list of dictionaries, one per order
+        """
+        counts = []
+        for n in range(1, self.max_n + 1):
+            n_counts = dict()
+            for i in range(len(ids) - n + 1):
+                ngram = ids[i:i + n]
+                n_counts[ngram] = n_counts.get(ngram, 0) + 1
+            counts.append(n_counts)
+        return counts
+
+    def reference_stats(self, reference):
+        """
+        Returns the cached length and n-gram counts of the given reference
+        :param reference: the reference ids, already cleaned
+        :return: (length, n-gram counts)
+        """
+        stats = self.ref_cache.get(reference)
+        if stats is None:
+            stats = (len(reference), self.ngram_counts(reference))
+            self.ref_cache[reference] = stats
+        return stats
+
+    def cache_references(self, references):
+        """
+        Precomputes the statistics for the given references
+        :param references: iterable of reference id sequences
+        """
+        for reference in references:
+            self.reference_stats(self.clean(reference))
+
+    def add(self, hypothesis, reference):
+        """
+        Accumulates the statistics of a single hypothesis/reference pair
+        :param hypothesis: hypothesis token ids
+        :param reference: reference token ids
+        """
+        hypothesis = self.clean(hypothesis)
+        ref_len, ref_counts = self.reference_stats(self.clean(reference))
+        hyp_counts = self.ngram_counts(hypothesis)
+        for n in range(self.max_n):
+            clipped = 0
+            total = 0
+            for ngram, count in hyp_counts[n].items():
+                total += count
+                clipped += min(count, ref_counts[n].get(ngram, 0))
+            self.numerators[n] += clipped
+            self.denominators[n] += max(1, total)
+        self.hyp_len += len(hypothesis)
+        self.ref_len += ref_len
+        self.count += 1
+
+    def add_batch(self, hypotheses, references):
+        """
+        Accumulates the statistics of a batch
+        :param hypotheses: list of hypotheses
+        :param references: list of references (one reference per hypothesis)
+        """
+        assert len(hypotheses) == len(references)
+        for hypothesis, reference in zip(hypotheses, references):
+            self.add(hypothesis, reference)
+
+    def score(self):
+        """
+        Computes the corpus BLEU for the accumulated statistics
+        :return: BLEU score in [0, 100]
+        """
+        if self.numerators[0] == 0:
+            return 0
+        if self.hyp_len > self.ref_len:
+            bp = 1
+        elif self.hyp_len == 0:
+            bp = 0
+        else:
+            bp = math.exp(1 - self.ref_len / self.hyp_len)
+        # smoothing method4, see: nltk.translate.bleu_score.SmoothingFunction
+        p_n = []
+        incvnt = 1
+        for numerator, denominator in zip(self.numerators, self.denominators):
+            if numerator == 0 and self.hyp_len > 1:
+                p_n.append((1 / (2 ** incvnt * self.k / math.log(self.hyp_len))) / denominator)
+                incvnt += 1
+            else:
+                p_n.append(numerator / denominator)
+        weight = 1 / self.max_n
+        s = math.fsum(weight * math.log(p) for p in p_n if p > 0)
+        return bp * math.exp(s) * 100
@@ -0,0 +1,241 @@
+"""
+This file contains the training on a mix of several preprocessed corpora.
+The training files are streamed: each pool of examples is drawn from the corpora with the sampling probabilities,
+read from the current position of each file, sorted by length and split into batches, like the BucketIterator.
+Only the pool is held in memory, the memory and the startup time do not grow with the size of the corpora.
+The token counts of the shared vocabulary are computed once per training file and cached.
+"""
+import json
+import math
+import os
+from collections import Counter
+
+import numpy as np
+from torchtext.data import Batch, Example
+
+from project.utils.utils_cache import StageCache, hash_key
+from settings import DATA_DIR_PREPRO, SEED
+
+
+def get_corpus_dir(corpus, lang_code, max_len=30):
+    """
+    :return: directory of the splits of the preprocessed corpus, e.g. data/preprocessed/europarl/de/splits/30
+    """
+    return os.path.join(os.path.expanduser(DATA_DIR_PREPRO), corpus, lang_code, "splits", str(max_len))
+
+
+def sampling_probabilities(sizes, weights=None, temperature=1.0):
+    """
+    :param sizes: number of training pairs of each corpus
+    :param weights: optional sampling weights of the corpora, the sizes are then ignored
+    :param temperature: with T > 1 the small corpora are sampled more often than their size, p ~ size^(1/T)
+    :return: array of the sampling probabilities
+    """
+    if weights:
+        if len(weights) != len(sizes):
+            raise ValueError("Provide one weight per corpus: {} weights for {} corpora".format(len(weights),
+                                                                                             len(sizes)))
+        probabilities = np.asarray(weights, dtype=np.float64)
+    else:
+        probabilities = np.asarray(sizes, dtype=np.float64) ** (1.0 / temperature)
+    if probabilities.sum() <= 0 or (probabilities < 0).any():
+        raise ValueError("The sampling weights must be positive")
+    return probabilities / probabilities.sum()
+
+
+def _prepare_line(line, truncate):
+    line = line.decode("utf-8").strip()
+    if truncate > 0:
+        line = " ".join(line.split(" ")[:truncate])
+    return line
+
+
+class CorpusStream(object):
+    """
+    Reads the examples of a parallel corpus in file order, the files are read again from the start at their end.
+    The position is given by the byte offsets of both files.
+    """
+
+    def __init__(self, name, src_path, trg_path, fields, truncate=0):
+        """
+        :param fields: list of (name, Field) of source and target
+        :param truncate: maximum number of words of a sentence, 0 for no truncation
+        """
+        self.name = name
+        self.paths = (src_path, trg_path)
+        self.fields = fields
+        self.truncate = truncate
+        self.files = None
+        self.passes = 0
+
+    def open(self, offsets=(0, 0)):
+        self.close()
+        self.files = [open(path, "rb") for path in self.paths]
+        for f, offset in zip(self.files, offsets):
+            f.seek(offset)
+
+    def close(self):
+        if self.files:
+            for f in self.files:
+                f.close()
+        self.files = None
+
+    def tell(self):
+        if self.files is None:
+            return [0, 0]
+        return [f.tell() for f in self.files]
+
+    def read(self, n):
+        """
+        :return: list of the next n examples, empty pairs are skipped
+        """
+        if self.files is None:
+            self.open()
+        src_file, trg_file = self.files
+        # False after a complete pass without pairs
+        found = True
+        examples = []
+        while len(examples) < n:
+            src, trg = src_file.readline(), trg_file.readline()
+            if not src or not trg:
+                if not found:
+                    raise ValueError("No sentence pairs in {}".format(", ".join(self.paths)))
+                found = False
+                src_file.seek(0)
+                trg_file.seek(0)
+                self.passes += 1
+                continue
+            src, trg = _prepare_line(src, self.truncate), _prepare_line(trg, self.truncate)
+            if src and trg:
+                found = True
+                examples.append(Example.fromlist([src, trg], self.fields))
+        return examples
+
+
+class MixedDataset(object):
+    """
+    Stands for the streamed training data of the mix, the examples are not held in memory
+    """
+
+    def __init__(self, fields, names, sizes, probabilities, epoch_size):
+        self.fields = dict(fields)
+        self.names = names
+        self.sizes = sizes
+        self.probabilities = probabilities
+        self.epoch_size = epoch_size
+        self.examples = []
+
+    def __len__(self):
+        return self.epoch_size
+
+    def describe(self):
+        return "\n".join("{:<12} {:>12,} pairs, sampling probability {:.3f}".format(name, size, p)
+                         for name, size, p in zip(self.names, self.sizes, self.probabilities))
+
+
+class MixedBucketIterator(object):
+    """
+    Iterates over an epoch of epoch_size examples drawn from the corpus streams.
+    The position (file offsets and random state at the start of the epoch and the batches done)
+    can be saved with state_dict and restored with load_state_dict, like the torchtext iterators.
+    """
+    streaming = True
+
+    def __init__(self, streams, dataset, batch_size, device=None, pool_batches=100, seed=SEED,
+                 sort_key=lambda x: (len(x.src), len(x.trg))):
+        """
+        :param streams: a CorpusStream per corpus
+        :param dataset: the MixedDataset with the fields, the probabilities and the epoch size
+        :param pool_batches: number of batches of a pool of examples sorted by length
+        """
+        self.streams = streams
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.device = device
+        self.pool_batches = pool_batches
+        self.sort_key = sort_key
+        self.random_state = np.random.RandomState(seed)
+        self.iterations = 0
+        self.iterations_this_epoch = 0
+        self._epoch_start = None
+        self._skip = 0
+
+    def __len__(self):
+        return math.ceil(self.dataset.epoch_size / self.batch_size)
+
+    def state_dict(self, end_of_epoch=False):
+        if end_of_epoch or self._epoch_start is None:
+            offsets, random_state, done = [s.tell() for s in self.streams], self.random_state.get_state(), 0
+        else:
+            (offsets, random_state), done = self._epoch_start, self.iterations_this_epoch
+        # the key array is stored as list, so the checkpoint can be loaded with weights_only=True
+        random_state = (random_state[0], random_state[1].tolist()) + tuple(random_state[2:])
+        return {"iterations": self.iterations, "iterations_this_epoch": done, "offsets": offsets,
+                "random_state": random_state}
+
+    def load_state_dict(self, state):
+        for stream, offsets in zip(self.streams, state["offsets"]):
+            stream.open(offsets)
+        random_state = state["random_state"]
+        self.random_state.set_state((random_state[0], np.array(random_state[1], dtype=np.uint32))
+                                    + tuple(random_state[2:]))
+        self.iterations = state["iterations"]
+        # the batches done are drawn again and skipped
+        self._skip = state["iterations_this_epoch"]
+
+    def pools(self):
+        """
+        :return: generator of the pools of the epoch, each as list of batches of examples in random order
+        """
+        remaining = self.dataset.epoch_size
+        while remaining > 0:
+            size = min(remaining, self.batch_size * self.pool_batches)
+            remaining -= size
+            counts = self.random_state.multinomial(size, self.dataset.probabilities)
+            pool = [example for stream, count in zip(self.streams, counts) if count for example in stream.read(count)]
+            pool.sort(key=self.sort_key)
+            batches = [pool[i:i + self.batch_size] for i in range(0, len(pool), self.batch_size)]
+            yield [batches[i] for i in self.random_state.permutation(len(batches))]
+
+    def __iter__(self):
+        self._epoch_start = ([s.tell() for s in self.streams], self.random_state.get_state())
+        skip, self._skip = self._skip, 0
+        self.iterations_this_epoch = 0
+        for batches in self.pools():
+            for examples in batches:
+                self.iterations_this_epoch += 1
+                if skip > 0:
+                    skip -= 1
+                    continue
+                self.iterations += 1
+                yield Batch(examples, self.dataset, self.device)
+
+
+def count_tokens(stream, signature):
+    """
+    Counts the tokens of a whole training file, the counts are cached next to it
+    :param stream: the CorpusStream of the training file
+    :param signature: identifies the tokenization, the counts are recomputed if it changes
+    :return: Counters of the source and target tokens and the number of pairs
+    """
+    cache = StageCache(os.path.join(os.path.dirname(stream.paths[0]), "cache"))
+    files = [(os.path.basename(path), os.path.getsize(path), os.path.getmtime(path)) for path in stream.paths]
+    key = hash_key("token_counts", files, stream.truncate, signature)
+    path = os.path.join(cache.path("token_counts", key), "counts.json")
+    if cache.is_done("token_counts", key):
+        with open(path, encoding="utf-8") as f:
+            counts = json.load(f)
+        return Counter(counts["src"]), Counter(counts["trg"]), cache.get_info("token_counts", key)["pairs"]
+    (src_name, src_field), (trg_name, trg_field) = stream.fields
+    src_counts, trg_counts, pairs = Counter(), Counter(), 0
+    with open(stream.paths[0], "rb") as src_file, open(stream.paths[1], "rb") as trg_file:
+        for src, trg in zip(src_file, trg_file):
+            src, trg = _prepare_line(src, stream.truncate), _prepare_line(trg, stream.truncate)
+            if src and trg:
+                src_counts.update(src_field.preprocess(src))
+                trg_counts.update(trg_field.preprocess(trg))
+                pairs += 1
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"src": src_counts, "trg": trg_counts}, f)
+    cache.mark_done("token_counts", key, {"pairs": pairs})
+    return src_counts, trg_counts, pairs
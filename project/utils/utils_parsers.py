@@ -22,6 +22,10 @@ class DatasetConfigParser(object):
     def get_download_dir(self):
         return self.parser.get(self.dataset_name.strip().lower(), "download_dir")
 
+    def get_sha256(self, file_name):
+        # optional checksum of a downloaded file, e.g. sha256_de-en.tmx.gz = <hex digest>
+        return self.parser.get(self.dataset_name.strip().lower(), "sha256_" + file_name, fallback=None)
+
 #TODO: Use this parser to load spacy models!
 class LanguageModelConfigParser(object):
     # config/lm.cfg
@@ -43,7 +47,6 @@ class LanguageModelConfigParser(object):
 
     def get_pretrained_embedding_url(self, embedding, lang_code):
         embedding_section = embedding.strip().upper()
-        print(embedding_section)
         try:
             return self.parser.get(embedding_section, embedding_section.lower()).format(lang_code)
         except NoSectionError:
@@ -0,0 +1,414 @@
+"""
+This file contains utilities to measure where the training and translation time is spent.
+"""
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+from torch import nn
+
+TRAIN_PHASES = ["data", "forward", "loss", "backward", "clip", "optimizer"]
+
+
+class PhaseTimer(object):
+    """
+    Accumulates the wall-clock time spent in the training phases and counts the processed sentences and tokens.
+    """
+
+    def __init__(self, sync_cuda=False, record=False):
+        """
+        :param sync_cuda: synchronize CUDA at the phase boundaries, otherwise asynchronous kernels are
+        attributed to the phase that waits for them
+        :param record: label the phases in torch.profiler traces
+        """
+        self.sync_cuda = sync_cuda and torch.cuda.is_available()
+        self.record = record
+        self.reset()
+
+    def reset(self):
+        self.times = OrderedDict()
+        self.sentences = 0
+        self.tokens = 0
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Times the enclosed block
+        :param name: the phase name
+        """
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        if self.record:
+            with torch.autograd.profiler.record_function(name):
+                yield
+        else:
+            yield
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        self.times[name] = self.times.get(name, 0.) + seconds
+
+    def count(self, sentences, tokens):
+        """
+        Counts the processed sentences and tokens, tokens may be a tensor to avoid a synchronization
+        """
+        self.sentences += sentences
+        self.tokens += tokens
+
+    def train_time(self):
+        return sum(self.times.get(name, 0.) for name in TRAIN_PHASES)
+
+    def summary(self):
+        """
+        :return: dictionary with the time per phase and the training throughput
+        """
+        tokens = int(self.tokens)
+        train_time = self.train_time()
+        summary = {"phase_times": dict(self.times), "sentences": self.sentences, "tokens": tokens}
+        if train_time > 0:
+            summary.update({"sentences_per_sec": self.sentences / train_time,
+                            "tokens_per_sec": tokens / train_time})
+        return summary
+
+    def __str__(self):
+        total = sum(self.times.values())
+        phases = " | ".join("{} {:.2f}s ({:.0%})".format(name, seconds, seconds / total if total > 0 else 0)
+                            for name, seconds in self.times.items())
+        train_time = self.train_time()
+        if train_time > 0:
+            phases += " | {:.1f} sentences/s, {:.1f} tokens/s".format(self.sentences / train_time,
+                                                                      int(self.tokens) / train_time)
+        return phases
+
+
+class StepProfiler(object):
+    """
+    Captures a torch.profiler trace for a window of training steps.
+    The trace is saved as profile_trace.json (chrome://tracing) and a summary table as profile.log.
+    """
+
+    def __init__(self, path, steps, wait=1, warmup=1):
+        """
+        :param path: the experiment directory
+        :param steps: number of profiled steps
+        :param wait: steps skipped before the warmup
+        :param warmup: steps traced but discarded
+        """
+        from torch.profiler import profile, schedule, ProfilerActivity
+        self.path = path
+        self.total_steps = wait + warmup + steps
+        self.steps = 0
+        activities = [ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(ProfilerActivity.CUDA)
+        self.profiler = profile(activities=activities, schedule=schedule(wait=wait, warmup=warmup, active=steps),
+                                on_trace_ready=self._save, record_shapes=True, profile_memory=True)
+        self.profiler.start()
+        self.active = True
+
+    def step(self):
+        if not self.active:
+            return
+        self.profiler.step()
+        self.steps += 1
+        if self.steps >= self.total_steps:
+            self.stop()
+
+    def stop(self):
+        if self.active:
+            self.active = False
+            self.profiler.stop()
+
+    def _save(self, profiler):
+        profiler.export_chrome_trace(os.path.join(self.path, "profile_trace.json"))
+        with open(os.path.join(self.path, "profile.log"), "w", encoding="utf8") as f:
+            f.write(profiler.key_averages().table(sort_by="self_cpu_time_total", row_limit=50))
+        print("Profiler trace saved in {}".format(self.path))
+
+
+def get_step_profiler(path, steps):
+    """
+    Creates a StepProfiler, if torch.profiler is available
+    :param path: the experiment directory
+    :param steps: number of profiled steps, 0 disables the profiler
+    :return: the profiler or None
+    """
+    if steps <= 0:
+        return None
+    try:
+        return StepProfiler(path, steps)
+    except ImportError:
+        print("torch.profiler not available. Please update PyTorch to profile the training!")
+        return None
+
+
+class LatencyHistogram(object):
+    """
+    Keeps the last 'window' values of a latency and computes their percentiles
+    """
+
+    def __init__(self, window=1000):
+        self.values = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.
+
+    def add(self, seconds):
+        self.values.append(seconds)
+        self.count += 1
+        self.total += seconds
+
+    def percentile(self, q):
+        """
+        :param q: percentile between 0 and 100
+        :return: the percentile of the values in the window in seconds
+        """
+        if not self.values:
+            return None
+        return float(np.percentile(self.values, q))
+
+    def summary(self):
+        return {"count": self.count, "mean": self.total / self.count if self.count else None,
+                "p50": self.percentile(50), "p90": self.percentile(90), "p99": self.percentile(99)}
+
+
+class TranslationStats(object):
+    """
+    Collects the latency of the translation stages per request and the decoding statistics of the beam search.
+    Stages: tokenize, numericalize, encode, decode (per request), decode_step, detokenize and total.
+    """
+
+    def __init__(self, window=1000, sync_cuda=False):
+        """
+        :param window: number of recent values used for the percentiles
+        :param sync_cuda: synchronize CUDA before reading the clock
+        """
+        self.window = window
+        self.sync_cuda = sync_cuda and torch.cuda.is_available()
+        self.reset()
+
+    def reset(self):
+        self.stages = OrderedDict()
+        self.requests = 0
+        self.decode_steps = 0
+        self.beam_slots = 0
+        self.active_hypotheses = 0
+
+    def now(self):
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def add(self, stage, seconds):
+        if stage not in self.stages:
+            self.stages[stage] = LatencyHistogram(self.window)
+        self.stages[stage].add(seconds)
+
+    @contextmanager
+    def stage(self, name):
+        start = self.now()
+        yield
+        self.add(name, self.now() - start)
+
+    def add_decode_step(self, seconds, active, beam_size):
+        """
+        :param seconds: duration of the decoder step
+        :param active: number of hypotheses expanded in the step
+        :param beam_size: the beam size
+        """
+        self.add("decode_step", seconds)
+        self.decode_steps += 1
+        self.active_hypotheses += active
+        self.beam_slots += beam_size
+
+    def add_request(self):
+        self.requests += 1
+
+    def get_percentiles(self, stage):
+        """
+        :return: dictionary with count, mean, p50, p90 and p99 of the stage in seconds
+        """
+        return self.stages[stage].summary() if stage in self.stages else None
+
+    def beam_occupancy(self):
+        """
+        :return: average fraction of the beam filled with hypotheses which are still decoded
+        """
+        return self.active_hypotheses / self.beam_slots if self.beam_slots else None
+
+    def summary(self):
+        return {"requests": self.requests, "decode_steps": self.decode_steps,
+                "decode_steps_per_request": self.decode_steps / self.requests if self.requests else None,
+                "beam_occupancy": self.beam_occupancy(),
+                "stages": {name: histogram.summary() for name, histogram in self.stages.items()}}
+
+    def __str__(self):
+        ms = lambda value: "{:.2f}".format(value * 1000) if value is not None else "-"
+        lines = ["{:<14} {:>8} {:>10} {:>10} {:>10} {:>10}".format("Stage (ms)", "Count", "Mean", "p50", "p90", "p99")]
+        for name, histogram in self.stages.items():
+            summary = histogram.summary()
+            lines.append("{:<14} {:>8} {:>10} {:>10} {:>10} {:>10}".format(
+                name, summary["count"], ms(summary["mean"]), ms(summary["p50"]), ms(summary["p90"]), ms(summary["p99"])))
+        occupancy = self.beam_occupancy()
+        lines.append("Requests: {} | Decode steps: {} | Beam occupancy: {}".format(
+            self.requests, self.decode_steps, "{:.1%}".format(occupancy) if occupancy is not None else "-"))
+        return "\n".join(lines)
+
+
+class ModuleProfiler(object):
+    """
+    Accumulates time, calls and estimated FLOPs and bytes of the Seq2Seq submodules with forward hooks.
+    The statistics are kept per mode, e.g. 'train' for the teacher forced training and 'decode' for the beam search.
+    FLOPs count a multiply-add as 2 operations and ignore the elementwise operations of the RNN gates.
+    Bytes are the parameters and the input and output activations read and written by the module.
+    """
+    DEFAULT_MODULES = ["encoder.embedding", "encoder.rnn", "decoder.embedding", "decoder.rnn", "attention",
+                       "preoutput", "output"]
+
+    def __init__(self, model, modules=None, sync_cuda=False):
+        """
+        :param model: the model
+        :param modules: names of the profiled submodules, as given by model.named_modules()
+        :param sync_cuda: synchronize CUDA around each module call, otherwise asynchronous kernels are not timed
+        """
+        self.model = model
+        self.module_names = modules or ModuleProfiler.DEFAULT_MODULES
+        self.sync_cuda = sync_cuda and torch.cuda.is_available()
+        self.handles = []
+        self.current_mode = "forward"
+        self.starts = dict()
+        self.stats = OrderedDict()
+
+    def attach(self):
+        named_modules = dict(self.model.named_modules())
+        for name in self.module_names:
+            module = named_modules.get(name)
+            if module is None:
+                continue
+            self.handles.append(module.register_forward_pre_hook(self._pre_hook(name)))
+            self.handles.append(module.register_forward_hook(self._hook(name)))
+        return self
+
+    def detach(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    @contextmanager
+    def mode(self, name):
+        """
+        Assigns the module calls of the enclosed block to the given mode
+        """
+        previous, self.current_mode = self.current_mode, name
+        try:
+            yield
+        finally:
+            self.current_mode = previous
+
+    def _pre_hook(self, name):
+        def hook(module, inputs):
+            if self.sync_cuda:
+                torch.cuda.synchronize()
+            self.starts[name] = time.perf_counter()
+
+        return hook
+
+    def _hook(self, name):
+        def hook(module, inputs, output):
+            if self.sync_cuda:
+                torch.cuda.synchronize()
+            elapsed = time.perf_counter() - self.starts.pop(name)
+            flops, bytes_moved = estimate_module_cost(module, inputs, output)
+            key = (self.current_mode, name)
+            if key not in self.stats:
+                self.stats[key] = {"calls": 0, "time": 0., "flops": 0, "bytes": 0}
+            stats = self.stats[key]
+            stats["calls"] += 1
+            stats["time"] += elapsed
+            stats["flops"] += flops
+            stats["bytes"] += bytes_moved
+
+        return hook
+
+    def reset(self):
+        self.stats = OrderedDict()
+
+    def summary(self):
+        """
+        :return: list of rows sorted by mode and descending time
+        """
+        totals = dict()
+        for (mode, _), stats in self.stats.items():
+            totals[mode] = totals.get(mode, 0.) + stats["time"]
+        rows = [dict(mode=mode, module=name, share=stats["time"] / totals[mode] if totals[mode] > 0 else 0., **stats)
+                for (mode, name), stats in self.stats.items()]
+        return sorted(rows, key=lambda row: (row["mode"], -row["time"]))
+
+    def table(self):
+        header = "{:<8} {:<18} {:>8} {:>11} {:>10} {:>7} {:>10} {:>9} {:>10}".format(
+            "Mode", "Module", "Calls", "Total (ms)", "Avg (ms)", "Time", "GFLOPs", "GFLOP/s", "MB")
+        lines = [header, "-" * len(header)]
+        for row in self.summary():
+            lines.append("{:<8} {:<18} {:>8} {:>11.2f} {:>10.4f} {:>7.1%} {:>10.4f} {:>9.2f} {:>10.2f}".format(
+                row["mode"], row["module"], row["calls"], row["time"] * 1000, row["time"] * 1000 / row["calls"],
+                row["share"], row["flops"] / 1e9, row["flops"] / 1e9 / row["time"] if row["time"] > 0 else 0,
+                row["bytes"] / 2 ** 20))
+        return "\n".join(lines)
+
+    def save(self, path, file_name="module_profile.log"):
+        """
+        Writes the table to the given directory, usually next to the model
+        """
+        with open(os.path.join(path, file_name), "w", encoding="utf8") as f:
+            f.write(self.table() + "\n")
+
+
+def _tensor_bytes(*tensors):
+    total = 0
+    for t in tensors:
+        if torch.is_tensor(t):
+            total += t.numel() * t.element_size()
+        elif isinstance(t, (tuple, list)):
+            total += _tensor_bytes(*t)
+    return total
+
+
+def estimate_module_cost(module, inputs, output):
+    """
+    Estimates the FLOPs and the bytes moved by a module call
+    :param module: the module
+    :param inputs: the positional inputs of the call
+    :param output: the output of the call
+    :return: flops, bytes
+    """
+    param_bytes = sum(p.numel() * p.element_size() for p in module.parameters(recurse=False))
+    io_bytes = _tensor_bytes(inputs, output)
+    if isinstance(module, nn.Embedding):
+        # rows are gathered, no arithmetic
+        return 0, io_bytes + _tensor_bytes(output)
+    if isinstance(module, nn.Linear):
+        n = inputs[0].numel() // module.in_features
+        return 2 * n * module.in_features * module.out_features, param_bytes + io_bytes
+    if isinstance(module, nn.RNNBase):
+        x = inputs[0]
+        tokens = x.size(0) * x.size(1)
+        gates = {"LSTM": 4, "GRU": 3}.get(module.mode, 1)
+        directions = 2 if module.bidirectional else 1
+        flops = 0
+        for layer in range(module.num_layers):
+            input_size = module.input_size if layer == 0 else module.hidden_size * directions
+            flops += directions * 2 * gates * module.hidden_size * (input_size + module.hidden_size) * tokens
+        return flops, param_bytes + io_bytes
+    if hasattr(module, "attn_type") and len(inputs) == 2:
+        # dot attention: scores and context are batched matrix products over source and target positions
+        encoder_outputs, decoder_outputs = inputs
+        src_len, batch_size = encoder_outputs.size(0), encoder_outputs.size(1)
+        trg_len, hidden = decoder_outputs.size(0), decoder_outputs.size(2)
+        attention_bytes = 2 * batch_size * trg_len * src_len * decoder_outputs.element_size()
+        return 4 * batch_size * trg_len * src_len * hidden, io_bytes + attention_bytes
+    return 0, param_bytes + io_bytes
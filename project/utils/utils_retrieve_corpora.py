@@ -1,20 +1,171 @@
 import gzip
+import hashlib
+import http.client
 import os
+import re
 import shutil
+import socket
 import sys
 import tarfile
+import time
 import urllib.error
 import urllib.request
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from urllib.error import ContentTooShortError
 from project.utils.utils_parsers import DatasetConfigParser
 
+CHUNK_SIZE = 1 << 20
+MAX_RETRIES = 5
+BACKOFF = 2.0  # seconds, doubled after each failed attempt
+TIMEOUT = 60  # seconds
+# errors after which the download is resumed
+RETRY_ERRORS = (urllib.error.URLError, http.client.HTTPException, ConnectionError, socket.timeout, TimeoutError)
+
+
+def _file_sha256(path, chunk_size=CHUNK_SIZE):
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            hasher.update(chunk)
+    return hasher
+
+
+def _checksum_path(destination):
+    return str(destination) + ".sha256"
+
+
+def read_checksum(destination):
+    """
+    :return: the SHA-256 stored next to a completed download, None if the file was not validated
+    """
+    try:
+        with open(_checksum_path(destination), "r") as f:
+            return f.read().split()[0]
+    except (OSError, IndexError):
+        return None
+
+
+def get_remote_size(url, timeout=TIMEOUT):
+    """
+    :return: the Content-Length of the url, None if unknown or not reachable
+    """
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, method="HEAD"), timeout=timeout) as response:
+            length = response.headers.get("Content-Length")
+            return int(length) if length is not None else None
+    except RETRY_ERRORS + (ValueError,):
+        return None
+
+
+def is_downloaded(url, destination, sha256=None):
+    """
+    Checks whether the destination is a complete download.
+    Files of previous versions of the downloader have no stored checksum: if their size differs from the
+    remote size, they are moved to the partial file and the download is resumed.
+    """
+    if not os.path.isfile(destination):
+        return False
+    stored = read_checksum(destination)
+    if stored is not None:
+        return sha256 is None or stored == sha256
+    remote_size = get_remote_size(url)
+    if remote_size is not None and remote_size != os.path.getsize(destination):
+        print("Incomplete download found: {}".format(destination))
+        os.replace(destination, str(destination) + ".part")
+        return False
+    digest = _file_sha256(destination).hexdigest()
+    if sha256 is not None and digest != sha256:
+        return False
+    with open(_checksum_path(destination), "w") as f:
+        f.write("{}  {}\n".format(digest, os.path.basename(destination)))
+    return True
+
+
+def _content_range_total(response):
+    # Content-Range: bytes 100-199/200
+    match = re.match(r"bytes \d+-\d+/(\d+)", response.headers.get("Content-Range", ""))
+    return int(match.group(1)) if match else None
+
+
+def download_file(url, destination, sha256=None, size=None, chunk_size=CHUNK_SIZE, retries=MAX_RETRIES,
+                  backoff=BACKOFF, timeout=TIMEOUT, progress=True):
+    """
+    Downloads the url in chunks to a partial file, which is renamed to the destination once validated.
+    An interrupted download is resumed with an HTTP Range request, also in a later run.
+    The SHA-256 is computed while downloading and stored in <destination>.sha256.
+    :param url: the url
+    :param destination: the file path
+    :param sha256: the expected SHA-256 hex digest, None to skip the check
+    :param size: the expected size in bytes, default: the size announced by the server
+    :param chunk_size: bytes read at once
+    :param retries: number of attempts after a network error
+    :param backoff: seconds waited after the first failed attempt, doubled after each further one
+    :param timeout: socket timeout in seconds
+    :param progress: True to print the progress
+    :return: the destination
+    """
+    destination = str(destination)
+    if is_downloaded(url, destination, sha256):
+        return destination
+    part = destination + ".part"
+    hasher = _file_sha256(part, chunk_size) if os.path.isfile(part) else hashlib.sha256()
+    attempt = 0
+    while True:
+        offset = os.path.getsize(part) if os.path.isfile(part) else 0
+        request = urllib.request.Request(url, headers={"Range": "bytes={}-".format(offset)} if offset else {})
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                if response.status == 206:
+                    total = _content_range_total(response)
+                else:
+                    # the server sent the whole file
+                    offset, hasher = 0, hashlib.sha256()
+                    length = response.headers.get("Content-Length")
+                    total = int(length) if length is not None else None
+                total = size or total
+                with open(part, "ab" if offset else "wb") as f:
+                    written = offset
+                    for chunk in iter(lambda: response.read(chunk_size), b""):
+                        f.write(chunk)
+                        hasher.update(chunk)
+                        written += len(chunk)
+                        if progress and total:
+                            _print_download_progress(written, 1, total)
+            if total is not None and written != total:
+                raise ConnectionError("Received {} of {} bytes".format(written, total))
+            break
+        except urllib.error.HTTPError as e:
+            if e.code == 416 and offset and size in (None, offset):
+                # nothing left to download
+                break
+            if e.code < 500 and e.code not in (408, 429):
+                raise
+            error = e
+        except RETRY_ERRORS as e:
+            error = e
+        attempt += 1
+        if attempt > retries:
+            raise IOError("Download of {} failed after {} attempts: {}".format(url, attempt, error))
+        wait = backoff * 2 ** (attempt - 1)
+        print("\nDownload interrupted ({}), resuming in {:.0f} seconds...".format(error, wait))
+        time.sleep(wait)
+
+    digest = hasher.hexdigest()
+    if sha256 is not None and digest != sha256:
+        os.remove(part)
+        raise IOError("Checksum mismatch for {}: expected {}, got {}".format(url, sha256, digest))
+    os.replace(part, destination)
+    with open(_checksum_path(destination), "w") as f:
+        f.write("{}  {}\n".format(digest, os.path.basename(destination)))
+    return destination
+
 
 class TmxCorpusDownloader(object):
     def __init__(self, config: DatasetConfigParser, lang_code="de"):
         self.url = config.get_dataset_url()
         assert "tmx" in self.url, "Only TMX corpora supported!"
+        self.config = config
         self.lang_code = lang_code
         self.download_directory = Path(config.get_download_dir() / Path(self.lang_code))
         self.full_url = [
@@ -22,33 +173,45 @@ class TmxCorpusDownloader(object):
             os.path.join(self.url, "{}-en.tmx.gz".format(self.lang_code))
         ]
 
-    def download(self):
+    def download(self, progress=True):
         os.makedirs(self.download_directory, exist_ok=True)
-        file_endings = (".gz", ".tar", ".zip")
-        already_downloaded = [e for e in self.download_directory.iterdir() if e.is_file()
-                              and (e.name.endswith(file_endings))]
-        download = False
-        if not already_downloaded:
-            for url in self.full_url:
-                if download:
-                    break
-                try:
-                    split = urllib.parse.urlsplit(url)
-                    file = split.query.split("/")[-1]
-                    final_destination = os.path.join(self.download_directory, file)
-                    urllib.request.urlretrieve(url, final_destination, reporthook=_print_download_progress)
-                    print("\nCorpus downloaded in {}".format(self.download_directory))
-                    download = True
-                except (urllib.error.URLError or ContentTooShortError) as e:
-                    # http://opus.nlpl.eu/download.php?f=Europarl/v8/tmx/en-fr.tmx.gz
-                    print(e)
-                    continue
-        else:
+        # the file name is the last part of the query, e.g. download.php?f=Europarl/v8/tmx/de-en.tmx.gz
+        files = [(url, os.path.join(self.download_directory, urllib.parse.urlsplit(url).query.split("/")[-1]))
+                 for url in self.full_url]
+        downloaded = [path for url, path in files if read_checksum(path) is not None]
+        if downloaded:
             print("File already downloaded in {}".format(self.download_directory))
-
+            return self.download_directory
+        # a partial or unvalidated file of a previous run is resumed first
+        files.sort(key=lambda file: not (os.path.isfile(file[1]) or os.path.isfile(file[1] + ".part")))
+        for url, path in files:
+            try:
+                download_file(url, path, sha256=self.config.get_sha256(os.path.basename(path)), progress=progress)
+                print("\nCorpus downloaded in {}".format(self.download_directory))
+                break
+            except urllib.error.HTTPError as e:
+                # http://opus.nlpl.eu/download.php?f=Europarl/v8/tmx/en-fr.tmx.gz
+                print(e)
+                continue
         return self.download_directory
 
 
+def download_corpora(configs, lang_code, workers=4):
+    """
+    Downloads the corpora of several datasets concurrently
+    :param configs: list of DatasetConfigParser
+    :param lang_code: the second language
+    :param workers: number of concurrent downloads
+    :return: list of the download directories
+    """
+    if len(configs) == 1:
+        return [TmxCorpusDownloader(configs[0], lang_code=lang_code).download()]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # the progress lines of concurrent downloads would be interleaved
+        return list(executor.map(lambda config: TmxCorpusDownloader(config, lang_code=lang_code).download(progress=False),
+                                 configs))
+
+
 class FileExtractor():
     def __init__(self, file_dir):
         self.file_dir = file_dir
@@ -0,0 +1,85 @@
+"""
+This file contains the statistics of the tokenized datasets: token counts, UNK and OOV rates and length histograms.
+The tokens are counted once per dataset with a Counter, the statistics are computed with numpy
+on the vocabulary ids of the distinct tokens instead of numericalizing the batches of an iterator.
+"""
+import itertools
+import json
+import os
+from collections import Counter
+
+import numpy as np
+
+from project.utils.constants import UNK_TOKEN
+
+
+def field_stats(dataset, name, field):
+    """
+    :param dataset: a torchtext dataset
+    :param name: the field name, e.g. "src"
+    :param field: the Field with the vocabulary
+    :return: dictionary of the statistics of the field
+    """
+    examples = dataset.examples
+    lengths = np.fromiter((len(getattr(e, name)) for e in examples), dtype=np.int64, count=len(examples))
+    counts = Counter(itertools.chain.from_iterable(getattr(e, name) for e in examples))
+    stoi, unk = field.vocab.stoi, field.vocab.stoi[UNK_TOKEN]
+    # stoi.get does not insert the missing tokens of the default dictionary
+    ids = np.fromiter((stoi.get(token, unk) for token in counts), dtype=np.int64, count=len(counts))
+    frequencies = np.fromiter(counts.values(), dtype=np.int64, count=len(counts))
+    id_counts = np.bincount(ids, weights=frequencies, minlength=len(field.vocab)).astype(np.int64)
+    tokens = int(lengths.sum())
+    oov_types = int((ids == unk).sum())
+    return {"sentences": len(examples), "tokens": tokens, "unks": int(id_counts[unk]),
+            "unk_rate": float(id_counts[unk]) / max(1, tokens),
+            "types": len(counts), "oov_types": oov_types, "oov_type_rate": oov_types / max(1, len(counts)),
+            "vocab_used": int((id_counts > 0).sum()),
+            "length_mean": float(lengths.mean()) if len(lengths) else 0.0,
+            "length_max": int(lengths.max()) if len(lengths) else 0,
+            "length_histogram": np.bincount(lengths).tolist()}
+
+
+def dataset_stats(dataset, src_field, trg_field):
+    """
+    Computes the statistics of both fields, they are cached in the dataset for its vocabularies
+    :return: dictionary with the statistics of "src" and "trg"
+    """
+    cache = dataset.__dict__.setdefault("_stats_cache", dict())
+    key = (id(src_field.vocab), len(src_field.vocab), id(trg_field.vocab), len(trg_field.vocab))
+    if key not in cache:
+        cache[key] = {"src": field_stats(dataset, "src", src_field), "trg": field_stats(dataset, "trg", trg_field)}
+    return cache[key]
+
+
+def format_stats(stats, top_lengths=10):
+    """
+    :param stats: dictionary split -> dataset_stats
+    :return: the statistics as text table
+    """
+    lines = ["{:<6}{:<5}{:>10}{:>12}{:>10}{:>9}{:>10}{:>10}{:>10}{:>8}".format(
+        "split", "side", "sentences", "tokens", "unks", "unk %", "types", "oov %", "mean len", "max")]
+    for split, sides in stats.items():
+        for side, s in sides.items():
+            lines.append("{:<6}{:<5}{:>10,}{:>12,}{:>10,}{:>9.2%}{:>10,}{:>10.2%}{:>10.2f}{:>8}".format(
+                split, side, s["sentences"], s["tokens"], s["unks"], s["unk_rate"], s["types"], s["oov_type_rate"],
+                s["length_mean"], s["length_max"]))
+    lines.append("")
+    lines.append("Most frequent lengths:")
+    for split, sides in stats.items():
+        for side, s in sides.items():
+            histogram = np.asarray(s["length_histogram"], dtype=np.int64)
+            common = np.argsort(-histogram, kind="stable")[:top_lengths]
+            lines.append("{:<6}{:<5}{}".format(split, side, ", ".join(
+                "{}: {}".format(length, histogram[length]) for length in common if histogram[length] > 0)))
+    return "\n".join(lines)
+
+
+def write_stats(path, file_name, stats):
+    """
+    Writes the statistics to <path>/<file_name>.log and, with the length histograms, to <file_name>.json
+    """
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, file_name + ".log"), "w", encoding="utf-8") as f:
+        f.write(format_stats(stats) + "\n")
+    with open(os.path.join(path, file_name + ".json"), "w", encoding="utf-8") as f:
+        json.dump(stats, f)
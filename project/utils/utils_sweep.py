@@ -0,0 +1,310 @@
+"""
+This file contains the sweeps over training configurations, see sweep.py.
+Each distinct data configuration of the sweep is loaded once in the sweep process. The runs are executed in forked
+worker processes, which share the loaded vocabularies and datasets copy-on-write, with a limited number of threads each.
+"""
+import functools
+import itertools
+import json
+import multiprocessing
+import os
+import queue
+import shlex
+import time
+import traceback
+from collections import OrderedDict
+
+import torch
+from torchtext.data import Iterator
+
+from project.utils.utils_checkpoints import get_iterator_state
+from project.utils.utils_logging import BufferedFileWriter
+from project.utils.utils_mixing import MixedBucketIterator
+
+# training arguments which change the vocabularies or the iterators
+DATA_ARGS = ["corpus", "lang_code", "reverse", "v", "min", "max_len", "train", "val", "test", "tok", "data_dir", "bpe",
+             "corpus_weights", "temperature", "b", "cuda"]
+
+# seconds between the checks for forked workers which exited without result
+WORKER_POLL_INTERVAL = 5.0
+
+# state of the sweep process, inherited by the forked workers
+_sweep = dict()
+
+
+def config_to_argv(config):
+    """
+    :param config: dictionary argument -> value, e.g. {"lr": 0.002, "corpus": ["europarl", "tatoeba"]}
+    :return: command line arguments of train_model.py
+    """
+    argv = []
+    for name, value in config.items():
+        values = value if isinstance(value, (list, tuple)) else [value]
+        argv += ["--" + name] + [str(v) for v in values]
+    return argv
+
+
+def expand_grid(base, grid):
+    """
+    :param base: arguments of all runs
+    :param grid: dictionary argument -> list of values
+    :return: list of the configurations of all combinations of the grid values
+    """
+    names = list(grid.keys())
+    return [dict(base, **dict(zip(names, values))) for values in itertools.product(*(grid[name] for name in names))]
+
+
+def read_sweep(path):
+    """
+    Reads the runs of a sweep, either from a JSON file with the keys "base" (arguments of all runs), "grid"
+    (argument -> list of values, all combinations are run) and "runs" (list of additional configurations),
+    or from a shell script, e.g. scripts/01_baseline.sh, of which the train_model.py command lines are run.
+    :return: list of the command line arguments of each run
+    """
+    if path.endswith(".json"):
+        with open(path, encoding="utf-8") as f:
+            sweep = json.load(f)
+        base = sweep.get("base", dict())
+        configs = expand_grid(base, sweep["grid"]) if sweep.get("grid") else []
+        configs += [dict(base, **config) for config in sweep.get("runs", [])]
+        return [config_to_argv(config) for config in configs]
+    runs = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            tokens = shlex.split(line, comments=True)
+            scripts = [i for i, token in enumerate(tokens) if token.endswith("train_model.py")]
+            if scripts:
+                runs.append(tokens[scripts[0] + 1:])
+    return runs
+
+
+def data_key(experiment):
+    """
+    :return: the values of the data arguments of the experiment, runs with the same key share the loaded data
+    """
+    args = vars(experiment.get_args())
+    key = []
+    for name in DATA_ARGS:
+        value = args.get(name)
+        key.append(tuple(value) if isinstance(value, list) else value)
+    return tuple(key)
+
+
+def group_runs(experiments):
+    """
+    :return: ordered dictionary data key -> indices of the experiments
+    """
+    groups = OrderedDict()
+    for i, experiment in enumerate(experiments):
+        groups.setdefault(data_key(experiment), []).append(i)
+    return groups
+
+
+def _init_worker(threads):
+    torch.set_num_threads(threads)
+
+
+def _run(index, data, **kwargs):
+    """
+    Runs the experiment of the given index with the run function of the sweep
+    :param kwargs: further arguments of the run function
+    :return: dictionary with the index, the status, the duration and the results of the run function
+    """
+    run, experiment = _sweep["run"], _sweep["experiments"][index]
+    start = time.time()
+    try:
+        results = run(experiment, data, "-{:02d}".format(index), **kwargs)
+        status, error = "done", None
+    except Exception:
+        results, status, error = None, "failed", traceback.format_exc()
+    finally:
+        # the buffered logs of the run are written before the worker exits
+        BufferedFileWriter.flush_all()
+    return {"index": index, "status": status, "duration": time.time() - start, "results": results, "error": error}
+
+
+def _iterators(data):
+    """
+    :return: the iterators of the loaded data, see get_vocabularies_and_iterators
+    """
+    if not isinstance(data, (tuple, list)):
+        return []
+    # hasattr is always True for the torchtext datasets
+    return [item for item in data if isinstance(item, (Iterator, MixedBucketIterator))]
+
+
+def _run_forked(index, key, kwargs):
+    # the sweep process checks that the worker is alive until the result arrives
+    _sweep["started"].put((index, os.getpid()))
+    return _run(index, _sweep["data"][key], **kwargs)
+
+
+def _failed(index, start, error):
+    return {"index": index, "status": "failed", "duration": time.time() - start, "results": None, "error": error}
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SweepPool(object):
+    """
+    Loads the distinct data configurations of the experiments and executes their runs, used as context manager.
+    Each run is executed in a new forked worker process, which shares the loaded data. Runs on CUDA are executed
+    one by one in the sweep process, the iterators are reset to their initial state before each run.
+    """
+
+    def __init__(self, experiments, run, load, workers=1, threads=None):
+        """
+        :param experiments: list of Experiment
+        :param run: function(experiment, data, path_suffix, **kwargs) training the experiment,
+        see train_model.run_experiment
+        :param load: function(experiment) loading the data of the experiment, see get_vocabularies_and_iterators
+        :param workers: number of runs at the same time
+        :param threads: number of torch threads per run, default: the cores divided by the workers
+        """
+        self.experiments = experiments
+        self.run = run
+        self.load = load
+        self.threads = threads or max(1, (os.cpu_count() or 1) // max(1, workers))
+        self.groups = group_runs(experiments)
+        self.keys = {index: key for key, indices in self.groups.items() for index in indices}
+        on_cuda = any(experiment.get_device().type == "cuda" for experiment in experiments)
+        self.forked = workers > 1 and not on_cuda and hasattr(os, "fork")
+        self.workers = min(workers, len(experiments)) if self.forked else 1
+        if self.forked:
+            # the pool workers are daemonic, they cannot start the validation process
+            for index, experiment in enumerate(experiments):
+                if getattr(experiment, "async_val", False):
+                    print("Run {}: asynchronous validation is not available in a forked worker, "
+                          "validation runs synchronously.".format(index))
+                    experiment.async_val = False
+        self.pool = None
+        self.results = queue.Queue()
+        # forked runs without result: index -> (AsyncResult, submission time), index -> worker pid
+        self.running = dict()
+        self.pids = dict()
+        self.lost = False
+        # data key -> initial states of the iterators
+        self.iterator_states = dict()
+        self.sweep_threads = torch.get_num_threads()
+
+    def __enter__(self):
+        _sweep.update({"run": self.run, "experiments": self.experiments, "data": dict()})
+        try:
+            for key, indices in self.groups.items():
+                print("Loading the data of {} run(s)...".format(len(indices)))
+                _sweep["data"][key] = self.load(self.experiments[indices[0]])
+                self.iterator_states[key] = [get_iterator_state(iterator, end_of_epoch=True)
+                                             for iterator in _iterators(_sweep["data"][key])]
+            if self.forked:
+                # written synchronously, the pid of a worker killed right after the start is not lost
+                _sweep["started"] = multiprocessing.get_context("fork").SimpleQueue()
+                # a new worker per run: the memory of the finished run is released, the data is shared again
+                self.pool = multiprocessing.get_context("fork").Pool(
+                    self.workers, initializer=_init_worker, initargs=(self.threads,), maxtasksperchild=1)
+            else:
+                _init_worker(self.threads)
+        except BaseException:
+            self.__exit__(None, None, None)
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self.pool:
+            # a closed pool waits for the results of the lost runs
+            if exc_type or self.lost:
+                self.pool.terminate()
+            else:
+                self.pool.close()
+            self.pool.join()
+            self.pool = None
+        _sweep.clear()
+        torch.set_num_threads(self.sweep_threads)
+
+    def submit(self, index, **kwargs):
+        """
+        Starts the run of the experiment of the given index, in the sweep process it is executed right away
+        :param kwargs: further arguments of the run function
+        """
+        key = self.keys[index]
+        if self.forked:
+            start = time.time()
+            # e.g. a result which cannot be pickled
+            error_callback = functools.partial(self._on_error, index, start)
+            self.running[index] = (self.pool.apply_async(_run_forked, (index, key, kwargs), callback=self.results.put,
+                                                         error_callback=error_callback), start)
+        else:
+            # the datasets cannot be copied, the iterators of the previous run are reset instead
+            data = _sweep["data"][key]
+            for iterator, state in zip(_iterators(data), self.iterator_states[key]):
+                iterator.load_state_dict(state)
+            self.results.put(_run(index, data, **kwargs))
+
+    def _on_error(self, index, start, exception):
+        error = "".join(traceback.format_exception(type(exception), exception, exception.__traceback__))
+        self.results.put(_failed(index, start, error))
+
+    def _check_workers(self):
+        """
+        Fails the runs whose worker exited without result, e.g. killed when out of memory.
+        The pool replaces the worker but never completes its run.
+        """
+        while not _sweep["started"].empty():
+            index, pid = _sweep["started"].get()
+            self.pids[index] = pid
+        for index, (result, start) in list(self.running.items()):
+            pid = self.pids.get(index)
+            if pid is None or _is_alive(pid):
+                continue
+            # the result of a worker which just finished may still be on its way
+            result.wait(WORKER_POLL_INTERVAL)
+            if not result.ready():
+                self.lost = True
+                self.results.put(_failed(index, start, "The worker process {} of the run exited without result, "
+                                                       "e.g. killed when out of memory.".format(pid)))
+
+    def get(self):
+        """
+        :return: the result of the next finished run, see _run
+        """
+        while True:
+            try:
+                result = self.results.get(timeout=WORKER_POLL_INTERVAL if self.forked else None)
+            except queue.Empty:
+                self._check_workers()
+                continue
+            if self.forked:
+                if result["index"] not in self.running:
+                    # the run was already failed by _check_workers
+                    continue
+                del self.running[result["index"]]
+                self.pids.pop(result["index"], None)
+            return result
+
+
+def run_sweep(experiments, run, load, workers=1, threads=None, on_result=None):
+    """
+    Loads the distinct data configurations of the experiments and runs them, see SweepPool
+    :param on_result: optional function called with the result of each run when it is finished
+    :return: list of the results of the runs, see _run, in the order of the experiments
+    """
+    results = []
+    with SweepPool(experiments, run, load, workers=workers, threads=threads) as pool:
+        tasks = [index for indices in pool.groups.values() for index in indices]
+        running = 0
+        while tasks or running:
+            while tasks and running < pool.workers:
+                pool.submit(tasks.pop(0))
+                running += 1
+            results.append(pool.get())
+            running -= 1
+            if on_result:
+                on_result(results[-1])
+    return sorted(results, key=lambda result: result["index"])
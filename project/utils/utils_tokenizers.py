@@ -1,16 +1,23 @@
 """
 THis file contains all needed tokenizers for the preprocessing and training steps.
 """
+import itertools
+import multiprocessing
 import re
+from collections import deque
+
 from settings import SUPPORTED_LANGS
 from project.utils.external.tmx_to_text import glom_urls
+from project.utils.utils_functions import ordered_pool_map
 
 ### Regex ###
 space_before_punct = r'\s([?.!\'"](?:\s|$))'
 before_apos = r"\s+(['])"
 after_apos = r"(['])\s+([\w])"
-BOUNDARY_REGEX = re.compile(r'\b|\Z')  # see tmx2corpus
 TAG_REGEX = re.compile(r'<[^>]+>')
+SPACES_REGEX = re.compile(r"\s\s+")
+# the text between two word boundaries: a run of word or of non-word characters
+SEGMENT_REGEX = re.compile(r'\w+|\W+')
 
 
 ############### Tokenizers ################
@@ -28,6 +35,27 @@ class BaseSequenceTokenizer(object):
         tokens = self._tokenize(sequence)
         return tokens
 
+    def tokenize_batch(self, lines, workers=1, chunk_size=10000):
+        """
+        Tokenizes a list of sentences
+        :param lines: list of sentences
+        :param workers: number of processes, the tokenizer is sent to each of them
+        :param chunk_size: number of lines per process task
+        :return: list of token lists
+        """
+        if workers <= 1:
+            tokenize = self.tokenize
+            return [tokenize(line) for line in lines]
+        chunks = ((self, chunk) for chunk in chunk_iterator(lines, chunk_size))
+        return [tokens for result in ordered_pool_map(_tokenize_batch_chunk, chunks, workers) for tokens in result]
+
+    def detokenize(self, tokens):
+        """
+        :param tokens: list of tokens, e.g. a translation
+        :return: the text of the tokens
+        """
+        return ' '.join(tokens)
+
     def set_mode(self, only_tokenize=True):
         self.only_tokenize = only_tokenize
 
@@ -64,29 +92,61 @@ class SpacyTokenizer(BaseSequenceTokenizer):
     def _tokenize(self, sequence):
         return [tok.text for tok in self.nlp.tokenizer(sequence)]
 
+    def tokenize_batch(self, lines, workers=1, chunk_size=1000):
+        """
+        Tokenizes a list of sentences, with more than one worker through spaCy's own process pool
+        """
+        if workers <= 1:
+            return [[tok.text for tok in doc] for doc in self.nlp.tokenizer.pipe(lines, batch_size=chunk_size)]
+        # only the tokenizer is needed, the other pipes do not change the tokens
+        with self.nlp.select_pipes(disable=self.nlp.pipe_names):
+            return [[tok.text for tok in doc]
+                    for doc in self.nlp.pipe(lines, batch_size=chunk_size, n_process=workers)]
+
 class FastTokenizer(BaseSequenceTokenizer):
     def __init__(self, lang):
         super(FastTokenizer, self).__init__(lang)
 
     def _tokenize(self, sequence):
         ## Tokenizer from https://github.com/amake/TMX2Corpus/blob/master/tokenizer.py#L45
-        text = TAG_REGEX.sub('', sequence)
-        text = re.sub(r"\s\s+", " ", text)
-        tokens = []
-        i = 0
-        for m in BOUNDARY_REGEX.finditer(text):
-            tokens.append(text[i:m.start()])
-            i = m.end()
+        ## Single pass version: the segments between the word boundaries are found with one regex
+        text = SPACES_REGEX.sub(" ", TAG_REGEX.sub('', sequence))
+        tokens = SEGMENT_REGEX.findall(text)
         if '://' in text or '@' in text:
             tokens = glom_urls(tokens)
-        tokens = [tok for tok in tokens if not tok.strip() == '']
-        return ' '.join(tokens).split(" ")
+        return ' '.join([tok for tok in tokens if tok.strip()]).split(" ")
 
 
 class SplitTokenizer(BaseSequenceTokenizer):
     def _tokenize(self, text):
-        text = re.sub(r"\s\s+", " ", text)
-        return text.split(" ")
+        return SPACES_REGEX.sub(" ", text).split(" ")
+
+
+class BPETokenizer(BaseSequenceTokenizer):
+    def __init__(self, lang, bpe, word_tokenizer, lower=True):
+        """
+        :param bpe: the BPE model, see utils_bpe
+        :param word_tokenizer: tokenizer of the words segmented into subwords
+        :param lower: True if the BPE merges have been learned on lowercased text
+        """
+        super(BPETokenizer, self).__init__(lang)
+        self.type = "bpe"
+        self.bpe = bpe
+        self.word_tokenizer = word_tokenizer
+        self.lower = lower
+
+    def _tokenize(self, text):
+        if self.lower:
+            text = text.lower()
+        return self.bpe.segment(self.word_tokenizer.tokenize(text))
+
+    def detokenize(self, tokens):
+        return self.bpe.decode(tokens)
+
+
+def _tokenize_batch_chunk(args):
+    tokenizer, lines = args
+    return tokenizer.tokenize_batch(lines)
 
 
 ##### Factory method ########
@@ -135,21 +195,170 @@ def select_word_based_tokenizer(lang):
     return tokenizer
 
 
-def get_custom_tokenizer(lang, mode="w", prepro=True):
+def get_custom_tokenizer(lang, mode="w", prepro=True, bpe=None):
     """
     This function returns the tokenizer based on the configurations. The function is used either during the first preprocessing phase and during training time
     :param lang: the tokenizer language (relevant for spacy)
     :param mode: Char-based ("c") or Word-based ("w")
     :param prepro: True during the preprocessing step, False during training preprocessing
+    :param bpe: optional BPE model, the words are segmented into subwords (word-based mode only)
     :return: tokenizer
     """
     assert mode.lower() in ["c", "w"], "Please provide 'c' or 'w' as mode (char-level, word-level)."
     if prepro:
         mode = "w"
     if mode == "w" and prepro:
-        return select_word_based_tokenizer(lang)
-    elif not prepro:
-        if mode == "c":
-            return CharBasedTokenizer(lang)
+        tokenizer = select_word_based_tokenizer(lang)
+    elif mode == "c":
+        return CharBasedTokenizer(lang)
+    else:
+        tokenizer = SplitTokenizer(lang)
+    if bpe is not None:
+        return BPETokenizer(lang, bpe, tokenizer)
+    return tokenizer
+
+
+##### Parallel tokenization ########
+
+_worker_tokenizers = None
+
+
+def tokenize_lines(tokenizer, lines, batch_size=1000):
+    """
+    Tokenizes the given lines with a preprocessing tokenizer
+    :param tokenizer: a SpacyTokenizer or a FastTokenizer
+    :param lines: list of sentences
+    :param batch_size: spaCy batch size
+    :return: list of sentences with the tokens separated by a space
+    """
+    return [' '.join(tokens) for tokens in tokenizer.tokenize_batch(lines, chunk_size=batch_size)]
+
+
+def _init_tokenizer_worker(langs):
+    # each worker loads its own tokenizers, spaCy models cannot be shared between processes
+    global _worker_tokenizers
+    _worker_tokenizers = [get_custom_tokenizer(lang, "w", prepro=True) for lang in langs]
+
+
+def _tokenize_columns(tokenizers, columns):
+    return [tokenize_lines(tokenizer, column) for tokenizer, column in zip(tokenizers, columns)]
+
+
+def _tokenize_chunk(columns):
+    return _tokenize_columns(_worker_tokenizers, columns)
+
+
+def chunk_iterator(lines, chunk_size):
+    """
+    :return: generator of lists of at most chunk_size consecutive lines
+    """
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _parallel_tokenize_columns(langs, chunks, workers):
+    """
+    Tokenizes chunks made of one column of lines per language, see ordered_pool_map
+    :return: generator of the tokenized chunks, in the input order
+    """
+    chunks = iter(chunks)
+    first = next(chunks, None)
+    if first is None:
+        # nothing to tokenize, the tokenizers are not loaded
+        return
+    chunks = itertools.chain([first], chunks)
+    if workers <= 1:
+        tokenizers = [get_custom_tokenizer(lang, "w", prepro=True) for lang in langs]
+        for columns in chunks:
+            yield _tokenize_columns(tokenizers, columns)
+        return
+    for columns in ordered_pool_map(_tokenize_chunk, chunks, workers, initializer=_init_tokenizer_worker,
+                                    initargs=(langs,)):
+        yield columns
+
+
+def parallel_tokenize(lang, lines, workers=1, chunk_size=10000):
+    """
+    Tokenizes contiguous chunks of lines in a process pool, each worker loads its own tokenizer
+    :param lang: the language of the lines
+    :param lines: iterable of sentences
+    :param workers: number of processes, 1 tokenizes in the current process
+    :param chunk_size: number of lines per chunk
+    :return: generator of the tokenized chunks, in the input order
+    """
+    chunks = ([chunk] for chunk in chunk_iterator(lines, chunk_size))
+    for columns in _parallel_tokenize_columns((lang,), chunks, workers):
+        yield columns[0]
+
+
+def parallel_tokenize_pairs(src_lang, trg_lang, pairs, workers=1, chunk_size=10000, cache=None):
+    """
+    Same as parallel_tokenize for an iterable of (source, target) sentence pairs
+    :param cache: optional TokenizationCache, only the chunks missing in the cache are tokenized
+    :return: generator of chunks of tokenized (source, target) pairs, in the input order
+    """
+    chunks = (list(zip(*chunk)) for chunk in chunk_iterator(pairs, chunk_size))
+    if cache is None:
+        for src_column, trg_column in _parallel_tokenize_columns((src_lang, trg_lang), chunks, workers):
+            yield list(zip(src_column, trg_column))
+        return
+    langs, pool, tokenizers = (src_lang, trg_lang), None, None
+    # chunks in input order as (key, cached, the pending result or the columns to tokenize)
+    order = deque()
+
+    def next_chunk():
+        nonlocal tokenizers
+        key, cached, item = order.popleft()
+        if cached:
+            return list(zip(*cache.load(key)))
+        if pool is not None:
+            columns = item.get()
         else:
-            return SplitTokenizer(lang)
\ No newline at end of file
+            if tokenizers is None:
+                tokenizers = [get_custom_tokenizer(lang, "w", prepro=True) for lang in langs]
+            columns = _tokenize_columns(tokenizers, item)
+        cache.store(key, columns)
+        return list(zip(*columns))
+
+    try:
+        for columns in chunks:
+            key = cache.key(columns)
+            if cache.contains(key):
+                order.append((key, True, None))
+            elif workers > 1:
+                # the pool and the tokenizers are only loaded if a chunk is missing in the cache
+                if pool is None:
+                    pool = multiprocessing.Pool(workers, initializer=_init_tokenizer_worker, initargs=(langs,))
+                order.append((key, False, pool.apply_async(_tokenize_chunk, (columns,))))
+            else:
+                order.append((key, False, columns))
+            # the cached chunks are yielded right away, at most 2 chunks per worker are read ahead
+            while order and (order[0][1] or len(order) >= 2 * max(1, workers)):
+                yield next_chunk()
+        while order:
+            yield next_chunk()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+def tokenizer_signature(lang):
+    """
+    Identifies the preprocessing tokenizer of the language without loading it, see select_word_based_tokenizer
+    :return: spaCy model name and version, or the name of the fallback tokenizer
+    """
+    model = SUPPORTED_LANGS[lang] if lang in SUPPORTED_LANGS.keys() else "xx_ent_wiki_sm"
+    try:
+        import spacy
+        if spacy.util.is_package(model):
+            return "spacy:{}:{}".format(model, spacy.util.get_package_version(model))
+    except ImportError:
+        pass
+    return FastTokenizer.__name__
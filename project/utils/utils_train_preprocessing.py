@@ -1,11 +1,16 @@
+import math
 import os
 import time
-from collections import Counter
 
 from torchtext import datasets, data as data
 from torchtext.data import Field
 from project.utils.constants import PAD_TOKEN, UNK_TOKEN, SOS_TOKEN, EOS_TOKEN
 from project.utils.utils_tokenizers import get_custom_tokenizer
+from project.utils.utils_bpe import get_joint_bpe
+from project.utils.utils_stats import dataset_stats, format_stats, write_stats
+from project.utils.utils_cache import file_fingerprint
+from project.utils.utils_mixing import get_corpus_dir, sampling_probabilities, CorpusStream, MixedDataset, \
+    MixedBucketIterator, count_tokens
 from project.utils.utils_functions import convert_time_unit
 from project.utils.datasets import Seq2SeqDataset
 from settings import DATA_DIR_PREPRO
@@ -19,8 +24,12 @@ def get_vocabularies_and_iterators(experiment, data_dir=None, max_len=30):
     :param data_dir: the directory where data is stored in. If None, default is applied
     :param max_len: the max length, default is the sentence max length considered during tokenization process
     :return: src vocabulary, trg vocabulary, datasets and iteratotrs + sample iterator if dataset europarl is used
+    + path of the BPE codes, None without BPE
     """
 
+    if len(experiment.corpora) > 1:
+        return get_mixed_vocabularies_and_iterators(experiment, max_len=max_len)
+
     device = experiment.get_device()
 
     #### Create torchtext fields
@@ -41,17 +50,10 @@ def get_vocabularies_and_iterators(experiment, data_dir=None, max_len=30):
 
     PREPRO = False if corpus == "europarl" else True
     MODE = "w"
-
-    src_tokenizer, trg_tokenizer = get_custom_tokenizer("en", mode=MODE, prepro=PREPRO), get_custom_tokenizer(language_code, mode=MODE, prepro=PREPRO)
-
-    src_vocab = Field(tokenize=lambda s: src_tokenizer.tokenize(s), include_lengths=False,init_token=None, eos_token=None, pad_token=PAD_TOKEN, unk_token=UNK_TOKEN, lower=True)
-    trg_vocab = Field(tokenize=lambda s: trg_tokenizer.tokenize(s), include_lengths=False,init_token=SOS_TOKEN, eos_token=EOS_TOKEN, pad_token=PAD_TOKEN, unk_token=UNK_TOKEN, lower=True)
-    print("Fields created!")
-
-    ####### create splits ##########
+    file_type = experiment.tok
+    exts = ("."+experiment.get_src_lang(), "."+experiment.get_trg_lang())
 
     if corpus == "europarl":
-
         root = os.path.expanduser(DATA_DIR_PREPRO)
         if not data_dir:
             data_dir = os.path.join(root, corpus, language_code, "splits", str(max_len)) # local directory
@@ -67,10 +69,28 @@ def get_vocabularies_and_iterators(experiment, data_dir=None, max_len=30):
             print("Please run the 'preprocess.py' script for the given <lang_code> before training the model!")
             exit(-1)
 
+    bpe, bpe_codes = None, None
+    if experiment.bpe > 0:
+        if corpus != "europarl":
+            raise ValueError("BPE requires the preprocessed training files, it is not available for IWSLT.")
+        # joint merges of both languages, the vocabularies share the subwords
+        # learned on the training lines of the model, Seq2SeqDataset keeps the lines up to the index reduce
+        max_lines = reduce[0] + 1 if reduce[0] > 0 else 0
+        bpe, bpe_codes = get_joint_bpe(data_dir, ["train." + file_type + ext for ext in exts], experiment.bpe,
+                                       max_lines=max_lines)
+        print("BPE merges:", len(bpe))
+
+    src_tokenizer, trg_tokenizer = get_custom_tokenizer("en", mode=MODE, prepro=PREPRO, bpe=bpe), get_custom_tokenizer(language_code, mode=MODE, prepro=PREPRO, bpe=bpe)
+
+    src_vocab = Field(tokenize=lambda s: src_tokenizer.tokenize(s), include_lengths=False,init_token=None, eos_token=None, pad_token=PAD_TOKEN, unk_token=UNK_TOKEN, lower=True)
+    trg_vocab = Field(tokenize=lambda s: trg_tokenizer.tokenize(s), include_lengths=False,init_token=SOS_TOKEN, eos_token=EOS_TOKEN, pad_token=PAD_TOKEN, unk_token=UNK_TOKEN, lower=True)
+    print("Fields created!")
+
+    ####### create splits ##########
+
+    if corpus == "europarl":
         print("Loading data...")
         start = time.time()
-        file_type = experiment.tok
-        exts = ("."+experiment.get_src_lang(), "."+experiment.get_trg_lang())
         train, val, test = Seq2SeqDataset.splits(fields=(src_vocab, trg_vocab),
                                                  exts=exts, train="train."+file_type, validation="val."+file_type, test="test."+file_type,
                                                  path=data_dir, reduce=reduce, truncate=experiment.truncate)
@@ -102,7 +122,14 @@ def get_vocabularies_and_iterators(experiment, data_dir=None, max_len=30):
         print("Total number of sentences: {}".format((len(train) + len(val) + len(test))))
 
 
-    if voc_limit > 0:
+    if bpe is not None:
+        # all subwords the BPE can produce are kept, only unseen characters are unknown
+        max_size = voc_limit if voc_limit > 0 else None
+        subwords = [sorted(bpe.vocabulary)]
+        src_vocab.build_vocab(train.src, train.trg, subwords, min_freq=1, max_size=max_size)
+        trg_vocab.build_vocab(train.src, train.trg, subwords, min_freq=1, max_size=max_size)
+        print("Joint subword vocabularies created!")
+    elif voc_limit > 0:
         src_vocab.build_vocab(train, min_freq=min_freq, max_size=voc_limit)
         trg_vocab.build_vocab(train, min_freq=min_freq, max_size=voc_limit)
         print("Vocabularies created!")
@@ -121,7 +148,97 @@ def get_vocabularies_and_iterators(experiment, data_dir=None, max_len=30):
         samples_iter = data.Iterator(samples[0], batch_size=1, device=device, repeat=False, shuffle=False, sort_key=lambda x: (len(x.src)))
     else: samples_iter = None
 
-    return src_vocab, trg_vocab, train_iter, val_iter, test_iter, train, val, test, samples, samples_iter
+    return src_vocab, trg_vocab, train_iter, val_iter, test_iter, train, val, test, samples, samples_iter, bpe_codes
+
+
+def get_mixed_vocabularies_and_iterators(experiment, max_len=30):
+    """
+    Creates the shared vocabularies and the iterators for the mix of the preprocessed corpora of the experiment.
+    The training examples are streamed from the corpora with the sampling probabilities, see utils_mixing.
+    The validation and test splits are made of an equal share of each corpus, the samples come from the first one.
+    :return: same as get_vocabularies_and_iterators, the training dataset is a MixedDataset without examples
+    """
+    device = experiment.get_device()
+    corpora, language_code = experiment.corpora, experiment.lang_code
+    voc_limit, min_freq = experiment.voc_limit, experiment.min_freq
+    file_type = experiment.tok
+    exts = ("."+experiment.get_src_lang(), "."+experiment.get_trg_lang())
+    print("Corpora:", ", ".join(corpora))
+
+    data_dirs = [get_corpus_dir(corpus, language_code, max_len) for corpus in corpora]
+    for data_dir in data_dirs:
+        if not all(os.path.isfile(os.path.join(data_dir, "train." + file_type + ext)) for ext in exts):
+            print("ERROR: Training files not found at {}!".format(data_dir))
+            print("Please run the 'preprocess.py' script for each corpus and the given <lang_code> before training the model!")
+            exit(-1)
+    train_files = [[os.path.join(data_dir, "train." + file_type + ext) for ext in exts] for data_dir in data_dirs]
+
+    bpe, bpe_codes = None, None
+    if experiment.bpe > 0:
+        # joint merges of both languages of all corpora
+        mix_dir = os.path.join(os.path.expanduser(DATA_DIR_PREPRO), "mix", language_code, "+".join(corpora))
+        os.makedirs(mix_dir, exist_ok=True)
+        # the training files are streamed entirely
+        bpe, bpe_codes = get_joint_bpe(mix_dir, [path for paths in train_files for path in paths], experiment.bpe)
+        print("BPE merges:", len(bpe))
+
+    src_tokenizer, trg_tokenizer = get_custom_tokenizer("en", mode="w", prepro=False, bpe=bpe), get_custom_tokenizer(language_code, mode="w", prepro=False, bpe=bpe)
+
+    src_vocab = Field(tokenize=lambda s: src_tokenizer.tokenize(s), include_lengths=False,init_token=None, eos_token=None, pad_token=PAD_TOKEN, unk_token=UNK_TOKEN, lower=True)
+    trg_vocab = Field(tokenize=lambda s: trg_tokenizer.tokenize(s), include_lengths=False,init_token=SOS_TOKEN, eos_token=EOS_TOKEN, pad_token=PAD_TOKEN, unk_token=UNK_TOKEN, lower=True)
+    fields = [("src", src_vocab), ("trg", trg_vocab)]
+    print("Fields created!")
+
+    print("Loading data...")
+    start = time.time()
+    streams = [CorpusStream(corpus, paths[0], paths[1], fields, truncate=experiment.truncate)
+               for corpus, paths in zip(corpora, train_files)]
+    signature = [src_tokenizer.type, trg_tokenizer.type, file_fingerprint(bpe_codes) if bpe else None]
+    counts = [count_tokens(stream, signature) for stream in streams]
+    sizes = [pairs for _, _, pairs in counts]
+    probabilities = sampling_probabilities(sizes, experiment.corpus_weights, experiment.temperature)
+    epoch_size = experiment.train_samples if experiment.train_samples > 0 else sum(sizes)
+    train = MixedDataset(fields, corpora, sizes, probabilities, epoch_size)
+    print(train.describe())
+    print("Examples per epoch: {}".format(epoch_size))
+
+    # an equal share of each corpus, 0 for all pairs
+    shares = [int(math.ceil(n / len(corpora))) for n in experiment.reduce]
+    val_examples, test_examples = [], []
+    for data_dir in data_dirs:
+        corpus_val, corpus_test = Seq2SeqDataset.splits(fields=(src_vocab, trg_vocab), exts=exts, train="",
+                                                        validation="val."+file_type, test="test."+file_type,
+                                                        path=data_dir, reduce=shares, truncate=experiment.truncate)
+        val_examples += corpus_val.examples
+        test_examples += corpus_test.examples
+    val, test = data.Dataset(val_examples, fields), data.Dataset(test_examples, fields)
+    samples = Seq2SeqDataset.splits(fields=(src_vocab, trg_vocab), exts=exts, train="samples."+file_type,
+                                    validation="", test="", path=data_dirs[0])
+    end = time.time()
+    print("Duration: {}".format(convert_time_unit(end - start)))
+
+    # build_vocab sums the Counters of the corpora
+    src_counts, trg_counts = [c[0] for c in counts], [c[1] for c in counts]
+    max_size = voc_limit if voc_limit > 0 else None
+    if bpe is not None:
+        subwords = [sorted(bpe.vocabulary)]
+        src_vocab.build_vocab(src_counts, trg_counts, subwords, min_freq=1, max_size=max_size)
+        trg_vocab.build_vocab(src_counts, trg_counts, subwords, min_freq=1, max_size=max_size)
+        print("Joint subword vocabularies created!")
+    else:
+        src_vocab.build_vocab(src_counts, min_freq=min_freq, max_size=max_size)
+        trg_vocab.build_vocab(trg_counts, min_freq=min_freq, max_size=max_size)
+        print("Vocabularies created!")
+
+    train_iter = MixedBucketIterator(streams, train, batch_size=experiment.batch_size, device=device)
+    val_iter = data.BucketIterator(val, 1, device=device, repeat=False, sort_key=lambda x: (len(x.src)), shuffle=True)
+    test_iter = data.Iterator(test, batch_size=1, device=device, repeat=False, sort_key=lambda x: (len(x.src)), shuffle=False)
+
+    if samples[0].examples:
+        samples_iter = data.Iterator(samples[0], batch_size=1, device=device, repeat=False, shuffle=False, sort_key=lambda x: (len(x.src)))
+    else: samples_iter = None
+
+    return src_vocab, trg_vocab, train_iter, val_iter, test_iter, train, val, test, samples, samples_iter, bpe_codes
 
 
 def print_info(logger, train_data, valid_data, test_data, val_iter, test_iter, src_field, trg_field, experiment):
@@ -136,11 +253,15 @@ def print_info(logger, train_data, valid_data, test_data, val_iter, test_iter, s
     logger.log('train {}'.format(len(train_data)-1))
     logger.log('valid {}'.format(len(valid_data)-1))
     logger.log('test {}'.format(len(test_data)-1))
-    #length_checker(train_data, valid_data, test_data)
+    #length_checker(train_data, valid_data, test_data, src_field, trg_field)
 
-    logger.log("First training example:")
-    logger.log("src: {}".format(" ".join(vars(train_data[0])['src'])))
-    logger.log("trg: {}".format(" ".join(vars(train_data[0])['trg'])))
+    if isinstance(train_data, MixedDataset):
+        logger.log("Mix of corpora (pairs per epoch: {}):".format(len(train_data)))
+        logger.log(train_data.describe())
+    else:
+        logger.log("First training example:")
+        logger.log("src: {}".format(" ".join(vars(train_data[0])['src'])))
+        logger.log("trg: {}".format(" ".join(vars(train_data[0])['trg'])))
 
     logger.log("Most common words (src):")
     logger.log("\n".join(["%20s %10d" % x for x in src_field.vocab.freqs.most_common(20)]))
@@ -160,121 +281,92 @@ def print_info(logger, train_data, valid_data, test_data, val_iter, test_iter, s
     logger.log("Number of Vocabulary target words (types): {}".format(len(trg_field.vocab)))
     logger.log("")
     logger.log("###### Training dataset information #######")
-    total_src_unk = {k: v for k, v in src_field.vocab.freqs.items() if v < experiment.min_freq}
-    total_trg_unk = {k: v for k, v in trg_field.vocab.freqs.items() if v < experiment.min_freq}
+    src_freqs = np.fromiter(src_field.vocab.freqs.values(), dtype=np.int64, count=len(src_field.vocab.freqs))
+    trg_freqs = np.fromiter(trg_field.vocab.freqs.values(), dtype=np.int64, count=len(trg_field.vocab.freqs))
 
-    logger.log("Total UNKs in source vocabulary: {}".format(len(total_src_unk.keys())))
-    logger.log("Total UNKs in target vocabulary: {}".format(len(total_trg_unk.keys())))
+    logger.log("Total UNKs in source vocabulary: {}".format(int((src_freqs < experiment.min_freq).sum())))
+    logger.log("Total UNKs in target vocabulary: {}".format(int((trg_freqs < experiment.min_freq).sum())))
 
-    logger.log("Total SRC words in the training dataset: {}".format(sum(src_field.vocab.freqs.values())))
-    logger.log("Total TRG words in the training dataset: {}".format(sum(trg_field.vocab.freqs.values())))
+    logger.log("Total SRC words in the training dataset: {}".format(int(src_freqs.sum())))
+    logger.log("Total TRG words in the training dataset: {}".format(int(trg_freqs.sum())))
 
-    src_val_unks, trg_val_unks = count_unks(val_iter, src_field, trg_field)
-    src_valid_words, trg_valid_words = count_words(val_iter, src_field, trg_field)
-    src_test_unks, trg_test_unks = count_unks(test_iter, src_field, trg_field)
-    src_test_words, trg_test_words = count_words(test_iter, src_field, trg_field)
+    stats = {"val": dataset_stats(val_iter.dataset, src_field, trg_field),
+             "test": dataset_stats(test_iter.dataset, src_field, trg_field)}
+    # the streamed training examples of a mix are not held in memory
+    if train_data.examples:
+        stats = dict(train=dataset_stats(train_data, src_field, trg_field), **stats)
 
     ### Validaiton Analysis ####
     logger.log("")
     logger.log("###### Validaiton dataset information #######")
 
-    logger.log("Validaition total source UNKs: {} | Validaition total target UNKs: {} ".format(src_val_unks, trg_val_unks))
-    logger.log("Total SRC words in the test dataset: {}".format(src_valid_words + src_val_unks))
-    logger.log("Total TRG words in the test dataset: {}".format(trg_valid_words + trg_val_unks))
+    logger.log("Validaition total source UNKs: {} | Validaition total target UNKs: {} ".format(stats["val"]["src"]["unks"], stats["val"]["trg"]["unks"]))
+    logger.log("Total SRC words in the validation dataset: {}".format(stats["val"]["src"]["tokens"]))
+    logger.log("Total TRG words in the validation dataset: {}".format(stats["val"]["trg"]["tokens"]))
 
     ### Test dataset analysis ####
     logger.log("")
     logger.log("###### Test dataset information #######")
-    logger.log("Test total source UNKs: {} | Test total target UNKs: {} ".format(src_test_unks, trg_test_unks))
-
-    logger.log("Total SRC words in the test dataset: {}".format(src_test_words + src_test_unks))
-    logger.log("Total TRG words in the test dataset: {}".format(trg_test_words + trg_test_unks))
-
-
-
-def count_words(data_iter, src_vocab, trg_vocab):
-    src_words, trg_words = 0, 0
-    exclusions = [UNK_TOKEN, PAD_TOKEN, SOS_TOKEN, EOS_TOKEN]
-    for batch in data_iter:
-        src = batch.src
-        trg = batch.trg
-
-        vectorized_src = [src_vocab.vocab.itos[i] for i in src]
-        src_word = [w for w in vectorized_src if w not in exclusions]
-
-        vectorized_trg = [trg_vocab.vocab.itos[i] for i in trg]
-        trg_word = [w for w in vectorized_trg if w not in exclusions]
-
-        src_words += len(src_word)
-        trg_words += len(trg_word)
-    return src_words, trg_words
-
-def count_unks(data_iter, src_vocab, trg_vocab):
-    src_unks, trg_unks = 0, 0
-    for batch in data_iter:
-        src = batch.src
-        trg = batch.trg
-
-        vectorized_src = [src_vocab.vocab.itos[i] for i in src]
-        unk_src = [w for w in vectorized_src if w == UNK_TOKEN]
-
-        vectorized_trg = [trg_vocab.vocab.itos[i] for i in trg]
-        unk_trg= [w for w in vectorized_trg if w == UNK_TOKEN]
-        src_unks += len(unk_src)
-        trg_unks += len(unk_trg)
-    return src_unks, trg_unks
+    logger.log("Test total source UNKs: {} | Test total target UNKs: {} ".format(stats["test"]["src"]["unks"], stats["test"]["trg"]["unks"]))
 
+    logger.log("Total SRC words in the test dataset: {}".format(stats["test"]["src"]["tokens"]))
+    logger.log("Total TRG words in the test dataset: {}".format(stats["test"]["trg"]["tokens"]))
 
+    logger.log("")
+    logger.log(format_stats(stats))
+    stats_path = get_stats_path(experiment)
+    file_name = get_stats_file_name(experiment)
+    write_stats(stats_path, file_name, stats)
+    logger.log("Statistics written to {}".format(os.path.join(stats_path, file_name + ".log")))
 
 
-def length_checker(train_data, valid_data, test_data):
-    from pprint import pprint
-    ### train lengths ####
-
-    all_train_src = [elem for elem in train_data.__getattr__("src")]
-    all_train_trg = [elem for elem in train_data.__getattr__("trg")]
-
-    all_train_src_lens = list(map(lambda x: len(x), all_train_src))
-    all_train_trg_lens = list(map(lambda x: len(x), all_train_trg))
-
-    train_src_len_counter = Counter(all_train_src_lens)
-    train_trg_len_counter = Counter(all_train_trg_lens)
-
-    print("Training data lengths:")
-    print("German:")
-    pprint(train_src_len_counter.most_common(10))
-    print("English")
-    pprint(train_trg_len_counter.most_common(10))
-
-    ### validation lengths ####
-    all_val_src = [elem for elem in valid_data.__getattr__("src")]
-    all_val_trg = [elem for elem in valid_data.__getattr__("trg")]
+def get_stats_path(experiment):
+    """
+    :return: the statistics directory of the corpus, e.g. data/preprocessed/europarl/de/stats
+    """
+    if len(experiment.corpora) > 1:
+        return os.path.join(os.path.expanduser(DATA_DIR_PREPRO), "mix", experiment.lang_code, experiment.corpus, "stats")
+    if experiment.corpus == "europarl":
+        return os.path.join(os.path.expanduser(DATA_DIR_PREPRO), experiment.corpus, experiment.lang_code, "stats")
+    return os.path.join(os.path.expanduser(DATA_DIR_PREPRO), "iwslt", "stats")
 
-    all_val_src_lens = list(map(lambda x: len(x), all_val_src))
-    all_val_trg_lens = list(map(lambda x: len(x), all_val_trg))
 
-    val_src_len_counter = Counter(all_val_src_lens)
-    val_trg_len_counter = Counter(all_val_trg_lens)
+def get_stats_file_name(experiment):
+    """
+    :return: name identifying the data configuration, e.g. de_en.170000_1020_1190.v30000.min5
+    """
+    name = "{}_{}.{}.v{}.min{}".format(experiment.get_src_lang(), experiment.get_trg_lang(),
+                                       "_".join(str(n) for n in experiment.reduce), experiment.voc_limit,
+                                       experiment.min_freq)
+    if experiment.bpe > 0:
+        name += ".bpe{}".format(experiment.bpe)
+    return name
 
-    print("Validation data lenghts")
-    print("German")
-    pprint(val_src_len_counter.most_common(10))
-    print("English")
-    pprint(val_trg_len_counter.most_common(10))
 
-    ### test lengths ####
-    all_test_src = [elem for elem in test_data.__getattr__("src")]
-    all_test_trg = [elem for elem in test_data.__getattr__("trg")]
+def count_words(data_iter, src_vocab, trg_vocab):
+    """
+    :return: number of source and target tokens of the iterator dataset, without the UNKs
+    """
+    stats = dataset_stats(data_iter.dataset, src_vocab, trg_vocab)
+    return stats["src"]["tokens"] - stats["src"]["unks"], stats["trg"]["tokens"] - stats["trg"]["unks"]
 
-    all_test_src_lens = list(map(lambda x: len(x), all_test_src))
-    all_test_trg_lens = list(map(lambda x: len(x), all_test_trg))
 
-    test_src_len_counter = Counter(all_test_src_lens)
-    test_trg_len_counter = Counter(all_test_trg_lens)
+def count_unks(data_iter, src_vocab, trg_vocab):
+    """
+    :return: number of source and target UNKs of the iterator dataset
+    """
+    stats = dataset_stats(data_iter.dataset, src_vocab, trg_vocab)
+    return stats["src"]["unks"], stats["trg"]["unks"]
 
-    print("Test data lengths")
-    print("German:")
-    pprint(test_src_len_counter.most_common(10))
-    print("English:")
-    pprint(test_trg_len_counter.most_common(10))
 
+def length_checker(train_data, valid_data, test_data, src_field, trg_field, top=10):
+    """
+    Prints the most frequent sentence lengths of each split
+    """
+    for split, dataset in (("train", train_data), ("val", valid_data), ("test", test_data)):
+        stats = dataset_stats(dataset, src_field, trg_field)
+        for side in ("src", "trg"):
+            histogram = np.asarray(stats[side]["length_histogram"], dtype=np.int64)
+            common = np.argsort(-histogram, kind="stable")[:top]
+            print("{} {} lengths:".format(split, side), [(int(length), int(histogram[length])) for length in common
+                                                         if histogram[length] > 0])
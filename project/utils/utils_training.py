@@ -1,14 +1,21 @@
 """
 This script contains methods to train the model.
 """
+import math
 import os
 import time
+import traceback
 import torch
+import torch.multiprocessing as mp
+import torch.nn.functional as F
+from torchtext import data
 from project.utils.constants import EOS_TOKEN, SOS_TOKEN, PAD_TOKEN
-from project.utils.utils_metrics import AverageMeter
+from project.utils.utils_metrics import AverageMeter, BleuScorer
+from project.utils.utils_checkpoints import CheckpointSaver, get_iterator_state, get_rng_state, set_rng_state
 from project.utils.utils_functions import convert_time_unit
+from project.utils.utils_memory import memory_stats, format_memory, snapshot_largest_batch
+from project.utils.utils_profiling import ModuleProfiler, PhaseTimer, get_step_profiler
 from settings import DEFAULT_DEVICE, SEED
-from nltk.translate.bleu_score import corpus_bleu, SmoothingFunction
 from torch.optim.lr_scheduler import ReduceLROnPlateau
 
 import random
@@ -23,7 +30,8 @@ def get_gradient_norm2(m):
     :return: the total norm for the model parameters
     """
     total_norm = 0
-    for p in m.parameters():
+    # frozen parameters, e.g. pretrained embeddings, have no gradient
+    for p in filter(lambda p: p.grad is not None, m.parameters()):
         param_norm = p.grad.data.norm(2)
         total_norm += param_norm.item() ** 2
     total_norm = total_norm ** (1. / 2)
@@ -100,7 +108,9 @@ class CustomReduceLROnPlateau(ReduceLROnPlateau):
 
 def train_model(train_iter, val_iter, model, criterion, optimizer, scheduler, epochs, SRC, TRG, logger=None,
                 device=DEFAULT_DEVICE, tr_logger=None, samples_iter=None, check_translations_every=20, beam_size=5,
-                clip_value=-1):
+                clip_value=-1, async_validation=False, val_metric="bleu", ppl_every=0, bleu_every=1,
+                keep_checkpoints=0, checkpoint_every=0, resume_state=None, profile_steps=0,
+                profile_modules=False, memory_snapshot=False):
     """
     The main function to train the model
     :param train_iter: training iterator
@@ -108,7 +118,7 @@ def train_model(train_iter, val_iter, model, criterion, optimizer, scheduler, ep
     :param model: the model
     :param criterion: the loss criterion
     :param optimizer: the optimizer
-    :param scheduler: the scheduler
+    :param scheduler: the scheduler, its mode should be 'max' for BLEU and 'min' for perplexity
     :param epochs: number of epochs
     :param SRC: the source vocabulary
     :param TRG: the target vocabulary
@@ -118,14 +128,28 @@ def train_model(train_iter, val_iter, model, criterion, optimizer, scheduler, ep
     :param samples_iter: the sample translation iterator
     :param check_translations_every: when to check translation
     :param beam_size: beam size for validation
-    :return: bleu and loss scores
+    :param async_validation: validate weight snapshots in a separate process while training goes on (CPU only)
+    :param val_metric: metric used for scheduling, model saving and early stopping: 'bleu' or 'ppl'
+    :param ppl_every: compute the validation perplexity every n training steps (0: only at the end of the epoch)
+    :param bleu_every: compute the validation BLEU every n epochs, the last epoch is always validated
+    :param keep_checkpoints: number of resumable checkpoints to keep (0: no checkpoints)
+    :param checkpoint_every: save a checkpoint every n training steps, in addition to the end of each epoch
+    :param resume_state: a checkpoint loaded with load_latest_checkpoint to resume the training from
+    :param profile_steps: capture a torch.profiler trace of n training steps in the experiment directory
+    :param profile_modules: accumulate time and estimated FLOPs of the submodules, saved as module_profile.log
+    :param memory_snapshot: trace the memory of forward and backward of the largest batch before training
+    :return: bleu and loss scores, the metrics contain "stopped_early", True if the training was stopped
+    by the early stopping, e.g. before the epochs of an ASHA rung
     """
-    best_bleu_score = 0
+    assert val_metric in ["bleu", "ppl"], "Validation metric should be 'bleu' or 'ppl'"
+    lower_is_better = val_metric == "ppl"
+    metric_name = val_metric.upper()
+    best_score = float("inf") if lower_is_better else 0
     metrics = dict()
     train_losses = []
     nltk_bleus = []
+    val_ppls = []
     bleus = dict()
-    last_avg_loss = 100
     check_transl_every = check_translations_every if epochs <= 80 else check_translations_every * 2
     if samples_iter:
         print("Training with translation check.")
@@ -138,61 +162,343 @@ def train_model(train_iter, val_iter, model, criterion, optimizer, scheduler, ep
     TOLERATE_DECAYS = 2
     no_metric_improvements = 0
     print("Validation Beam: ", beam_size)
+    bleu_scorer = get_bleu_scorer(TRG)
+
+    ppl_iter = None
+    if val_metric == "ppl" or ppl_every > 0:
+        # teacher forced validation runs in batches of the training size
+        ppl_iter = data.BucketIterator(val_iter.dataset, batch_size=train_iter.batch_size, device=device,
+                                       repeat=False, sort_key=lambda x: (len(x.src), len(x.trg)),
+                                       shuffle=False, train=False)
+        logger.log("Validation metric: {}. Perplexity every {} steps, BLEU every {} epochs.".format(
+            metric_name, ppl_every if ppl_every > 0 else "epoch", bleu_every))
+
+    validator = None
+    if async_validation:
+        if val_metric != "bleu":
+            logger.log("Asynchronous validation is only used with the BLEU metric. Validation runs synchronously.")
+        elif torch.device(device).type == "cpu":
+            validator = AsyncValidator(model, val_iter, TRG, path=logger.path, beam_size=beam_size)
+            logger.log("Validation runs asynchronously in a separate process.")
+        else:
+            logger.log("Asynchronous validation is only supported on CPU. Validation runs synchronously.")
 
-    for epoch in range(epochs):
-        start_time = time.time()
-        avg_train_loss, avg_norms, first_norm = train(train_iter=train_iter, model=model, criterion=criterion,
-                                                      optimizer=optimizer, device=device, clip_value=clip_value)
-        avg_bleu_val = validate(val_iter=val_iter, model=model, device=device, TRG=TRG, beam_size=beam_size)
-
-        train_losses.append(avg_train_loss)
-        nltk_bleus.append(avg_bleu_val)
-        bleu = avg_bleu_val
-        ### scheduler monitors val loss value
-        scheduler.step(bleu)  # input bleu score
-        if bleu > best_bleu_score:
-            best_bleu_score = bleu
-            logger.save_model(model.state_dict())
-            logger.log('New best BLEU: {:.3f}'.format(best_bleu_score))
+    def on_validation(epoch, score, snapshot=None, avg_train_loss=None):
+        """
+        Feeds the validation metric of the given epoch to the scheduler, the model saving and the early stopping
+        :return: True if training should be stopped
+        """
+        nonlocal best_score, no_metric_improvements
+        state_dict = lambda: torch.load(snapshot) if snapshot else model.state_dict()
+        improved = score < best_score if lower_is_better else score > best_score
+        ### scheduler monitors the validation metric
+        scheduler.step(score)
+        if improved:
+            best_score = score
+            logger.save_model(state_dict())
+            logger.log('New best {}: {:.3f}'.format(metric_name, best_score))
             no_metric_improvements = 0
         else:
             if scheduler.get_total_decays() >= TOLERATE_DECAYS:
                 no_metric_improvements += 1
-            if avg_train_loss < last_avg_loss:
-                if epoch % CHECKPOINT == 0:
-                    logger.save_model(model.state_dict())
-                    logger.log('Training Checkpoint - BLEU: {:.3f}'.format(bleu))
-
-        last_avg_loss = avg_train_loss  # update checkpoint loss to last avg loss
+            if avg_train_loss is not None:
+                last_avg_loss = train_losses[epoch - 1] if epoch > 0 else 100
+                if avg_train_loss < last_avg_loss:
+                    if epoch % CHECKPOINT == 0:
+                        logger.save_model(state_dict())
+                        logger.log('Training Checkpoint - {}: {:.3f}'.format(metric_name, score))
+        if snapshot:
+            os.remove(snapshot)
+        return no_metric_improvements >= TOLERANCE
+
+    def on_bleu(epoch, bleu, snapshot=None):
+        nltk_bleus.append(bleu)
+        bleus.update({'nltk': nltk_bleus})
+        if snapshot:
+            logger.log('\tEpoch: {} | Val. BLEU: {:.3f}'.format(epoch + 1, bleu))
+            logger.log_metrics({"epoch": epoch + 1, "val_bleu": bleu})
+        if val_metric == "bleu":
+            return on_validation(epoch, bleu, snapshot, train_losses[epoch])
+        return False
+
+    global_step = 0
+    start_epoch = 0
+    meters = None
+    saver = CheckpointSaver(logger.path, keep=keep_checkpoints) if keep_checkpoints > 0 else None
+
+    def checkpoint(epoch, meters=None):
+        """
+        Saves a resumable checkpoint. Without meters the checkpoint refers to the beginning of the given epoch,
+        otherwise to the current position inside the epoch. Pending asynchronous validations are not part of it.
+        """
+        state = {"epoch": epoch, "global_step": global_step,
+                 "model": model.state_dict(), "optimizer": optimizer.state_dict(),
+                 "scheduler": scheduler.state_dict(),
+                 "iterator": get_iterator_state(train_iter, end_of_epoch=meters is None),
+                 "rng": get_rng_state(),
+                 "train_state": {"best_score": best_score, "no_metric_improvements": no_metric_improvements,
+                                 "train_losses": train_losses, "nltk_bleus": nltk_bleus, "val_ppls": val_ppls,
+                                 "stopped_early": stop},
+                 "meters": [vars(m) for m in meters] if meters else None}
+        saver.save(state, global_step)
+
+    if resume_state:
+        model.load_state_dict(resume_state["model"])
+        optimizer.load_state_dict(resume_state["optimizer"])
+        scheduler.load_state_dict(resume_state["scheduler"])
+        train_iter.load_state_dict(resume_state["iterator"])
+        set_rng_state(resume_state["rng"])
+        train_state = resume_state["train_state"]
+        best_score = train_state["best_score"]
+        no_metric_improvements = train_state["no_metric_improvements"]
+        train_losses.extend(train_state["train_losses"])
+        nltk_bleus.extend(train_state["nltk_bleus"])
+        val_ppls.extend(train_state["val_ppls"])
+        bleus.update({'nltk': nltk_bleus})
+        metrics.update({"loss": train_losses})
+        global_step = resume_state["global_step"]
+        start_epoch = resume_state["epoch"]
+        if resume_state["meters"]:
+            meters = [AverageMeter(), AverageMeter()]
+            for meter, meter_state in zip(meters, resume_state["meters"]):
+                meter.__dict__.update(meter_state)
+        logger.log("Training resumed at epoch {}, step {}.".format(start_epoch + 1, global_step))
+
+    profiler = get_step_profiler(logger.path, profile_steps)
+    on_cuda = torch.device(device).type == "cuda"
+    # synchronizing at each phase boundary stops CPU and GPU from overlapping, it is only done when profiling
+    timer = PhaseTimer(sync_cuda=on_cuda and (profiler is not None or profile_modules), record=profiler is not None)
+    module_profiler = ModuleProfiler(model, sync_cuda=on_cuda)
+    if profile_modules:
+        module_profiler.attach()
+
+    def on_step(epoch, losses, norms):
+        nonlocal global_step
+        global_step += 1
+        if profiler:
+            profiler.step()
+        stop = False
+        if ppl_every > 0 and global_step % ppl_every == 0:
+            with timer.phase("validation"), module_profiler.mode("eval"):
+                ppl = validate_perplexity(ppl_iter, model, device, TRG)
+            val_ppls.append(ppl)
+            logger.log('\tStep: {} | Val. PPL: {:.3f}'.format(global_step, ppl))
+            logger.log_metrics({"epoch": epoch + 1, "step": global_step, "val_ppl": ppl})
+            if val_metric == "ppl":
+                stop = on_validation(epoch, ppl)
+        if saver and checkpoint_every > 0 and global_step % checkpoint_every == 0 and not stop:
+            with timer.phase("checkpoint"):
+                checkpoint(epoch, (losses, norms))
+        return stop
+
+    # the largest batch is not known for a streamed mix of corpora
+    if memory_snapshot and train_iter.dataset.examples:
+        batch_memory = snapshot_largest_batch(train_iter.dataset, train_iter.batch_size, model, criterion, device,
+                                              logger.path)
+        logger.log_metrics(dict({"phase": "largest_batch"}, **batch_memory))
+        logger.log("Largest batch ({} x {} source tokens, {} target tokens): {}".format(
+            batch_memory["batch_size"], batch_memory["src_len"], batch_memory["trg_len"],
+            format_memory(batch_memory)))
+
+    # a training stopped early is not continued with more epochs, e.g. in the next ASHA rung
+    stop = bool(resume_state and resume_state["train_state"].get("stopped_early", False))
+    if stop:
+        logger.log("The training was stopped early, it is not continued.")
+    for epoch in range(start_epoch, start_epoch if stop else epochs):
+        start_time = time.time()
+        timer.reset()
+        with module_profiler.mode("train"):
+            avg_train_loss, avg_norms, first_norm = train(train_iter=train_iter, model=model, criterion=criterion,
+                                                          optimizer=optimizer, device=device, clip_value=clip_value,
+                                                          on_step=lambda losses, norms: on_step(epoch, losses, norms),
+                                                          meters=meters, timer=timer)
+        meters = None
+        train_time = timer.train_time()
+        train_losses.append(avg_train_loss)
+        stop = no_metric_improvements >= TOLERANCE
+
+        if val_metric == "ppl" and ppl_every <= 0:
+            with timer.phase("validation"), module_profiler.mode("eval"):
+                ppl = validate_perplexity(ppl_iter, model, device, TRG)
+            val_ppls.append(ppl)
+            stop = on_validation(epoch, ppl, avg_train_loss=avg_train_loss)
+        ppl = val_ppls[-1] if val_ppls else None
+
+        bleu = None
+        if (epoch + 1) % bleu_every == 0 or epoch == epochs - 1 or stop:
+            with timer.phase("validation"), module_profiler.mode("decode"):
+                if validator:
+                    validator.submit(epoch, model)
+                    # the results of the last epochs are part of the last checkpoint
+                    for val_epoch, val_bleu, snapshot in validator.collect(wait=epoch == epochs - 1):
+                        if not stop:
+                            stop = on_bleu(val_epoch, val_bleu, snapshot)
+                else:
+                    bleu = validate(val_iter=val_iter, model=model, device=device, TRG=TRG, beam_size=beam_size,
+                                    bleu_scorer=bleu_scorer)
+                    stop = on_bleu(epoch, bleu) or stop
 
         if epoch % check_transl_every == 0:
             #### checking translations
             if samples_iter:
-                tr_logger.log("Translation check. Epoch {}".format(epoch + 1))
-                check_translation(mini_samples, model, SRC, TRG, tr_logger)
+                with timer.phase("translation"), module_profiler.mode("decode"):
+                    tr_logger.log("Translation check. Epoch {}".format(epoch + 1))
+                    check_translation(mini_samples, model, SRC, TRG, tr_logger)
+
+        if saver:
+            with timer.phase("checkpoint"):
+                # a finished training is not continued on resume
+                checkpoint(epochs if stop else epoch + 1)
 
         end_epoch_time = time.time()
 
         total_epoch = convert_time_unit(end_epoch_time - start_time)
+        epoch_metrics = {"epoch": epoch + 1, "step": global_step, "train_loss": avg_train_loss,
+                         "val_bleu": bleu, "val_ppl": ppl, "lr": optimizer.param_groups[0]["lr"],
+                         "epoch_time": end_epoch_time - start_time, "train_time": train_time}
+        epoch_metrics.update(timer.summary())
+        memory = memory_stats(model, optimizer, device)
+        epoch_metrics["memory"] = memory
+        logger.log_metrics(epoch_metrics)
 
         logger.log('Epoch: {} | Time: {}'.format(epoch + 1, total_epoch))
-        logger.log(f'\tTrain Loss: {avg_train_loss:.3f} | Val. BLEU: {bleu:.3f}')
+        val_info = ["Val. BLEU: {}".format("{:.3f}".format(bleu) if bleu is not None else
+                                           "pending" if validator else "-")]
+        if ppl is not None:
+            val_info.append("Val. PPL: {:.3f}".format(ppl))
+        logger.log('\tTrain Loss: {:.3f} | {}'.format(avg_train_loss, " | ".join(val_info)))
         if first_norm > 0 and avg_norms > 0:
             logger.log(
                 '\tFirst batch norm value (before clip): {} | Average dataset gradient norms: {}'.format(first_norm,
                                                                                                          avg_norms))
+        logger.log('\tPhases: {}'.format(timer))
+        logger.log('\tMemory: {}'.format(format_memory(memory)))
+        if profile_modules:
+            module_profiler.save(logger.path)
 
         metrics.update({"loss": train_losses})
-        bleus.update({'nltk': nltk_bleus})
+        if val_ppls:
+            metrics.update({"ppl": val_ppls})
 
-        if no_metric_improvements >= TOLERANCE:
-            logger.log("No training improvements in the last {} epochs. Training stopped.".format(TOLERANCE))
+        if stop:
+            logger.log("No training improvements in the last {} validations. Training stopped.".format(TOLERANCE))
             break
 
+    if validator:
+        # the results pending after an early stop are dropped
+        validator.close()
+    if saver:
+        saver.close()
+    if profiler:
+        profiler.stop()
+    module_profiler.detach()
+
+    metrics.update({"stopped_early": stop})
     return bleus, metrics
 
 
-def train(train_iter, model, criterion, optimizer, device="cuda", clip_value=-1):
+class AsyncValidator(object):
+    """
+    Runs the beam search validation in a separate process.
+    After each epoch the weights are saved as snapshot in the experiment directory and handed to the worker,
+    which owns a copy of the model and of the validation iterator. Results are returned in epoch order.
+    The worker is forked, so this works only for models on the CPU.
+    """
+
+    def __init__(self, model, val_iter, TRG, path, beam_size=5, max_pending=2, num_threads=1):
+        """
+        :param model: the model, copied into the worker process
+        :param val_iter: the validation iterator
+        :param TRG: the target vocabulary
+        :param path: the experiment directory, snapshots are stored in it
+        :param beam_size: beam size for validation
+        :param max_pending: maximal number of epochs waiting for validation before training is blocked
+        :param num_threads: number of torch threads used by the worker
+        """
+        self.path = path
+        self.max_pending = max_pending
+        self.pending = 0
+        self.ready = []
+        ctx = mp.get_context("fork")
+        self.tasks = ctx.Queue()
+        self.results = ctx.Queue()
+        self.process = ctx.Process(target=_validation_worker,
+                                   args=(model, val_iter, TRG, beam_size, num_threads, self.tasks, self.results),
+                                   daemon=True)
+        self.process.start()
+
+    def submit(self, epoch, model):
+        """
+        Saves a snapshot of the current weights and queues it for validation.
+        Blocks while too many epochs are waiting for their results.
+        :param epoch: the epoch of the snapshot
+        :param model: the model
+        """
+        while self.pending >= self.max_pending:
+            self.ready.append(self._get())
+        snapshot = os.path.join(self.path, "snapshot_{}.pkl".format(epoch))
+        torch.save(model.state_dict(), snapshot)
+        self.tasks.put((epoch, snapshot))
+        self.pending += 1
+
+    def collect(self, wait=False):
+        """
+        Returns the available validation results
+        :param wait: True to wait for all pending results
+        :return: list of (epoch, bleu, snapshot path)
+        """
+        results, self.ready = self.ready, []
+        while self.pending > 0:
+            if not wait and self.results.empty():
+                break
+            results.append(self._get())
+        return results
+
+    def _get(self):
+        epoch, bleu, snapshot, error = self.results.get()
+        self.pending -= 1
+        if error:
+            self.close()
+            raise RuntimeError("Validation of epoch {} failed:\n{}".format(epoch + 1, error))
+        return epoch, bleu, snapshot
+
+    def close(self):
+        """
+        Stops the worker and removes the snapshots which have not been consumed
+        """
+        if self.process.is_alive():
+            if self.pending > 0:
+                self.process.terminate()
+            else:
+                self.tasks.put(None)
+            self.process.join()
+        for file in os.listdir(self.path):
+            if file.startswith("snapshot_") and file.endswith(".pkl"):
+                os.remove(os.path.join(self.path, file))
+
+
+def _validation_worker(model, val_iter, TRG, beam_size, num_threads, tasks, results):
+    """
+    Worker loop of the AsyncValidator
+    """
+    torch.set_num_threads(num_threads)
+    bleu_scorer = get_bleu_scorer(TRG)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        epoch, snapshot = task
+        try:
+            model.load_state_dict(torch.load(snapshot))
+            bleu = validate(val_iter=val_iter, model=model, device="cpu", TRG=TRG, beam_size=beam_size,
+                            bleu_scorer=bleu_scorer)
+            results.put((epoch, bleu, snapshot, None))
+        except Exception:
+            results.put((epoch, None, snapshot, traceback.format_exc()))
+
+
+def train(train_iter, model, criterion, optimizer, device="cuda", clip_value=-1, on_step=None, meters=None,
+          timer=None):
     """
     Train epoch step
     :param train_iter: the training iterator
@@ -200,55 +506,73 @@ def train(train_iter, model, criterion, optimizer, device="cuda", clip_value=-1)
     :param criterion: the loss criterion
     :param optimizer: the optimizer
     :param device: the devise
+    :param on_step: function called with the loss and norm meters after each optimizer step,
+    the epoch is interrupted if it returns True
+    :param meters: loss and norm meters to continue, when the epoch is resumed from a checkpoint
+    :param timer: a PhaseTimer accumulating the time of the training phases and the processed sentences and tokens
     :return: the loss and gradient statistics
     """
 
     model.train()
-    losses = AverageMeter()
-    train_iter.init_epoch()
-    norms = AverageMeter()
+    # the iterator initializes the epoch itself, also when its position has been restored
+    losses, norms = meters if meters else (AverageMeter(), AverageMeter())
+    timer = timer or PhaseTimer()
     first_norm_value = -1
     gradient_clip = 1.0  # fest
+    trg_field = train_iter.dataset.fields["trg"]
+    pad_idx = trg_field.vocab.stoi[trg_field.pad_token]
 
+    fetch_start = time.perf_counter()
     for i, batch in enumerate(train_iter):
 
         # print(device)
         # Use GPU
         src = batch.src.to(device)
         trg = batch.trg.to(device)
+        timer.add("data", time.perf_counter() - fetch_start)
 
         # Forward, backprop, optimizer
-        model.zero_grad()
-        scores = model(src, trg)  # teacher forcing during training.
-
-        scores = scores[:-1]
-        trg = trg[1:]
-
-        # Reshape for loss function
-        scores = scores.view(scores.size(0) * scores.size(1), scores.size(2))
-        # print(scores.requires_grad)
-        trg = trg.view(scores.size(0))
-
-        # Pass through loss function
-        loss = criterion(scores, trg)
-        loss.backward()
-        losses.update(loss.item())
-        if clip_value != -1.0:
-            if clip_value >= 1.0:
-                gradient_clip = clip_value
-                grad_norm = get_gradient_norm2(model)
-                norms.update(grad_norm)
-                if i == 0:
-                    first_norm_value = grad_norm
-            else:
-                gradient_clip = 1.0  # default value
-        # Clip gradient norms and step optimizer, by default: norm type = 2
-        torch.nn.utils.clip_grad_norm_(model.parameters(), gradient_clip)
-        optimizer.step()
+        with timer.phase("forward"):
+            model.zero_grad()
+            scores = model(src, trg)  # teacher forcing during training.
+
+        with timer.phase("loss"):
+            scores = scores[:-1]
+            trg = trg[1:]
+
+            # Reshape for loss function
+            scores = scores.view(scores.size(0) * scores.size(1), scores.size(2))
+            # print(scores.requires_grad)
+            trg = trg.view(scores.size(0))
+
+            # Pass through loss function
+            loss = criterion(scores, trg)
+        with timer.phase("backward"):
+            loss.backward()
+            losses.update(loss.item())
+        with timer.phase("clip"):
+            if clip_value != -1.0:
+                if clip_value >= 1.0:
+                    gradient_clip = clip_value
+                    grad_norm = get_gradient_norm2(model)
+                    norms.update(grad_norm)
+                    if i == 0:
+                        first_norm_value = grad_norm
+                else:
+                    gradient_clip = 1.0  # default value
+            # Clip gradient norms and step optimizer, by default: norm type = 2
+            torch.nn.utils.clip_grad_norm_(model.parameters(), gradient_clip)
+        with timer.phase("optimizer"):
+            optimizer.step()
+        # target tokens including the end of sentence token, summed as tensor to avoid a synchronization
+        timer.count(batch.batch_size, (trg != pad_idx).sum())
+        if on_step and on_step(losses, norms):
+            break
+        fetch_start = time.perf_counter()
     return losses.avg, norms.avg, first_norm_value
 
 
-def validate(val_iter, model, device, TRG, beam_size=5):
+def validate(val_iter, model, device, TRG, beam_size=5, bleu_scorer=None):
     """
     Validation epoch step
     :param val_iter: the validation iterator
@@ -256,45 +580,28 @@ def validate(val_iter, model, device, TRG, beam_size=5):
     :param device: the device
     :param TRG: the target vocabulary
     :param beam_size: beam size
+    :param bleu_scorer: a BleuScorer, pass the same object at each epoch to reuse the cached references
     :return: average BLEu score for the validation dataset
     """
     model.eval()
     val_iter.init_epoch()
 
-    # Iterate over words in validation batch.
-    bleu = AverageMeter()
-    sent_candidates = []  # list of sentences from decoder
-    sent_references = []  # list of target sentences
+    if bleu_scorer is None:
+        bleu_scorer = get_bleu_scorer(TRG)
+    bleu_scorer.reset()
 
-    clean_tokens = [TRG.vocab.stoi[PAD_TOKEN], TRG.vocab.stoi[SOS_TOKEN], TRG.vocab.stoi[EOS_TOKEN]]
     with torch.no_grad():
         for i, batch in enumerate(val_iter):
             # Use GPU
             src = batch.src.to(device)
-            trg = batch.trg.to(device)
             # Get model prediction (from beam search)
             out = model.predict(src, beam_size=beam_size)  ### the beam value is the best value from the baseline study
-            # print(out.size())
-            ref = list(trg.data.squeeze())
-            # Prepare sentence for bleu script
-            out = [w for w in out if w not in clean_tokens]
-            ref = [w for w in ref if w not in clean_tokens]
-            sent_out = ' '.join(TRG.vocab.itos[j] for j in out)
-            sent_ref = ' '.join(TRG.vocab.itos[j] for j in ref)
-            sent_candidates.append(sent_out)
-            sent_references.append(sent_ref)
-
-        # smoothing technique for any cases
-        smooth = SmoothingFunction()
-        nlkt_bleu = corpus_bleu(list_of_references=[[sent.split()] for sent in sent_references],
-                                hypotheses=[hyp.split() for hyp in sent_candidates],
-                                smoothing_function=smooth.method4) * 100
-        bleu.update(nlkt_bleu)
-
-    return bleu.val
-
-
-def beam_predict(model, data_iter, device, beam_size, TRG, max_len=30):
+            bleu_scorer.add(out, batch.trg.view(-1).tolist())
+
+    return bleu_scorer.score()
+
+
+def beam_predict(model, data_iter, device, beam_size, TRG, max_len=30, bleu_scorer=None):
     """
     Tests the model after training
     :param model: trained model
@@ -303,36 +610,32 @@ def beam_predict(model, data_iter, device, beam_size, TRG, max_len=30):
     :param beam_size: beam size
     :param TRG: target vocabulary
     :param max_len: max len to unroll the decoder during the prediction
+    :param bleu_scorer: a BleuScorer, reuse it to keep the cached references of the dataset
     :return: the average bleu score
     """
     model.eval()
-    sent_candidates = []
-    sent_references = []
+    if bleu_scorer is None:
+        bleu_scorer = get_bleu_scorer(TRG)
+    bleu_scorer.reset()
     with torch.no_grad():
         for i, batch in enumerate(data_iter):
             src = batch.src.to(device)
-            tgt = batch.trg.to(device)
             #### BLEU
             # compute scores with greedy search
             out = model.predict(src, beam_size=beam_size, max_len=max_len)  # out is a list
+            bleu_scorer.add(out, batch.trg.view(-1).tolist())
 
-            ## Prepare sentences for BLEU
-            ref = list(tgt.data.squeeze())
-            # Prepare sentence for bleu script
-            remove_tokens = [TRG.vocab.stoi[PAD_TOKEN], TRG.vocab.stoi[SOS_TOKEN], TRG.vocab.stoi[EOS_TOKEN]]
-            out = [w for w in out if w not in remove_tokens]
-            ref = [w for w in ref if w not in remove_tokens]
-            sent_out = ' '.join(TRG.vocab.itos[j] for j in out)
-            sent_ref = ' '.join(TRG.vocab.itos[j] for j in ref)
-            sent_candidates.append(sent_out)
-            sent_references.append(sent_ref)
-
-    smooth = SmoothingFunction()  # if there are less than 4 ngrams
-    nlkt_bleu = corpus_bleu(list_of_references=[[sent.split()] for sent in sent_references],
-                            hypotheses=[hyp.split() for hyp in sent_candidates],
-                            smoothing_function=smooth.method4) * 100
-    # print("BLEU", batch_bleu)
-    return nlkt_bleu
+    return bleu_scorer.score()
+
+
+def get_bleu_scorer(TRG):
+    """
+    Creates a BleuScorer ignoring the special tokens of the target vocabulary
+    :param TRG: the target vocabulary
+    :return: the scorer
+    """
+    remove_tokens = [TRG.vocab.stoi[PAD_TOKEN], TRG.vocab.stoi[SOS_TOKEN], TRG.vocab.stoi[EOS_TOKEN]]
+    return BleuScorer(remove_tokens=remove_tokens)
 
 
 def check_translation(samples, model, SRC, TRG, logger, persist=False):
@@ -384,30 +687,29 @@ def check_translation(samples, model, SRC, TRG, logger, persist=False):
         logger.log("*" * 100, stdout=False)
 
 
-def validate_scores_tf(val_iter, model, criterion, logger):
+def validate_perplexity(data_iter, model, device, TRG):
     """
-    Validates the validation dataset using teacher forcing (DEPRECATED)
-    :param val_iter: validatio dataset
+    Computes the teacher forced validation perplexity, padding positions are ignored.
+    The training mode of the model is restored afterwards.
+    :param data_iter: the validation iterator, batches of any size
     :param model: the model
-    :param criterion: loss criterion
-    :param logger: logger utilities
-    :return: validation loss average as cross entropy loss
+    :param device: the device
+    :param TRG: the target vocabulary
+    :return: the perplexity per target token
     """
+    was_training = model.training
     model.eval()
-    losses = AverageMeter()
-    for i, batch in enumerate(val_iter):
-        src = batch.src.to(model.device)
-        trg = batch.trg.to(model.device)
-        # Forward
-        scores = model(src, trg)
-        scores = scores[:-1]
-        trg = trg[1:]
-        # Reshape for loss function
-        scores = scores.view(scores.size(0) * scores.size(1), scores.size(2))
-        trg = trg.view(scores.size(0))
-        num_words = (trg != 0).float().sum()
-        # Calculate loss
-        loss = criterion(scores, trg)
-        losses.update(loss.data[0])
-    logger.log('Average loss on validation: {:.3f}'.format(losses.avg))
-    return losses.avg
+    data_iter.init_epoch()
+    pad_idx = TRG.vocab.stoi[PAD_TOKEN]
+    total_loss, total_tokens = 0., 0
+    with torch.no_grad():
+        for batch in data_iter:
+            src = batch.src.to(device)
+            trg = batch.trg.to(device)
+            scores = model(src, trg)[:-1]
+            trg = trg[1:]
+            total_loss += F.cross_entropy(scores.reshape(-1, scores.size(2)), trg.reshape(-1),
+                                          ignore_index=pad_idx, reduction="sum").item()
+            total_tokens += (trg != pad_idx).sum().item()
+    model.train(was_training)
+    return math.exp(total_loss / total_tokens) if total_tokens > 0 else float("inf")
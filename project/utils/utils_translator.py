@@ -3,11 +3,12 @@ import os
 import torch
 
 from project.utils.constants import UNK_TOKEN, SOS_TOKEN, EOS_TOKEN
+from project.utils.utils_profiling import TranslationStats
 
 
 class Translator(object):
     def __init__(self, model, SRC, TRG, logger, src_tokenizer,
-                 device="cuda", beam_size=5, max_len=30):
+                 device="cuda", beam_size=5, max_len=30, stats_every=100, trg_tokenizer=None):
         """
         :param model: the trained model
         :param SRC: the src vocabulary
@@ -17,6 +18,8 @@ class Translator(object):
         :param device: the device
         :param beam_size:
         :param max_len: unroll steps during prediction
+        :param stats_every: write the latency statistics to the log every n translations (0: never)
+        :param trg_tokenizer: the target tokenizer, joins the predicted tokens, e.g. the BPE subwords (None: spaces)
         """
         self.model = model
         self.src_vocab = SRC
@@ -26,25 +29,54 @@ class Translator(object):
         self.beam_size = beam_size
         self.max_len = max_len
         self.src_tokenizer = src_tokenizer
+        self.trg_tokenizer = trg_tokenizer
+        self.stats_every = stats_every
+        self.stats = TranslationStats(sync_cuda=torch.device(device).type == "cuda")
 
     def predict_sentence(self, sentence, stdout=False):
-        sentence = self.src_tokenizer.tokenize(sentence.lower())
+        stats = self.stats
+        start = stats.now()
+        with stats.stage("tokenize"):
+            sentence = self.src_tokenizer.tokenize(sentence.lower())
         #### Changed from original ###
-        sent_indices = [self.src_vocab.vocab.stoi[word] if word in self.src_vocab.vocab.stoi
-                        else self.src_vocab.vocab.stoi[UNK_TOKEN] for word in
-                        sentence]
-        sent = torch.LongTensor([sent_indices])
-        sent = sent.to(self.device)
-        sent = sent.view(-1, 1)
+        with stats.stage("numericalize"):
+            sent_indices = [self.src_vocab.vocab.stoi[word] if word in self.src_vocab.vocab.stoi
+                            else self.src_vocab.vocab.stoi[UNK_TOKEN] for word in
+                            sentence]
+            sent = torch.LongTensor([sent_indices])
+            sent = sent.to(self.device)
+            sent = sent.view(-1, 1)
         self.logger.log('SRC  >>> ' + ' '.join([self.src_vocab.vocab.itos[index] for index in sent_indices]),
                         stdout=stdout)
-        pred = self.model.predict(sent, beam_size=self.beam_size, max_len=self.max_len)
-        pred = [index for index in pred if index not in [self.trg_vocab.vocab.stoi[SOS_TOKEN],
-                                                         self.trg_vocab.vocab.stoi[EOS_TOKEN]]]
-        out = ' '.join(self.trg_vocab.vocab.itos[idx] for idx in pred)
+        pred = self.model.predict(sent, beam_size=self.beam_size, max_len=self.max_len, stats=stats)
+        with stats.stage("detokenize"):
+            pred = [index for index in pred if index not in [self.trg_vocab.vocab.stoi[SOS_TOKEN],
+                                                             self.trg_vocab.vocab.stoi[EOS_TOKEN]]]
+            tokens = [self.trg_vocab.vocab.itos[idx] for idx in pred]
+            out = self.trg_tokenizer.detokenize(tokens) if self.trg_tokenizer else ' '.join(tokens)
+        stats.add("total", stats.now() - start)
+        stats.add_request()
         self.logger.log('PRED >>> ' + out, stdout=True)
+        if self.stats_every > 0 and stats.requests % self.stats_every == 0:
+            self.log_stats()
         return out
 
+    def get_stats(self):
+        """
+        :return: dictionary with the latency percentiles per stage in seconds, the decode steps and the beam occupancy
+        """
+        return self.stats.summary()
+
+    def log_stats(self, stdout=False):
+        """
+        Writes the latency statistics to the translation log and to translation_stats.jsonl
+        """
+        if not self.stats.requests:
+            return
+        self.logger.log("Translation latency after {} requests:\n{}".format(self.stats.requests, self.stats),
+                        stdout=stdout)
+        self.logger.log_metrics(self.get_stats(), file_name="translation_stats.jsonl")
+
     def predict_from_text(self, path_to_file):
         path_to_file = os.path.expanduser(path_to_file)
         self.logger.log("Predictions from file: {}".format(path_to_file))
@@ -56,6 +88,7 @@ class Translator(object):
         for sample in samples:
             out = self.predict_sentence(sample, stdout=True)
             self.logger.log("-" * 100, stdout=True)
+        self.log_stats(stdout=True)
 
     def set_beam_size(self, new_size):
         self.beam_size = new_size
@@ -4,6 +4,13 @@ testmodules = [
     'test.test_converter',
     'test.test_tokenizers',
     'test.test_utils',
+    'test.test_metrics',
+    'test.test_training',
+    'test.test_benchmarks',
+    'test.test_retrieve_corpora',
+    'test.test_embeddings',
+    'test.test_mixing',
+    'test.test_sweep',
     'test.test_translator',
     'test.parsers.test_translation_parser',
     'test.parsers.test_training_parser',
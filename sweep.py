@@ -0,0 +1,85 @@
+"""
+Script to run a sweep of nmt experiments in parallel, see project/utils/utils_sweep.py and utils_asha.py
+
+Examples:
+    python sweep.py scripts/01_baseline.sh --workers 4
+    python sweep.py sweep.json --workers 6 --threads 2
+    python sweep.py sweep.json --workers 6 --asha True --min_epochs 2 --eta 3
+
+with sweep.json, e.g.: {"base": {"epochs": 80, "rnn": "lstm"}, "grid": {"lr": [0.002, 0.0002], "num_layers": [2, 4]}}
+"""
+import argparse
+import datetime
+import json
+import os
+import sys
+
+from project.utils.experiment import Experiment
+from project.utils.utils_asha import run_asha
+from project.utils.utils_functions import str2bool
+from project.utils.utils_sweep import read_sweep, run_sweep
+from project.utils.utils_train_preprocessing import get_vocabularies_and_iterators
+from settings import MODEL_STORE
+from train_model import experiment_parser, run_experiment
+
+
+def sweep_parser():
+    parser = argparse.ArgumentParser(description='Sweep of NMT experiments')
+    parser.add_argument('sweep', type=str,
+                        help="JSON file with the base arguments and the grid or list of runs, or a shell script with train_model.py command lines")
+    parser.add_argument('--workers', default=1, type=int, metavar='N',
+                        help="Number of runs trained at the same time, each in its own process. Default: 1")
+    parser.add_argument('--threads', default=0, type=int, metavar='N',
+                        help="Number of torch threads per run. Default: 0, the cores divided by the workers")
+    parser.add_argument('--asha', type=str2bool, default=False,
+                        help="Stop the worst runs early with asynchronous successive halving: the runs are trained in rungs of increasing epochs, only the best 1/eta of each rung continue from their checkpoint. Default: False")
+    parser.add_argument('--min_epochs', default=2, type=int, metavar='N',
+                        help="ASHA: number of epochs of the first rung. Default: 2")
+    parser.add_argument('--eta', default=3, type=int, metavar='N',
+                        help="ASHA: reduction factor, the epochs of each rung are multiplied by it. Default: 3")
+    return parser
+
+
+def load_data(experiment):
+    return get_vocabularies_and_iterators(experiment, experiment.data_dir)
+
+
+def main():
+    args = sweep_parser().parse_args()
+    runs = read_sweep(args.sweep)
+    parser = experiment_parser()
+    experiments = [Experiment(parser.parse_args(argv)) for argv in runs]
+    print("{} runs in {}".format(len(experiments), args.sweep))
+
+    sweep_path = os.path.join(MODEL_STORE, "sweeps", datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S"))
+    os.makedirs(sweep_path, exist_ok=True)
+    summary_file = os.path.join(sweep_path, "runs.jsonl")
+
+    def on_result(result):
+        result = dict(result, args=runs[result["index"]])
+        with open(summary_file, "a", encoding="utf-8") as f:
+            f.write(json.dumps(result) + "\n")
+        print("Run {} {} in {:.0f}s: {}".format(result["index"], result["status"], result["duration"],
+                                                result["results"] if result["results"] else result["error"]))
+
+    if args.asha:
+        trials = run_asha(experiments, run_experiment, load_data, workers=args.workers, threads=args.threads,
+                          min_epochs=args.min_epochs, eta=args.eta, on_result=on_result)
+        trials_file = os.path.join(sweep_path, "trials.jsonl")
+        with open(trials_file, "w", encoding="utf-8") as f:
+            for trial in trials:
+                f.write(json.dumps(dict(trial, args=runs[trial["index"]])) + "\n")
+        for trial in trials:
+            print("Run {} {} after {} epochs, validation score: {}, {}".format(
+                trial["index"], trial["status"], trial["epochs"], trial["score"], trial["path"]))
+        print("Sweep finished. Summary: {}".format(trials_file))
+        return
+    results = run_sweep(experiments, run_experiment, load_data, workers=args.workers, threads=args.threads,
+                        on_result=on_result)
+    failed = [result["index"] for result in results if result["status"] != "done"]
+    print("Sweep finished, {} of {} runs failed. Summary: {}".format(len(failed), len(results), summary_file))
+
+
+if __name__ == '__main__':
+    print(' '.join(sys.argv))
+    main()
@@ -0,0 +1,31 @@
+import unittest
+
+from benchmarks.run_benchmarks import compare_results
+from benchmarks.suite import run_benchmarks
+from benchmarks.synthetic import SyntheticCorpus
+
+
+class TestBenchmarks(unittest.TestCase):
+
+    def test_synthetic_corpus_is_reproducible(self):
+        corpus = SyntheticCorpus(20, vocab_size=100, seed=1)
+        self.assertEqual(corpus.src, SyntheticCorpus(20, vocab_size=100, seed=1).src)
+        self.assertEqual(len(corpus.tokenized_lines("trg")), 20)
+        for line in corpus.tokenized_lines("src"):
+            self.assertLessEqual(len(line.split(" ")), 2 * corpus.max_len + 1)
+
+    def test_run_subset(self):
+        results = run_benchmarks(scale="small", names=["split_tokenizer", "bleu"], repeat=1)
+        self.assertEqual(list(results), ["split_tokenizer", "bleu"])
+        for result in results.values():
+            self.assertGreater(result["throughput"], 0)
+
+    def test_compare_flags_regressions(self):
+        baseline = {"results": {"a": {"median": 1.0}, "b": {"median": 1.0}, "c": {"median": 1.0}}}
+        current = {"results": {"a": {"median": 1.05}, "b": {"median": 1.5}, "d": {"median": 1.0}}}
+        status = {row[0]: row[4] for row in compare_results(baseline, current, threshold=0.1)}
+        self.assertEqual(status, {"a": "ok", "b": "REGRESSION", "c": "missing", "d": "new"})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,9 @@
+import gzip
 import os
+import shutil
+import tempfile
 import unittest
-from project.utils.external.tmx_to_text import FileOutput, Converter
+from project.utils.external.tmx_to_text import FileOutput, Converter, extract_tmx, iter_tmx_shards
 
 data_dir = os.path.expanduser(os.path.join(".", "test", "test_data"))
 print(data_dir)
@@ -30,4 +33,46 @@ class TestTmxToTxt(unittest.TestCase):
         en_line = open(os.path.join(data_dir, files[1])).read().strip("\n")
         set1 = set(en_line.split(' '))
         set2 = set(EN.split(' '))
-        self.assertEqual(set1, set2)
\ No newline at end of file
+        self.assertEqual(set1, set2)
+
+    def test_gzip_extraction(self):
+        path = tempfile.mkdtemp()
+        try:
+            file = os.path.join(path, "test.tmx.gz")
+            with open(os.path.join(data_dir, "test.tmx"), "rb") as tmx, gzip.open(file, "wb") as gz:
+                shutil.copyfileobj(tmx, gz)
+            with Converter(output=FileOutput(path=path)) as converter:
+                converter.convert(files=[file])
+            self.assertEqual(converter.output_lines, 1)
+            self.assertEqual(open(os.path.join(path, "bitext.de"), encoding="utf-8").read(), DE + "\n")
+            self.assertEqual(open(os.path.join(path, "bitext.en"), encoding="utf-8").read(), EN + "\n")
+            self.assertEqual(list(extract_tmx(file)), list(extract_tmx(os.path.join(data_dir, "test.tmx"))))
+        finally:
+            shutil.rmtree(path)
+
+    def test_sharded_extraction(self):
+        path = tempfile.mkdtemp()
+        try:
+            file = os.path.join(path, "units.tmx")
+            with open(file, "w", encoding="utf-8") as tmx:
+                tmx.write('<?xml version="1.0" encoding="UTF-8"?>\n<tmx version="1.4"><header/><body>\n')
+                for i in range(50):
+                    tmx.write('<tu><tuv xml:lang="de"><seg>Satz {0} &amp; mehr</seg></tuv>'
+                              '<tuv xml:lang="en"><seg>Sentence {0}</seg></tuv></tu>\n'.format(i))
+                tmx.write('</body></tmx>\n')
+            shards = list(iter_tmx_shards(file, shard_size=300))
+            self.assertGreater(len(shards), 1)
+            self.assertTrue(all(shard.startswith(b"<tu>") for shard in shards))
+            outputs = []
+            for workers in [1, 2]:
+                output_path = os.path.join(path, str(workers))
+                os.makedirs(output_path)
+                with Converter(output=FileOutput(path=output_path)) as converter:
+                    converter.convert(files=[file], workers=workers, shard_size=300)
+                self.assertEqual(converter.output_lines, 50)
+                outputs.append([open(os.path.join(output_path, "bitext." + lang), encoding="utf-8").read()
+                                for lang in ["de", "en"]])
+            self.assertEqual(outputs[0], outputs[1])
+            self.assertTrue(outputs[1][0].startswith("Satz 0 & mehr\nSatz 1 & mehr\n"))
+        finally:
+            shutil.rmtree(path)
@@ -0,0 +1,75 @@
+import functools
+import gzip
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch.nn as nn
+
+from project.utils.utils_embeddings import extract_vectors, load_pretrained_vectors, init_embedding
+
+VECTORS = [("the", [0.1, 0.2, 0.3]), ("House", [0.4, 0.5, 0.6]), ("house", [0.7, 0.8, 0.9]),
+           ("small", [-0.1, -0.2, -0.3]), ("garden", [1.0, 1.1, 1.2])]
+ITOS = ["<unk>", "<pad>", "the", "house", "small", "hou@@", "unseen"]
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class TestEmbeddings(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.served = os.path.join(self.path, "served")
+        os.makedirs(self.served)
+        self.vec_file = os.path.join(self.served, "cc.en.3.vec.gz")
+        with gzip.open(self.vec_file, "wt", encoding="utf-8") as f:
+            f.write("{} 3\n".format(len(VECTORS)))
+            for word, vector in VECTORS:
+                f.write("{} {}\n".format(word, " ".join(str(v) for v in vector)))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_extract_vectors(self):
+        vectors, found = extract_vectors(self.vec_file, ITOS)
+        self.assertEqual(vectors.shape, (len(ITOS), 3))
+        self.assertEqual(vectors.dtype, np.float32)
+        self.assertEqual(found.tolist(), [False, False, True, True, True, False, False])
+        # the first (most frequent) spelling is used
+        np.testing.assert_allclose(vectors[3], [0.4, 0.5, 0.6])
+        np.testing.assert_allclose(vectors[4], [-0.1, -0.2, -0.3])
+
+    def test_cached_vectors(self):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(QuietHandler, directory=self.served))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            url = "http://127.0.0.1:{}/cc.en.3.vec.gz".format(server.server_address[1])
+            vectors, info = load_pretrained_vectors(ITOS, url, path=self.path)
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual((info["size"], info["found"]), (len(ITOS), 3))
+        self.assertIsInstance(vectors, np.memmap)
+        # the server is down, the vectors of the vocabulary are loaded from the cache
+        cached, _ = load_pretrained_vectors(ITOS, url, path=self.path)
+        np.testing.assert_array_equal(np.asarray(cached), np.asarray(vectors))
+
+    def test_init_embedding(self):
+        vectors, _ = extract_vectors(self.vec_file, ITOS)
+        embedding = nn.Embedding(len(ITOS), 3)
+        init_embedding(embedding, vectors, freeze=True)
+        np.testing.assert_allclose(embedding.weight.detach().numpy(), vectors)
+        self.assertFalse(embedding.weight.requires_grad)
+        with self.assertRaises(ValueError):
+            init_embedding(nn.Embedding(len(ITOS), 4), vectors)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,8 @@
 import unittest
 
+from project.model.models import get_nmt_model, count_trainable_params
 from project.utils.experiment import Experiment
+from project.utils.utils_cost_model import plan_experiment, estimate_cost
 from train_model import experiment_parser
 
 
@@ -42,3 +44,31 @@ class ExperimentTest(unittest.TestCase):
             self.assertEqual(parsed.bi, False)
             self.assertEqual(experiment.reverse_input, True)
 
+
+class CostModelTest(unittest.TestCase):
+
+    def get_experiment(self, *args):
+        experiment = Experiment(experiment_parser().parse_args(list(args) + ["--cuda", "False"]))
+        experiment.model_type = "custom"
+        return experiment
+
+    def test_parameters_match_model(self):
+        configs = [["--hs", "32", "--emb", "16", "--v", "100"],
+                   ["--hs", "32", "--emb", "16", "--v", "100", "--bi", "False", "--num_layers", "3"],
+                   ["--hs", "24", "--emb", "24", "--v", "50", "--rnn", "gru", "--tied", "True"],
+                   ["--hs", "16", "--emb", "8", "--v", "80", "--attn", "none"]]
+        for config in configs:
+            experiment = self.get_experiment(*config)
+            experiment.src_vocab_size, experiment.trg_vocab_size = 104, 90
+            cost = estimate_cost(experiment, 104, 90, src_len=10, trg_len=12, batch_size=4)
+            model = get_nmt_model(experiment, [0, 1, 2, 3])
+            self.assertEqual(cost["params"], count_trainable_params(model), config)
+
+    def test_plan_scales(self):
+        small = plan_experiment(self.get_experiment("--hs", "128", "--v", "1000"), flops_per_second=1e9)
+        large = plan_experiment(self.get_experiment("--hs", "512", "--v", "1000"), flops_per_second=1e9)
+        self.assertEqual(small["src_vocab_size"], 1004)
+        self.assertGreater(large["train_flops_per_token"], small["train_flops_per_token"])
+        self.assertGreater(large["train_memory_bytes"], small["train_memory_bytes"])
+        self.assertLess(large["tokens_per_sec"], small["tokens_per_sec"])
+        self.assertIn("epoch_time", small)
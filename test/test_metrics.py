@@ -0,0 +1,56 @@
+import random
+import unittest
+
+from nltk.translate.bleu_score import corpus_bleu, SmoothingFunction
+
+from project.utils.utils_metrics import BleuScorer
+
+
+def nltk_bleu(hypotheses, references):
+    return corpus_bleu(list_of_references=[[ref] for ref in references], hypotheses=hypotheses,
+                       smoothing_function=SmoothingFunction().method4) * 100
+
+
+class TestBleuScorer(unittest.TestCase):
+
+    def setUp(self):
+        rnd = random.Random(42)
+        self.references = [[rnd.randint(4, 30) for _ in range(rnd.randint(1, 20))] for _ in range(50)]
+        self.hypotheses = [[w if rnd.random() > 0.3 else rnd.randint(4, 30) for w in ref[:rnd.randint(0, len(ref) + 3)]]
+                           for ref in self.references]
+
+    def test_matches_nltk(self):
+        scorer = BleuScorer()
+        scorer.add_batch(self.hypotheses, self.references)
+        self.assertAlmostEqual(scorer.score(), nltk_bleu(self.hypotheses, self.references), places=10)
+
+    def test_short_and_empty_hypotheses(self):
+        hypotheses = [[5], [], [6, 7]]
+        references = [[5, 6, 7], [8, 9], [6, 7, 8, 9, 10]]
+        scorer = BleuScorer()
+        scorer.add_batch(hypotheses, references)
+        self.assertAlmostEqual(scorer.score(), nltk_bleu(hypotheses, references), places=10)
+        scorer.reset()
+        scorer.add([1, 2], [3, 4])
+        self.assertEqual(scorer.score(), 0)
+
+    def test_remove_tokens(self):
+        pad, sos, eos = 1, 2, 3
+        scorer = BleuScorer(remove_tokens=[pad, sos, eos])
+        scorer.add([sos] + self.hypotheses[0] + [eos], [sos] + self.references[0] + [eos, pad, pad])
+        self.assertAlmostEqual(scorer.score(), nltk_bleu(self.hypotheses[:1], self.references[:1]), places=10)
+
+    def test_reference_cache(self):
+        scorer = BleuScorer()
+        scorer.cache_references(self.references)
+        cached = len(scorer.ref_cache)
+        for epoch in range(2):
+            scorer.reset()
+            scorer.add_batch(self.hypotheses, self.references)
+            self.assertEqual(len(scorer.ref_cache), cached)
+            self.assertEqual(scorer.count, len(self.hypotheses))
+        self.assertAlmostEqual(scorer.score(), nltk_bleu(self.hypotheses, self.references), places=10)
+
+
+if __name__ == '__main__':
+    unittest.main()
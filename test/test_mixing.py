@@ -0,0 +1,98 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+from torchtext.data import Field
+
+from project.utils.utils_mixing import sampling_probabilities, CorpusStream, MixedDataset, MixedBucketIterator, \
+    count_tokens
+
+
+def write_corpus(path, name, size):
+    src_path, trg_path = os.path.join(path, name + ".en"), os.path.join(path, name + ".de")
+    with open(src_path, "w", encoding="utf-8") as src, open(trg_path, "w", encoding="utf-8") as trg:
+        for i in range(size):
+            length = 1 + i % 7
+            src.write(" ".join([name] * length) + " {}\n".format(i))
+            trg.write(" ".join([name.upper()] * length) + " {}\n".format(i))
+    return src_path, trg_path
+
+
+class TestMixing(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        field = Field(tokenize=str.split, lower=True)
+        self.fields = [("src", field), ("trg", field)]
+        self.sizes = {"big": 300, "small": 30}
+        self.streams = [CorpusStream(name, *write_corpus(self.path, name, size), self.fields)
+                        for name, size in self.sizes.items()]
+        field.build_vocab([count_tokens(stream, "split")[0] for stream in self.streams])
+
+    def tearDown(self):
+        for stream in self.streams:
+            stream.close()
+        shutil.rmtree(self.path)
+
+    def get_iterator(self, probabilities, streams=None, epoch_size=200, batch_size=8, pool_batches=5):
+        dataset = MixedDataset(self.fields, list(self.sizes), list(self.sizes.values()), probabilities, epoch_size)
+        return MixedBucketIterator(streams or self.streams, dataset, batch_size, device="cpu",
+                                   pool_batches=pool_batches, seed=3)
+
+    def test_sampling_probabilities(self):
+        np.testing.assert_allclose(sampling_probabilities([300, 100]), [0.75, 0.25])
+        np.testing.assert_allclose(sampling_probabilities([300, 100], temperature=1e9), [0.5, 0.5])
+        np.testing.assert_allclose(sampling_probabilities([400, 100], temperature=2.0), [2 / 3, 1 / 3])
+        np.testing.assert_allclose(sampling_probabilities([300, 100], weights=[1, 3]), [0.25, 0.75])
+        with self.assertRaises(ValueError):
+            sampling_probabilities([300, 100], weights=[1])
+
+    def test_stream_wraps_around(self):
+        stream = self.streams[1]
+        examples = stream.read(45)
+        self.assertEqual(stream.passes, 1)
+        self.assertEqual([e.src[-1] for e in examples[28:32]], ["28", "29", "0", "1"])
+
+    def test_epoch(self):
+        data_iter = self.get_iterator([0.5, 0.5])
+        batches = list(data_iter)
+        self.assertEqual(len(batches), len(data_iter))
+        self.assertEqual(sum(batch.batch_size for batch in batches), 200)
+        # the small corpus is sampled much more often than its share of the pairs
+        small_id = self.fields[0][1].vocab.stoi["small"]
+        small = sum(int((batch.src[0] == small_id).sum()) for batch in batches)
+        self.assertGreater(small, 60)
+        self.assertGreaterEqual(self.streams[1].passes, 2)
+
+    def test_resume(self):
+        data_iter = self.get_iterator([0.6, 0.4])
+        list(data_iter)
+        iterator = iter(data_iter)
+        for _ in range(7):
+            next(iterator)
+        # the state is saved in the checkpoints, it is loaded with weights_only=True
+        checkpoint = os.path.join(self.path, "checkpoint.pt")
+        torch.save(data_iter.state_dict(), checkpoint)
+        state = torch.load(checkpoint, weights_only=True)
+        expected = [batch.src.tolist() for batch in iterator]
+
+        streams = [CorpusStream(stream.name, *stream.paths, self.fields) for stream in self.streams]
+        self.streams += streams
+        resumed = self.get_iterator([0.6, 0.4], streams=streams)
+        resumed.load_state_dict(state)
+        self.assertEqual([batch.src.tolist() for batch in resumed], expected)
+        self.assertEqual(resumed.iterations, data_iter.iterations)
+        # the next epoch starts from the same position
+        self.assertEqual([batch.src.tolist() for batch in resumed], [batch.src.tolist() for batch in data_iter])
+
+    def test_count_tokens(self):
+        src_counts, trg_counts, pairs = count_tokens(self.streams[1], "split")
+        self.assertEqual(pairs, 30)
+        self.assertEqual(src_counts["small"], sum(1 + i % 7 for i in range(30)))
+        self.assertEqual(trg_counts["small"], sum(1 + i % 7 for i in range(30)))
+        # the counts are loaded from the cache
+        self.assertEqual(count_tokens(self.streams[1], "split"), (src_counts, trg_counts, pairs))
+        self.assertEqual(len(os.listdir(os.path.join(self.path, "cache", "token_counts"))), 2)
@@ -0,0 +1,105 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from project.utils.utils_retrieve_corpora import download_file, read_checksum
+
+DATA = os.urandom(300000)
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """
+    Serves DATA with support for Range requests, the first response is cut after `fail_after` bytes
+    """
+    fail_after = None
+    ranges = []
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(DATA)))
+        self.end_headers()
+
+    def do_GET(self):
+        start = 0
+        header = self.headers.get("Range")
+        if header:
+            start = int(header.split("=")[1].split("-")[0])
+        RangeHandler.ranges.append(start)
+        if start >= len(DATA):
+            self.send_response(416)
+            self.end_headers()
+            return
+        body = DATA[start:]
+        self.send_response(206 if header else 200)
+        self.send_header("Content-Length", str(len(body)))
+        if header:
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start, len(DATA) - 1, len(DATA)))
+        self.end_headers()
+        if RangeHandler.fail_after is not None:
+            body, RangeHandler.fail_after = body[:RangeHandler.fail_after], None
+        self.wfile.write(body)
+
+
+class TestDownloader(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = "http://127.0.0.1:{}/en-de.tmx.gz".format(cls.server.server_address[1])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.file = os.path.join(self.path, "en-de.tmx.gz")
+        RangeHandler.ranges = []
+        RangeHandler.fail_after = None
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_download(self):
+        sha256 = hashlib.sha256(DATA).hexdigest()
+        download_file(self.url, self.file, sha256=sha256, chunk_size=4096, progress=False)
+        self.assertEqual(open(self.file, "rb").read(), DATA)
+        self.assertEqual(read_checksum(self.file), sha256)
+        # a completed download is not fetched again
+        download_file(self.url, self.file, progress=False)
+        self.assertEqual(RangeHandler.ranges, [0])
+
+    def test_resume_after_interruption(self):
+        RangeHandler.fail_after = 100000
+        download_file(self.url, self.file, sha256=hashlib.sha256(DATA).hexdigest(), chunk_size=4096,
+                      backoff=0.01, progress=False)
+        self.assertEqual(open(self.file, "rb").read(), DATA)
+        self.assertEqual(RangeHandler.ranges, [0, 100000])
+        self.assertFalse(os.path.exists(self.file + ".part"))
+
+    def test_resume_partial_file(self):
+        # partial file of a previous run, saved without checksum
+        with open(self.file, "wb") as f:
+            f.write(DATA[:1234])
+        download_file(self.url, self.file, progress=False)
+        self.assertEqual(open(self.file, "rb").read(), DATA)
+        self.assertEqual(RangeHandler.ranges, [1234])
+
+    def test_checksum_mismatch(self):
+        with self.assertRaises(IOError):
+            download_file(self.url, self.file, sha256="0" * 64, progress=False)
+        self.assertFalse(os.path.exists(self.file))
+        self.assertFalse(os.path.exists(self.file + ".part"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,255 @@
+import json
+import os
+import shutil
+import signal
+import tempfile
+import unittest
+
+import torch
+from torchtext.data import BucketIterator, Dataset, Example, Field
+
+from project.utils.experiment import Experiment
+from project.utils.utils_asha import get_rungs, SuccessiveHalving, read_validation_scores, best_score, run_asha
+from project.utils import utils_sweep
+from project.utils.utils_sweep import read_sweep, group_runs, run_sweep
+from project.utils.utils_train_preprocessing import get_vocabularies_and_iterators
+from train_model import experiment_parser
+
+SCRIPT = """#!/usr/bin/env bash
+echo "0.002"
+python3 train_model.py --lr 0.002 --rnn gru --cuda False  # baseline
+python3 train_model.py --lr 0.002 --rnn lstm --cuda False --corpus europarl tatoeba
+"""
+
+
+def load(experiment):
+    field = Field(tokenize=str.split)
+    fields = [("src", field), ("trg", field)]
+    examples = [Example.fromlist(["w{} x y".format(i), "z w{}".format(i)], fields) for i in range(50)]
+    dataset = Dataset(examples, fields)
+    field.build_vocab(dataset)
+    iterator = BucketIterator(dataset, batch_size=experiment.batch_size, device="cpu", repeat=False,
+                              sort_key=lambda x: len(x.src), shuffle=True)
+    return field, dataset, iterator, os.getpid()
+
+
+def run(experiment, data, path_suffix):
+    if experiment.rnn_type == "fail":
+        raise ValueError("unknown rnn")
+    if experiment.rnn_type == "kill":
+        # e.g. killed when out of memory
+        os.kill(os.getpid(), signal.SIGKILL)
+    if experiment.rnn_type == "unpicklable":
+        return {"suffix": path_suffix, "model": lambda x: x}
+    field, dataset, iterator, loaded_by = data
+    # the first batch depends on the state of the iterator
+    started_at = iterator.iterations
+    first_batch = next(iter(iterator)).src.tolist()
+    return {"suffix": path_suffix, "lr": experiment.lr, "threads": torch.get_num_threads(),
+            "async_val": experiment.async_val,
+            "pids": [loaded_by, os.getpid()], "started_at": started_at, "first_batch": first_batch}
+
+
+class TestSweep(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def get_experiments(self, runs):
+        parser = experiment_parser()
+        return [Experiment(parser.parse_args(argv)) for argv in runs]
+
+    def test_read_script(self):
+        path = os.path.join(self.path, "sweep.sh")
+        with open(path, "w") as f:
+            f.write(SCRIPT)
+        runs = read_sweep(path)
+        self.assertEqual(runs, [["--lr", "0.002", "--rnn", "gru", "--cuda", "False"],
+                                ["--lr", "0.002", "--rnn", "lstm", "--cuda", "False", "--corpus", "europarl",
+                                 "tatoeba"]])
+        experiments = self.get_experiments(runs)
+        self.assertEqual(experiments[1].corpora, ["europarl", "tatoeba"])
+        self.assertEqual(len(group_runs(experiments)), 2)
+
+    def test_read_grid(self):
+        path = os.path.join(self.path, "sweep.json")
+        with open(path, "w") as f:
+            json.dump({"base": {"cuda": False, "b": 32}, "grid": {"lr": [0.1, 0.01], "rnn": ["gru", "lstm"]},
+                       "runs": [{"lr": 0.1, "b": 64}]}, f)
+        runs = read_sweep(path)
+        self.assertEqual(len(runs), 5)
+        self.assertEqual(runs[1], ["--cuda", "False", "--b", "32", "--lr", "0.1", "--rnn", "lstm"])
+        experiments = self.get_experiments(runs)
+        self.assertEqual([experiment.lr for experiment in experiments], [0.1, 0.1, 0.01, 0.01, 0.1])
+        # the learning rate does not change the data, the batch size does
+        self.assertEqual(list(group_runs(experiments).values()), [[0, 1, 2, 3], [4]])
+
+    def test_run_sweep(self):
+        runs = [["--lr", "0.1", "--cuda", "False", "--async_val", "True"],
+                ["--lr", "0.1", "--cuda", "False", "--rnn", "gru"],
+                ["--lr", "0.1", "--cuda", "False", "--rnn", "fail"], ["--lr", "0.1", "--cuda", "False", "--b", "8"]]
+        for workers in (1, 2):
+            finished = []
+            results = run_sweep(self.get_experiments(runs), run, load, workers=workers, threads=1,
+                                on_result=finished.append)
+            self.assertEqual([result["index"] for result in results], [0, 1, 2, 3])
+            self.assertEqual(sorted(result["index"] for result in finished), [0, 1, 2, 3])
+            self.assertEqual([result["status"] for result in results], ["done", "done", "failed", "done"])
+            self.assertIn("unknown rnn", results[2]["error"])
+            self.assertEqual([results[i]["results"]["suffix"] for i in (0, 1, 3)], ["-00", "-01", "-03"])
+            self.assertEqual(results[0]["results"]["threads"], 1)
+            # the validation process cannot be started from a daemonic worker
+            self.assertEqual(results[0]["results"]["async_val"], workers == 1)
+            # each run gets the iterators in the state after loading, unchanged by the other runs
+            for i in (0, 1):
+                self.assertEqual(results[i]["results"]["started_at"], 0)
+            self.assertEqual(results[0]["results"]["first_batch"], results[1]["results"]["first_batch"])
+            self.assertNotEqual(results[0]["results"]["first_batch"], results[3]["results"]["first_batch"])
+            if workers > 1:
+                # the data is loaded in the sweep process and used by the forked workers
+                pids = results[0]["results"]["pids"]
+                self.assertEqual(pids[0], os.getpid())
+                self.assertNotEqual(pids[1], os.getpid())
+
+    def test_lost_workers(self):
+        runs = [["--lr", "0.1", "--cuda", "False", "--rnn", rnn] for rnn in ["kill", "gru", "unpicklable", "lstm"]]
+        poll_interval = utils_sweep.WORKER_POLL_INTERVAL
+        utils_sweep.WORKER_POLL_INTERVAL = 0.2
+        try:
+            results = run_sweep(self.get_experiments(runs), run, load, workers=2, threads=1)
+        finally:
+            utils_sweep.WORKER_POLL_INTERVAL = poll_interval
+        # the sweep does not wait for the results which never come
+        self.assertEqual([result["status"] for result in results], ["failed", "done", "failed", "done"])
+        self.assertIn("exited without result", results[0]["error"])
+        self.assertIn("pickle", results[2]["error"].lower())
+
+    def test_shared_bpe_codes(self):
+        for split, size in [("train", 60), ("val", 5), ("test", 5), ("samples", 3)]:
+            for ext, words in [(".en", "house houses housing"), (".de", "haus hauser hausen")]:
+                with open(os.path.join(self.path, split + ".tok" + ext), "w") as f:
+                    for i in range(size):
+                        f.write("{} w{}\n".format(words, i % 7))
+        runs = [["--lr", str(lr), "--cuda", "False", "--bpe", "10", "--lang_code", "de"] for lr in (0.1, 0.01)]
+        load_splits = lambda experiment: get_vocabularies_and_iterators(experiment, self.path)
+        # the codes are part of the loaded data, not of the experiment which loaded it
+        run_bpe = lambda experiment, data, path_suffix: {"codes": data[-1], "own": hasattr(experiment, "bpe_codes")}
+        results = run_sweep(self.get_experiments(runs), run_bpe, load_splits)
+        self.assertEqual([result["status"] for result in results], ["done", "done"])
+        for result in results:
+            self.assertTrue(os.path.isfile(result["results"]["codes"]))
+            self.assertFalse(result["results"]["own"])
+
+
+def run_trial(experiment, data, path_suffix, evaluate=True):
+    """
+    Logs a validation BLEU per epoch, proportional to the learning rate, and continues from the logged epochs
+    """
+    path = experiment.resume or os.path.join(experiment.data_dir, "run" + path_suffix)
+    os.makedirs(path, exist_ok=True)
+    metrics_file = os.path.join(path, "metrics.jsonl")
+    start = sum(1 for _ in open(metrics_file)) if experiment.resume else 0
+    with open(metrics_file, "a") as f:
+        for epoch in range(start, experiment.epochs):
+            f.write(json.dumps({"epoch": epoch + 1, "val_bleu": experiment.lr * (epoch + 1)}) + "\n")
+    return {"path": path, "evaluated": evaluate, "start": start}
+
+
+def run_stopped_trial(experiment, data, path_suffix, evaluate=True):
+    """
+    Same as run_trial, the trial with the best learning rate is stopped early in its first rung
+    """
+    results = run_trial(experiment, data, path_suffix, evaluate=evaluate)
+    return dict(results, stopped_early=experiment.lr == 0.6)
+
+
+class TestSuccessiveHalving(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_rungs(self):
+        self.assertEqual(get_rungs(80, 2, 3), [2, 6, 18, 54, 80])
+        self.assertEqual(get_rungs(18, 2, 3), [2, 6, 18])
+        self.assertEqual(get_rungs(1, 2, 3), [1])
+
+    def test_scheduler(self):
+        scheduler = SuccessiveHalving(4, [1, 3, 9], eta=2)
+        self.assertEqual([scheduler.next_job() for _ in range(4)], [(0, 0), (1, 0), (2, 0), (3, 0)])
+        self.assertIsNone(scheduler.next_job())
+        scheduler.report(0, 0, 10.0)
+        # a single result is not enough for a promotion
+        self.assertIsNone(scheduler.next_job())
+        scheduler.report(1, 0, 20.0)
+        self.assertEqual(scheduler.next_job(), (1, 1))
+        self.assertIsNone(scheduler.next_job())
+        scheduler.report(2, 0, 15.0)
+        scheduler.report(3, 0, 5.0)
+        self.assertEqual(scheduler.next_job(), (2, 1))
+        scheduler.report(1, 1, 30.0)
+        scheduler.report(2, 1, 25.0)
+        self.assertEqual(scheduler.next_job(), (1, 2))
+        self.assertEqual([scheduler.last_rung(trial) for trial in range(4)], [0, 1, 1, 0])
+
+    def test_scores(self):
+        with open(os.path.join(self.path, "metrics.jsonl"), "w") as f:
+            for record in [{"epoch": 1, "val_bleu": 3.0}, {"epoch": 1, "step": 10, "val_ppl": 50.0},
+                           {"epoch": 2, "val_bleu": 5.0, "val_ppl": 40.0}, {"test_bleu": 9.0, "beam": 1},
+                           {"epoch": 3, "val_bleu": 4.0, "val_ppl": 45.0}]:
+                f.write(json.dumps(record) + "\n")
+        scores = read_validation_scores(self.path)
+        self.assertEqual(scores, [(1, 3.0), (2, 5.0), (3, 4.0)])
+        self.assertEqual(best_score(scores, 1), 3.0)
+        self.assertEqual(best_score(scores, 3), 5.0)
+        self.assertEqual(best_score(read_validation_scores(self.path, "ppl"), 3, lower_is_better=True), 40.0)
+        self.assertIsNone(best_score(scores, 0))
+
+    def test_run_asha(self):
+        parser = experiment_parser()
+        experiments = [Experiment(parser.parse_args(["--lr", str(lr), "--epochs", "9", "--cuda", "False",
+                                                     "--data_dir", self.path]))
+                       for lr in [0.1, 0.4, 0.2, 0.3, 0.5, 0.6]]
+        for workers in (1, 3):
+            shutil.rmtree(self.path)
+            os.makedirs(self.path)
+            segments = []
+            trials = run_asha(experiments, run_trial, load, workers=workers, threads=1, min_epochs=1, eta=3,
+                              on_result=segments.append)
+            if workers == 1:
+                # the best trials are trained longest, the worst trials stop after the first rung
+                self.assertEqual([(trial["status"], trial["epochs"]) for trial in trials],
+                                 [("stopped", 1), ("stopped", 3), ("stopped", 1), ("stopped", 1), ("stopped", 3),
+                                  ("completed", 9)])
+            else:
+                # the order of the promotions depends on the order in which the trials finish
+                self.assertNotIn("paused", [trial["status"] for trial in trials])
+                self.assertEqual((trials[0]["status"], trials[0]["epochs"]), ("stopped", 1))
+                self.assertGreaterEqual(trials[5]["epochs"], 3)
+            for trial in trials:
+                # the logged epochs are continued, not repeated
+                scores = read_validation_scores(trial["path"])
+                self.assertEqual([epoch for epoch, _ in scores], list(range(1, trial["epochs"] + 1)))
+                self.assertAlmostEqual(trial["score"], experiments[trial["index"]].lr * trial["epochs"])
+            for segment in segments:
+                self.assertEqual(segment["results"]["evaluated"], segment["epochs"] == 9)
+                self.assertEqual(segment["results"]["start"] > 0, segment["rung"] > 0)
+
+    def test_run_asha_stopped_early(self):
+        parser = experiment_parser()
+        experiments = [Experiment(parser.parse_args(["--lr", str(lr), "--epochs", "9", "--cuda", "False",
+                                                     "--data_dir", self.path]))
+                       for lr in [0.1, 0.4, 0.2, 0.3, 0.5, 0.6]]
+        segments = []
+        trials = run_asha(experiments, run_stopped_trial, load, workers=1, threads=1, min_epochs=1, eta=3,
+                          on_result=segments.append)
+        # the trial stopped early is not promoted, it still ranks the other trials of its rung
+        self.assertEqual([segment["index"] for segment in segments].count(5), 1)
+        self.assertEqual((trials[5]["status"], trials[5]["epochs"], trials[5]["stopped_early"]), ("stopped", 1, True))
+        self.assertEqual([(trial["status"], trial["epochs"]) for trial in trials[:5]],
+                         [("stopped", 1), ("stopped", 3), ("stopped", 1), ("stopped", 1), ("stopped", 3)])
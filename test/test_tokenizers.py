@@ -1,6 +1,14 @@
+import os
+import shutil
+import tempfile
+from collections import Counter
 import unittest
 import spacy
 
+from project.utils.utils_bpe import BPE, SEPARATOR, learn_bpe, get_joint_bpe, bpe_codes_path, word_to_symbols, \
+    _merge_symbols
+from project.utils.utils_cache import StageCache, TokenizationCache
+
 from project.utils.utils_tokenizers import *
 
 class TestEnvironmentTokenizers(unittest.TestCase):
@@ -84,3 +92,139 @@ class TestEnvironmentTokenizers(unittest.TestCase):
         test_string = "das ist ein Satz"
         self.assertIsInstance(tokenizer.tokenize(test_string), list)
         self.assertAlmostEqual(len(tokenizer.tokenize(test_string)), 4)
+
+    def test_parallel_tokenize(self):
+        lines = ["Satz Nummer {}, mit Komma.".format(i) for i in range(25)]
+        tokenizer = get_custom_tokenizer("xx", prepro=True, mode="w")
+        expected = [' '.join(tokenizer.tokenize(line)) for line in lines]
+        for workers in [1, 2]:
+            chunks = list(parallel_tokenize("xx", lines, workers=workers, chunk_size=4))
+            self.assertEqual([len(chunk) for chunk in chunks], [4] * 6 + [1])
+            self.assertEqual([line for chunk in chunks for line in chunk], expected)
+
+    def test_tokenization_cache(self):
+        path = tempfile.mkdtemp()
+        try:
+            cache = TokenizationCache(StageCache(path), [tokenizer_signature("en"), tokenizer_signature("xx")])
+            pairs = [("Sentence {}.".format(i), "Satz {}!".format(i)) for i in range(10)]
+            expected = [pair for chunk in parallel_tokenize_pairs("en", "xx", pairs, chunk_size=4) for pair in chunk]
+            cached = [pair for chunk in parallel_tokenize_pairs("en", "xx", pairs, chunk_size=4, cache=cache)
+                      for pair in chunk]
+            self.assertEqual(cached, expected)
+            self.assertEqual((cache.hits, cache.misses), (0, 3))
+            # appended lines: only the last chunk changes
+            pairs += [("One more sentence.", "Noch ein Satz.")]
+            cached = [pair for chunk in parallel_tokenize_pairs("en", "xx", pairs, workers=2, chunk_size=4, cache=cache)
+                      for pair in chunk]
+            self.assertEqual(cached[:10], expected)
+            self.assertEqual(cached[10], ("One more sentence .", "Noch ein Satz ."))
+            self.assertEqual((cache.hits, cache.misses), (2, 4))
+            # the cached chunks are yielded without reading the whole corpus ahead
+            list(parallel_tokenize_pairs("en", "xx", pairs * 10, chunk_size=2, cache=cache))
+            read = []
+            stream = (read.append(pair) or pair for pair in pairs * 10)
+            chunks = parallel_tokenize_pairs("en", "xx", stream, workers=2, chunk_size=2, cache=cache)
+            self.assertEqual(next(chunks), expected[:2])
+            self.assertLessEqual(len(read), 2 * 2 * 2)
+            self.assertEqual(len([pair for chunk in chunks for pair in chunk]), 108)
+        finally:
+            shutil.rmtree(path)
+
+    def test_tokenize_batch(self):
+        lines = ["das ist ein Satz", "Hello, world!", "visit http://example.com/x?y=1 now", "<b>a@b.de</b>  x", ""]
+        for tokenizer in [FastTokenizer(lang="xx"), SplitTokenizer(lang="xx"), CharBasedTokenizer(lang="xx")]:
+            expected = [tokenizer.tokenize(line) for line in lines]
+            self.assertEqual(tokenizer.tokenize_batch(lines), expected)
+            self.assertEqual(tokenizer.tokenize_batch(lines, workers=2, chunk_size=2), expected)
+        self.assertEqual(FastTokenizer(lang="xx").tokenize("visit http://example.com/x?y=1 now"),
+                         ["visit", "http://example.com/x?y=1", "now"])
+
+
+def naive_learn_bpe(word_counts, num_symbols, min_frequency=2):
+    # counts all pairs again after each merge
+    words = {word_to_symbols(word): count for word, count in word_counts.items()}
+    merges = []
+    while len(merges) < num_symbols:
+        pairs = Counter()
+        for symbols, count in words.items():
+            for pair in zip(symbols, symbols[1:]):
+                pairs[pair] += count
+        if not pairs:
+            break
+        pair = min(pairs, key=lambda p: (-pairs[p], p))
+        if pairs[pair] < min_frequency:
+            break
+        merges.append(pair)
+        words = {_merge_symbols(symbols, pair, pair[0] + pair[1]): count for symbols, count in words.items()}
+    return merges
+
+
+class TestBPE(unittest.TestCase):
+
+    def setUp(self):
+        self.lines = ["the lower newest widest", "low lower lowest new newer", "the wider the newer",
+                      "ein neuer niedriger weg", "die neuesten wege sind niedriger", "aaaa aaa"] * 3
+        self.counts = Counter(word for line in self.lines for word in line.split())
+
+    def test_learn_matches_naive(self):
+        for num_symbols in [1, 5, 20, 100]:
+            self.assertEqual(learn_bpe(self.counts, num_symbols), naive_learn_bpe(self.counts, num_symbols))
+
+    def test_segment_and_decode(self):
+        bpe = BPE(learn_bpe(self.counts, 20))
+        for line in self.lines + ["unseen lowering words"]:
+            subwords = bpe.segment(line.split())
+            self.assertEqual(bpe.decode(subwords), line)
+            # only the last subword of a word has no separator
+            self.assertEqual(len([s for s in subwords if not s.endswith(SEPARATOR)]), len(line.split()))
+        self.assertEqual(bpe.segment(["newest"]), bpe.segment(["newest"]))
+        self.assertIn("newest", bpe.cache)
+
+    def test_no_unknown_subwords(self):
+        bpe = BPE(learn_bpe(self.counts, 30))
+        vocabulary = set(subword for line in self.lines for subword in bpe.segment(line.split()))
+        self.assertFalse(set(bpe.segment(["lowered", "wideness", "niedrigsten"])) <= vocabulary)
+        # words of known characters are segmented into subwords of the training vocabulary
+        vocabulary = bpe.get_vocabulary(self.counts)
+        bpe.set_vocabulary(vocabulary)
+        for word in ["lowered", "wideness", "niedrigsten"]:
+            self.assertTrue(set(bpe.segment([word])) <= vocabulary)
+            self.assertEqual(bpe.decode(bpe.segment([word])), word)
+        self.assertEqual(bpe.segment(self.lines[0].split()), BPE(bpe.merges).segment(self.lines[0].split()))
+
+    def test_codes_file(self):
+        path = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(path, "train.tok.en"), "w", encoding="utf-8") as f:
+                f.write("\n".join(self.lines[:3]) + "\n")
+            with open(os.path.join(path, "train.tok.de"), "w", encoding="utf-8") as f:
+                f.write("\n".join(self.lines[3:6]).upper() + "\n")
+            bpe, codes = get_joint_bpe(path, ["train.tok.en", "train.tok.de"], 50)
+            self.assertTrue(os.path.isfile(codes))
+            self.assertEqual(os.path.basename(codes), os.path.basename(bpe_codes_path(path, 50)))
+            # joint merges of the lowercased words of both files
+            self.assertEqual(bpe.merges, learn_bpe(Counter(" ".join(self.lines[:6]).split()), 50))
+            self.assertEqual(BPE.from_file(codes).merges, bpe.merges)
+            self.assertEqual(get_joint_bpe(path, ["train.tok.en", "train.tok.de"], 50)[1], codes)
+            # the codes of changed training files or parameters are learned again
+            with open(os.path.join(path, "train.tok.en"), "w", encoding="utf-8") as f:
+                f.write("\n".join(self.lines[3:6]) + "\n")
+            bpe, changed = get_joint_bpe(path, ["train.tok.en", "train.tok.de"], 50)
+            self.assertNotEqual(changed, codes)
+            self.assertEqual(bpe.merges, learn_bpe(Counter(" ".join(self.lines[3:6] * 2).split()), 50))
+            bpe, reduced = get_joint_bpe(path, ["train.tok.en", "train.tok.de"], 50, max_lines=1)
+            self.assertNotIn(reduced, [codes, changed])
+            self.assertEqual(bpe.merges, learn_bpe(Counter(" ".join([self.lines[3]] * 2).split()), 50))
+        finally:
+            shutil.rmtree(path)
+
+    def test_factory_bpe(self):
+        bpe = BPE(learn_bpe(self.counts, 20))
+        tokenizer = get_custom_tokenizer("de", prepro=False, mode="w", bpe=bpe)
+        self.assertIsInstance(tokenizer, BPETokenizer)
+        self.assertIsInstance(tokenizer.word_tokenizer, SplitTokenizer)
+        tokens = tokenizer.tokenize("The  Lowest newer")
+        self.assertEqual(tokens, bpe.segment(["the", "lowest", "newer"]))
+        self.assertEqual(tokenizer.detokenize(tokens), "the lowest newer")
+        self.assertEqual(tokenizer.tokenize_batch(["The  Lowest newer"], workers=2), [tokens])
+        self.assertEqual(SplitTokenizer("de").detokenize(["a", "b"]), "a b")
@@ -0,0 +1,285 @@
+import math
+import os
+import random
+import shutil
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+import torch
+from torchtext.data import Field, BucketIterator
+
+from project.model.models import get_nmt_model
+from project.utils.constants import SOS_TOKEN, EOS_TOKEN, PAD_TOKEN, UNK_TOKEN
+from project.utils.datasets import Seq2SeqDataset
+from project.utils.experiment import Experiment
+from project.utils.utils_checkpoints import CheckpointSaver, list_checkpoints, load_latest_checkpoint, \
+    get_rng_state, set_rng_state
+from project.utils.utils_embeddings import init_embedding
+from project.utils.utils_logging import Logger
+from project.utils.utils_memory import snapshot_largest_batch, memory_stats, dataset_memory, vocab_memory
+from project.utils.utils_profiling import PhaseTimer, TRAIN_PHASES, LatencyHistogram, ModuleProfiler
+from project.utils.utils_tokenizers import SplitTokenizer
+from project.utils.utils_translator import Translator
+from project.utils.utils_training import train, validate_perplexity
+from train_model import experiment_parser
+
+data_dir = os.path.join(".", "test", "test_data")
+
+
+def get_toy_setup():
+    """
+    Builds vocabularies, dataset and a small model on the sample files
+    """
+    SRC = Field(pad_token=PAD_TOKEN, unk_token=UNK_TOKEN, lower=True)
+    TRG = Field(init_token=SOS_TOKEN, eos_token=EOS_TOKEN, pad_token=PAD_TOKEN, unk_token=UNK_TOKEN, lower=True)
+    dataset = Seq2SeqDataset.splits(path=data_dir, exts=(".de", ".en"), train="samples", validation="", test="",
+                                    fields=(SRC, TRG))[0]
+    SRC.build_vocab(dataset)
+    TRG.build_vocab(dataset)
+    experiment = Experiment(experiment_parser().parse_args(["--hs", "16", "--emb", "16", "--cuda", "False"]))
+    experiment.model_type = "custom"
+    experiment.src_vocab_size = len(SRC.vocab)
+    experiment.trg_vocab_size = len(TRG.vocab)
+    tokens_bos_eos_pad_unk = [TRG.vocab.stoi[SOS_TOKEN], TRG.vocab.stoi[EOS_TOKEN],
+                              TRG.vocab.stoi[PAD_TOKEN], TRG.vocab.stoi[UNK_TOKEN]]
+    torch.manual_seed(0)
+    model = get_nmt_model(experiment, tokens_bos_eos_pad_unk)
+    return SRC, TRG, dataset, model, experiment
+
+
+class SlowValue(object):
+    """
+    Takes some time to be pickled, like a large checkpoint
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+    def __reduce__(self):
+        time.sleep(0.3)
+        return SlowValue, (self.value,)
+
+
+class TestValidation(unittest.TestCase):
+
+    def setUp(self):
+        self.SRC, self.TRG, self.dataset, self.model, self.experiment = get_toy_setup()
+
+    def get_iter(self, batch_size):
+        return BucketIterator(self.dataset, batch_size=batch_size, repeat=False, shuffle=False, train=False,
+                              sort_key=lambda x: (len(x.src), len(x.trg)))
+
+    def test_perplexity_ignores_padding(self):
+        data_iter = self.get_iter(len(self.dataset))
+        ppl = validate_perplexity(data_iter, self.model, "cpu", self.TRG)
+        # same masking as the training criterion
+        weight = torch.ones(len(self.TRG.vocab))
+        weight[self.TRG.vocab.stoi[PAD_TOKEN]] = 0
+        criterion = torch.nn.CrossEntropyLoss(weight=weight)
+        batch = next(iter(data_iter))
+        self.model.eval()
+        with torch.no_grad():
+            scores = self.model(batch.src, batch.trg)[:-1]
+        loss = criterion(scores.reshape(-1, scores.size(2)), batch.trg[1:].reshape(-1))
+        self.assertTrue(math.isfinite(ppl))
+        self.assertAlmostEqual(ppl, math.exp(loss.item()), places=3)
+
+    def test_perplexity_keeps_training_mode(self):
+        self.model.train()
+        validate_perplexity(self.get_iter(4), self.model, "cpu", self.TRG)
+        self.assertTrue(self.model.training)
+        self.model.eval()
+        validate_perplexity(self.get_iter(4), self.model, "cpu", self.TRG)
+        self.assertFalse(self.model.training)
+
+
+class TestCheckpoints(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_rotation(self):
+        saver = CheckpointSaver(self.path, keep=2)
+        weights = torch.zeros(3)
+        for step in [5, 10, 15]:
+            weights += 1
+            saver.save({"step": step, "weights": weights}, step)
+        saver.close()
+        checkpoints = list_checkpoints(self.path)
+        self.assertEqual(len(checkpoints), 2)
+        self.assertEqual(sorted(os.listdir(self.path)), [os.path.basename(c) for c in checkpoints])
+        state = load_latest_checkpoint(self.path)
+        self.assertEqual(state["step"], 15)
+        self.assertTrue(torch.equal(state["weights"], torch.full((3,), 3.)))
+
+    def test_one_pending_checkpoint(self):
+        saver = CheckpointSaver(self.path, keep=3)
+        saver.save({"value": SlowValue(1)}, 1)
+        saver.save({"value": SlowValue(2)}, 2)
+        # the state of a checkpoint is only copied once the previous one is written
+        self.assertEqual(len(list_checkpoints(self.path)), 1)
+        saver.close()
+        self.assertEqual(len(list_checkpoints(self.path)), 2)
+
+    def test_no_checkpoint(self):
+        self.assertIsNone(load_latest_checkpoint(self.path))
+
+    def test_rng_state(self):
+        state = get_rng_state()
+        expected = (random.random(), np.random.rand(), torch.rand(1).item())
+        saver = CheckpointSaver(self.path, keep=1)
+        saver.save({"rng": state}, 1)
+        saver.close()
+        set_rng_state(load_latest_checkpoint(self.path)["rng"])
+        self.assertEqual((random.random(), np.random.rand(), torch.rand(1).item()), expected)
+
+
+class TestProfiling(unittest.TestCase):
+
+    def test_phase_timer_counts_epoch(self):
+        SRC, TRG, dataset, model, _ = get_toy_setup()
+        train_iter = BucketIterator(dataset, batch_size=4, repeat=False, shuffle=True,
+                                    sort_key=lambda x: (len(x.src), len(x.trg)))
+        weight = torch.ones(len(TRG.vocab))
+        weight[TRG.vocab.stoi[PAD_TOKEN]] = 0
+        timer = PhaseTimer()
+        train(train_iter, model, torch.nn.CrossEntropyLoss(weight=weight),
+              torch.optim.SGD(model.parameters(), lr=0.1), device="cpu", timer=timer)
+        summary = timer.summary()
+        self.assertEqual(summary["sentences"], len(dataset))
+        # target tokens and end of sentence tokens
+        self.assertEqual(summary["tokens"], sum(len(example.trg) + 1 for example in dataset.examples))
+        self.assertEqual(list(summary["phase_times"]), TRAIN_PHASES)
+        self.assertGreater(summary["tokens_per_sec"], 0)
+
+    def test_module_profiler(self):
+        SRC, TRG, dataset, model, _ = get_toy_setup()
+        model.eval()
+        src = SRC.process([e.src for e in dataset.examples[:4]], device="cpu")
+        trg = TRG.process([e.trg for e in dataset.examples[:4]], device="cpu")
+        profiler = ModuleProfiler(model).attach()
+        with torch.no_grad():
+            with profiler.mode("train"):
+                model(src, trg)
+            with profiler.mode("decode"):
+                model.predict(src[:, :1], beam_size=2, max_len=5)
+        profiler.detach()
+        model(src, trg)
+        rows = {(row["mode"], row["module"]): row for row in profiler.summary()}
+        self.assertEqual({name for mode, name in rows if mode == "train"}, set(ModuleProfiler.DEFAULT_MODULES))
+        self.assertEqual(rows[("train", "output")]["calls"], 1)
+        self.assertEqual(rows[("train", "output")]["flops"],
+                         2 * trg.numel() * model.output.in_features * model.output.out_features)
+        self.assertEqual(rows[("decode", "encoder.rnn")]["calls"], 1)
+        self.assertGreater(rows[("decode", "decoder.rnn")]["calls"], 1)
+
+
+class TestMemory(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def train_epoch(self, snapshot):
+        SRC, TRG, dataset, model, _ = get_toy_setup()
+        criterion = torch.nn.CrossEntropyLoss(ignore_index=TRG.vocab.stoi[PAD_TOKEN])
+        torch.manual_seed(1)
+        if snapshot:
+            stats = snapshot_largest_batch(dataset, 4, model, criterion, "cpu", self.path)
+            self.assertEqual(stats["src_len"], max(len(e.src) for e in dataset.examples))
+        train_iter = BucketIterator(dataset, batch_size=4, repeat=False, shuffle=False,
+                                    sort_key=lambda x: (len(x.src), len(x.trg)))
+        train(train_iter, model, criterion, torch.optim.SGD(model.parameters(), lr=0.1), device="cpu")
+        return model
+
+    def test_snapshot_does_not_change_training(self):
+        expected = self.train_epoch(snapshot=False).state_dict()
+        model = self.train_epoch(snapshot=True)
+        for name, value in model.state_dict().items():
+            self.assertTrue(torch.equal(value, expected[name]), name)
+        self.assertTrue(os.path.isfile(os.path.join(self.path, "memory_snapshot.log")))
+
+    def test_memory_stats(self):
+        SRC, TRG, dataset, model, _ = get_toy_setup()
+        stats = memory_stats(model, torch.optim.Adam(model.parameters()), k=3)
+        self.assertEqual(stats["model_bytes"], 4 * sum(p.numel() for p in model.parameters()))
+        self.assertEqual(stats["optimizer_bytes"], 0)
+        self.assertEqual(len(stats["largest_tensors"]), 3)
+        self.assertGreaterEqual(stats["peak_rss"], stats["rss"])
+        data = dataset_memory(dataset)
+        self.assertEqual(data["examples"], len(dataset))
+        self.assertEqual(data["tokens"], sum(len(e.src) + len(e.trg) for e in dataset.examples))
+        self.assertEqual(vocab_memory(TRG)["size"], len(TRG.vocab))
+
+
+class TestFrozenEmbeddings(unittest.TestCase):
+
+    def test_training_step(self):
+        SRC, TRG, dataset, model, _ = get_toy_setup()
+        vectors = np.random.RandomState(0).normal(size=tuple(model.encoder.embedding.weight.shape))
+        init_embedding(model.encoder.embedding, vectors, freeze=True)
+        init_embedding(model.decoder.embedding, np.zeros(tuple(model.decoder.embedding.weight.shape)), freeze=True)
+        frozen = model.encoder.embedding.weight.detach().clone()
+        criterion = torch.nn.CrossEntropyLoss(ignore_index=TRG.vocab.stoi[PAD_TOKEN])
+        optimizer = torch.optim.Adam(filter(lambda p: p.requires_grad, model.parameters()))
+        train_iter = BucketIterator(dataset, batch_size=4, repeat=False, shuffle=False,
+                                    sort_key=lambda x: (len(x.src), len(x.trg)))
+        # the gradient norm is computed with clip values >= 1
+        loss, norm, first_norm = train(train_iter, model, criterion, optimizer, device="cpu", clip_value=5.0)
+        self.assertGreater(first_norm, 0)
+        self.assertIsNone(model.encoder.embedding.weight.grad)
+        self.assertTrue(torch.equal(model.encoder.embedding.weight, frozen))
+
+
+class TestTranslationStats(unittest.TestCase):
+
+    def setUp(self):
+        self.SRC, self.TRG, self.dataset, self.model, _ = get_toy_setup()
+        self.model.eval()
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_histogram_percentiles(self):
+        histogram = LatencyHistogram(window=100)
+        for value in range(200):
+            histogram.add(value)
+        summary = histogram.summary()
+        self.assertEqual(summary["count"], 200)
+        self.assertAlmostEqual(summary["p50"], 149.5)
+        self.assertAlmostEqual(summary["p99"], 198.01)
+
+    def test_translator_stats(self):
+        translator = Translator(self.model, self.SRC, self.TRG, Logger(self.path), SplitTokenizer("de"),
+                                device="cpu", beam_size=3, max_len=10, stats_every=2)
+        sentences = [" ".join(example.src) for example in self.dataset.examples[:4]]
+        with torch.no_grad():
+            outputs = [translator.predict_sentence(sentence) for sentence in sentences]
+            expected = [self.model.predict(self.SRC.process([example.src], device="cpu"), beam_size=3, max_len=10)
+                        for example in self.dataset.examples[:4]]
+        # the instrumentation does not change the predictions
+        self.assertEqual([output.split(" ") if output else [] for output in outputs],
+                         [[self.TRG.vocab.itos[i] for i in pred if i not in [self.TRG.vocab.stoi[SOS_TOKEN],
+                                                                             self.TRG.vocab.stoi[EOS_TOKEN]]]
+                          for pred in expected])
+        stats = translator.get_stats()
+        self.assertEqual(stats["requests"], 4)
+        for stage in ["tokenize", "numericalize", "encode", "decode", "decode_step", "detokenize", "total"]:
+            self.assertEqual(stats["stages"][stage]["count"], 4 if stage != "decode_step" else stats["decode_steps"])
+        self.assertGreater(stats["decode_steps"], 0)
+        self.assertTrue(0 < stats["beam_occupancy"] <= 1)
+        with open(os.path.join(self.path, "translation_stats.jsonl")) as f:
+            self.assertEqual(len(f.readlines()), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,20 @@
+import json
 import os
+import shutil
+import tempfile
 import unittest
 
+import numpy as np
+
 from torchtext.data import Field, Iterator
 
 from project.utils.utils_metrics import AverageMeter
-from project.utils.utils_logging import Logger
+from project.utils.utils_logging import Logger, BufferedFileWriter
 from project.utils.datasets import Seq2SeqDataset
+from project.utils.data import SplitWriter, filter_by_length
+from project.utils.utils_dedup import find_duplicates
+from project.utils.utils_stats import dataset_stats, write_stats
+from project.utils.utils_train_preprocessing import count_unks, count_words
 
 data_dir = os.path.join(".", "test", "test_data")
 
@@ -44,6 +53,55 @@ class TestIOUtils(unittest.TestCase):
         self.assertEqual(content[0], "test_logging")
         self.assertEqual(content[1], "test_second_logging")
 
+    def test_buffered_logger(self):
+        path = os.path.join(data_dir, "buffered.log")
+        if os.path.exists(path):
+            os.remove(path)
+        logger = Logger(path=data_dir, file_name="buffered.log", buffered=True)
+        for i in range(100):
+            logger.log("line {}".format(i), stdout=False)
+        logger.flush()
+        with open(path, mode="r") as f:
+            content = f.read().strip().split("\n")
+        self.assertEqual(content, ["line {}".format(i) for i in range(100)])
+        os.remove(path)
+
+    def test_close_buffered_logger(self):
+        path = os.path.join(data_dir, "closed.log")
+        metrics_path = os.path.join(data_dir, "closed.jsonl")
+        writers = len(BufferedFileWriter._writers)
+        for _ in range(3):
+            logger = Logger(path=data_dir, file_name="closed.log", buffered=True)
+            logger.log("line", stdout=False)
+            logger.log_metrics({"epoch": 1}, file_name="closed.jsonl")
+            logger.close()
+        # the writers of the closed loggers are written and not flushed anymore
+        self.assertEqual(len(BufferedFileWriter._writers), writers)
+        with open(path, mode="r") as f:
+            self.assertEqual(f.read().split(), ["line"] * 3)
+        with open(metrics_path, mode="r") as f:
+            self.assertEqual(len(f.readlines()), 3)
+        os.remove(path)
+        os.remove(metrics_path)
+
+    def test_log_metrics(self):
+        path = os.path.join(data_dir, "metrics.jsonl")
+        if os.path.exists(path):
+            os.remove(path)
+        for buffered in [False, True]:
+            logger = Logger(path=data_dir, buffered=buffered)
+            logger.log_metrics({"epoch": 1, "train_loss": np.float32(2.5), "val_bleu": None})
+            logger.flush()
+        with open(path, mode="r") as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(len(records), 2)
+        for record in records:
+            self.assertIn("time", record)
+            self.assertEqual(record["epoch"], 1)
+            self.assertEqual(record["train_loss"], 2.5)
+            self.assertIsNone(record["val_bleu"])
+        os.remove(path)
+
     def test_save_model(self):
         path = os.path.join(data_dir, "log.log")
         if os.path.exists(path):
@@ -81,4 +139,119 @@ class TestIOUtils(unittest.TestCase):
         self.assertEqual(metric.count, 0)
         self.assertEqual(metric.val,  0)
         self.assertEqual(metric.avg,  0)
-        self.assertEqual(metric.sum, 0)
\ No newline at end of file
+        self.assertEqual(metric.sum, 0)
+
+
+class TestDataSplits(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.pairs = [("source sentence {} .".format(i), "target sentence {} .".format(i)) for i in range(200)]
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def read_split(self, split):
+        with open(os.path.join(self.path, split + ".tok.en")) as src, open(os.path.join(self.path, split + ".tok.de")) as trg:
+            return [(s.strip(), t.strip()) for s, t in zip(src, trg)]
+
+    def write_splits(self, pairs, val_samples, chunk_size=7):
+        with SplitWriter(self.path, (".en", ".de"), val_samples=val_samples) as writer:
+            for i in range(0, len(pairs), chunk_size):
+                writer.write(pairs[i:i + chunk_size])
+        return {split: self.read_split(split) for split in ["train", "val", "test"]}
+
+    def test_fixed_samples(self):
+        splits = self.write_splits(self.pairs, val_samples=10)
+        self.assertEqual([len(splits[split]) for split in ["train", "val", "test"]], [180, 10, 10])
+        self.assertEqual(sorted(sum(splits.values(), [])), sorted(self.pairs))
+        # the assignment does not depend on the order or the chunking
+        shuffled = self.write_splits(list(reversed(self.pairs)), val_samples=10, chunk_size=50)
+        self.assertEqual(splits["val"], shuffled["val"])
+        self.assertEqual(splits["test"], shuffled["test"])
+        # the training pairs are shuffled, independently of the order of the corpus
+        self.assertEqual(splits["train"], shuffled["train"])
+        self.assertNotEqual(splits["train"], sorted(splits["train"], key=self.pairs.index))
+        self.assertEqual(len(self.read_split("samples")), 15)
+        # the temporary buckets are removed
+        self.assertEqual(sorted(os.listdir(self.path)), sorted(split + ".tok" + ext for ext in [".en", ".de"]
+                                                               for split in ["train", "val", "test", "samples"]))
+
+    def test_ratio(self):
+        splits = self.write_splits(self.pairs, val_samples=0.1)
+        self.assertEqual(sum(len(pairs) for pairs in splits.values()), 200)
+        self.assertTrue(10 <= len(splits["val"]) <= 30)
+        self.assertTrue(10 <= len(splits["test"]) <= 30)
+
+    def test_filter_by_length(self):
+        pairs = [("a  b", "c d"), ("a", "b c"), ("a b c d", "e f"), ("", "a b")]
+        self.assertEqual(list(filter_by_length(pairs, min_len=2, max_len=3)), [("a b", "c d")])
+
+
+class TestDeduplication(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        words = "the of and to a in is that for it as was with be by on not this are or from at".split()
+        generator = np.random.RandomState(0)
+        sentence = lambda: " ".join(generator.choice(words, 12))
+        self.pairs = [(sentence(), sentence()) for _ in range(300)]
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_duplicates(self):
+        src = self.pairs[5][0].split(" ")
+        src[6] = "changed"
+        pairs = self.pairs + [self.pairs[3], (" ".join(src), self.pairs[5][1])]
+        chunks = [pairs[i:i + 50] for i in range(0, len(pairs), 50)]
+        for workers in [1, 2]:
+            keep, stats = find_duplicates(chunks, self.path, threshold=0.7, workers=workers)
+            self.assertEqual(keep.tolist(), [True] * 300 + [False, False])
+            self.assertEqual(stats, {"pairs": 302, "exact": 1, "near": 1, "kept": 300})
+        keep, stats = find_duplicates(chunks, self.path, threshold=0)
+        self.assertEqual(keep.tolist(), [True] * 300 + [False, True])
+        self.assertEqual(os.listdir(self.path), [])
+
+
+class TestCorpusStats(unittest.TestCase):
+
+    def setUp(self):
+        self.src_vocab = Field(pad_token="<pad>", unk_token="<unk>", lower=True)
+        self.trg_vocab = Field(init_token="<sos>", eos_token="<eos>", pad_token="<pad>", unk_token="<unk>", lower=True)
+        self.data = Seq2SeqDataset.splits(root="", path=data_dir, exts=(".de", ".en"), train="samples",
+                                          fields=(self.src_vocab, self.trg_vocab), validation="", test="")[0]
+        self.src_vocab.build_vocab(self.data, min_freq=2)
+        self.trg_vocab.build_vocab(self.data, min_freq=2)
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_counts_match_batches(self):
+        data_iter = Iterator(self.data, batch_size=1, device="cpu", repeat=False, shuffle=False)
+        unks, words = [0, 0], [0, 0]
+        for batch in data_iter:
+            for side, (field, ids) in enumerate([(self.src_vocab, batch.src), (self.trg_vocab, batch.trg)]):
+                tokens = [field.vocab.itos[i] for i in ids.view(-1).tolist()]
+                unks[side] += tokens.count("<unk>")
+                words[side] += len([t for t in tokens if t not in ["<unk>", "<pad>", "<sos>", "<eos>"]])
+        self.assertEqual(list(count_unks(data_iter, self.src_vocab, self.trg_vocab)), unks)
+        self.assertEqual(list(count_words(data_iter, self.src_vocab, self.trg_vocab)), words)
+        self.assertGreater(unks[0], 0)
+
+    def test_dataset_stats(self):
+        stats = dataset_stats(self.data, self.src_vocab, self.trg_vocab)
+        self.assertIs(dataset_stats(self.data, self.src_vocab, self.trg_vocab), stats)
+        lengths = [len(e.src) for e in self.data.examples]
+        src = stats["src"]
+        self.assertEqual(src["sentences"], len(self.data))
+        self.assertEqual(src["tokens"], sum(lengths))
+        self.assertEqual(src["length_max"], max(lengths))
+        self.assertEqual(src["length_histogram"][max(lengths)], lengths.count(max(lengths)))
+        types = set(t for e in self.data.examples for t in e.src)
+        self.assertEqual(src["types"], len(types))
+        self.assertEqual(src["oov_types"], len([t for t in types if t not in self.src_vocab.vocab.stoi]))
+        write_stats(self.path, "de_en", {"train": stats})
+        self.assertEqual(json.load(open(os.path.join(self.path, "de_en.json")))["train"]["src"]["unks"], src["unks"])
+        self.assertIn("train", open(os.path.join(self.path, "de_en.log")).read())
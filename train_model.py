@@ -2,8 +2,9 @@
 Main script to run nmt experiments
 """
 import argparse
-import os, datetime, time, sys
+import os, datetime, time, sys, shutil
 
+import dill
 import torch
 import torch.nn as nn
 import numpy as np
@@ -12,8 +13,14 @@ from project.utils.experiment import Experiment
 from project.model.models import count_trainable_params, get_nmt_model
 from project.utils.constants import SOS_TOKEN, EOS_TOKEN, PAD_TOKEN, UNK_TOKEN
 from project.utils.utils_train_preprocessing import get_vocabularies_and_iterators, print_info, count_unks
-from project.utils.utils_training import train_model, beam_predict, check_translation, CustomReduceLROnPlateau
+from project.utils.utils_training import train_model, beam_predict, check_translation, CustomReduceLROnPlateau, \
+    get_bleu_scorer
 from project.utils.utils_logging import Logger
+from project.utils.utils_bpe import BPE_CODES_FILE
+from project.utils.utils_embeddings import init_pretrained_embeddings
+from project.utils.utils_checkpoints import load_latest_checkpoint
+from project.utils.utils_cost_model import plan_experiment, format_plan
+from project.utils.utils_memory import dataset_memory, vocab_memory, memory_stats, format_memory
 from project.utils.utils_functions import convert_time_unit, str2bool
 from settings import MODEL_STORE
 
@@ -40,6 +47,10 @@ def experiment_parser():
     parser.add_argument('--max_len', type=int, metavar="N", default=30, help="Truncate the sequences to the given max_len parameter.")
     parser.add_argument('--corpus', nargs='+',  default="europarl", metavar='STR',
                         help="Please pass one or more valid corpora, e.g. europarl ted2013 tatoeba")
+    parser.add_argument('--corpus_weights', nargs='+', type=float, default=None, metavar='W',
+                        help="Sampling weights of the corpora of a mix, one per corpus. Default: None, the sampling follows the corpus sizes and --temperature.")
+    parser.add_argument('--temperature', type=float, default=1.0,
+                        help="Temperature of the size-based sampling of a mix of corpora, p ~ size^(1/T). Values > 1 sample the small corpora more often. Default: 1.0")
     parser.add_argument('--attn', default="dot", type=str, help="Attention type: dot, none. Default: dot")
     parser.add_argument('--lang_code', metavar='STR', default="de",
                         help="Provide language code, e.g. 'de'. This is the second language. First is by default English. Default: 'de'")
@@ -52,16 +63,89 @@ def experiment_parser():
     parser.add_argument('--test', default=1190, type=int, help="Number of test examples")
     parser.add_argument('--data_dir', default=None, type=str, help="Data directory. Provide this, if data are not in the default data directory of the project. Default: None.")
     parser.add_argument('--tok', default="tok", type=str, help="Infix of tokenized files (e.g. train.tok.de), or specify other: train.de ('')")
+    parser.add_argument('--bpe', default=0, type=int, metavar='N',
+                        help="Learn N joint BPE merges on the training files (e.g. 8000) and train on subwords with a joint vocabulary. Default: 0 (word-level)")
+    parser.add_argument('--pretrained', default="", type=str, metavar='STR',
+                        help="Initialize the embeddings with pretrained vectors of each language, e.g. fasttext (see config/lm.cfg). Requires --emb 300 for fasttext. Default: '' (random initialization)")
+    parser.add_argument('--freeze_emb', type=str2bool, default=False,
+                        help="Keep the pretrained embeddings fixed during training. With --tied the output layer is fixed too. Default: False")
     parser.add_argument('--min', type=int, default=5,
                         help="Minimal word frequency. If min_freq <= 0, then min_freq is set to default value")
     parser.add_argument('--tied', default="False", type=str2bool,
                         help="Tie weights between input and output in decoder.")
     parser.add_argument('--beam', type=int, default=5, help="Beam size used during the model validation.")
     parser.add_argument('--norm', type=float, default=-1.0, help="Check norm during training epochs. Default: False (no check).")
+    parser.add_argument('--async_val', type=str2bool, default=False,
+                        help="Validate weight snapshots in a separate process while training goes on (CPU only). Default: False")
+    parser.add_argument('--val_metric', default="bleu", type=str, choices=["bleu", "ppl"],
+                        help="Validation metric for the scheduler, model saving and early stopping: bleu (beam search) or ppl (teacher forced perplexity). Default: bleu")
+    parser.add_argument('--ppl_every', default=0, type=int, metavar='N',
+                        help="Compute the validation perplexity every N training steps. With --val_metric ppl, 0 means once per epoch. Default: 0")
+    parser.add_argument('--bleu_every', default=1, type=int, metavar='N',
+                        help="Compute the validation BLEU every N epochs. The last epoch is always validated. Default: 1")
+    parser.add_argument('--keep_checkpoints', default=2, type=int, metavar='N',
+                        help="Number of resumable checkpoints kept in the experiment directory. Use 0 to disable checkpoints. Default: 2")
+    parser.add_argument('--checkpoint_every', default=0, type=int, metavar='N',
+                        help="Save a checkpoint every N training steps, in addition to the end of each epoch. Default: 0 (only at the end of each epoch)")
+    parser.add_argument('--resume', default="", type=str, metavar='PATH',
+                        help="Resume the training from the latest checkpoint in the given experiment directory. The configuration of that experiment is used.")
+    parser.add_argument('--profile', default=0, type=int, metavar='N',
+                        help="Capture a torch.profiler trace of N training steps in the experiment directory. Default: 0 (no trace)")
+    parser.add_argument('--profile_modules', type=str2bool, default=False,
+                        help="Accumulate time, calls and estimated FLOPs of the model submodules during training and decoding, saved as module_profile.log. Default: False")
+    parser.add_argument('--memory_snapshot', type=str2bool, default=False,
+                        help="Trace the allocations of forward and backward of the largest batch before training, saved as memory_snapshot.log (and memory_snapshot.pickle on CUDA). Default: False")
+    parser.add_argument('--dry_run', type=str2bool, default=False,
+                        help="Only estimate parameters, memory, FLOPs and throughput of the configuration, calibrated with a short benchmark on this host. No data is loaded. Default: False")
     return parser
 
 def main():
     experiment = Experiment(experiment_parser())
+    if experiment.resume:
+        # the configuration of the interrupted experiment is used
+        resume_path = experiment.resume
+        args = torch.load(os.path.join(resume_path, "experiment.pkl"), pickle_module=dill,
+                          weights_only=False)["args"]
+        args.resume = resume_path
+        experiment = Experiment(args)
+    run_experiment(experiment)
+
+
+def get_experiment_path(experiment, suffix=""):
+    """
+    :param suffix: appended to the timestamp, distinguishes the runs of a sweep started in the same second
+    :return: the directory of a new experiment, e.g. results/de_en/custom/lstm/2/bi/2019-08-11-10-30-31
+    """
+    lang_comb = "{}_{}".format(experiment.get_src_lang(), experiment.get_trg_lang())
+    direction = "bi" if experiment.bi else "uni"
+    return os.path.join(MODEL_STORE, lang_comb, experiment.model_type, experiment.rnn_type, str(experiment.nlayers),
+                        direction, datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S") + suffix)
+
+
+def run_experiment(experiment, data=None, path_suffix="", evaluate=True):
+    """
+    Trains and evaluates the model of the experiment
+    :param experiment: the Experiment
+    :param data: optional result of get_vocabularies_and_iterators for the experiment, loaded if None
+    :param path_suffix: suffix of the experiment directory, see get_experiment_path
+    :param evaluate: False to skip the test of the trained model, e.g. for a training continued later
+    :return: dictionary with the experiment directory, the best validation score, the test BLEU per beam size
+    and whether the training was stopped early
+    """
+    loggers = []
+    try:
+        return _run_experiment(experiment, data, path_suffix, evaluate, loggers)
+    finally:
+        # the runs of a sweep share the process, the writers of a finished run are not flushed anymore
+        for logger in loggers:
+            logger.close()
+
+
+def _run_experiment(experiment, data, path_suffix, evaluate, loggers):
+    """
+    See run_experiment
+    :param loggers: list to which the created loggers are appended, they are closed by run_experiment
+    """
     print("Running experiment on:", experiment.get_device())
     # Model configuration
     if experiment.attn != "none":
@@ -71,46 +155,54 @@ def main():
 
     model_type = experiment.model_type
     print("Model Type", model_type)
+
+    if experiment.dry_run:
+        print(format_plan(plan_experiment(experiment)))
+        return None
     src_lang = experiment.get_src_lang()
     trg_lang = experiment.get_trg_lang()
 
-    lang_comb = "{}_{}".format(src_lang, trg_lang)
-    layers = experiment.nlayers
-
-    direction = "bi" if experiment.bi else "uni"
-
-    rnn_type = experiment.rnn_type
-    experiment_path = os.path.join(MODEL_STORE, lang_comb, model_type, rnn_type, str(layers),
-                                   direction,
-                                   datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S"))
+    if experiment.resume:
+        experiment_path = experiment.resume
+    else:
+        experiment_path = get_experiment_path(experiment, path_suffix)
     os.makedirs(experiment_path, exist_ok=True)
 
     data_dir = experiment.data_dir
 
     # Create directory for logs, create logger, log hyperparameters
-    logger = Logger(experiment_path)
+    logger = Logger(experiment_path, buffered=True)
+    loggers.append(logger)
     logger.log("Language combination ({}-{})".format(src_lang, trg_lang))
     logger.log("Attention: {}".format(experiment.attn))
 
 
     # Load and process data
     time_data = time.time()
-    SRC, TRG, train_iter, val_iter, test_iter, train_data, val_data, test_data, samples, samples_iter = \
-        get_vocabularies_and_iterators(experiment, data_dir)
+    if data is None:
+        data = get_vocabularies_and_iterators(experiment, data_dir)
+    SRC, TRG, train_iter, val_iter, test_iter, train_data, val_data, test_data, samples, samples_iter, bpe_codes = data
     end_time_data = time.time()
-
-    print(len(train_data),len(val_data), len(test_data))
-    exit()
+    logger.log_metrics(dict({"phase": "data", "train_data": dataset_memory(train_data),
+                             "val_data": dataset_memory(val_data), "test_data": dataset_memory(test_data),
+                             "src_vocab": vocab_memory(SRC), "trg_vocab": vocab_memory(TRG)},
+                            **memory_stats(k=0)))
 
     # Pickle vocabulary objects
     logger.pickle_obj(SRC, "src")
     logger.pickle_obj(TRG, "trg")
     logger.log("SRC and TRG objects persisted in the experiment directory.")
+    if experiment.bpe > 0:
+        # needed by the translation to segment the input and to join the predicted subwords
+        # the codes are part of the loaded data, they are shared by the runs of a sweep
+        shutil.copy(bpe_codes, os.path.join(experiment_path, BPE_CODES_FILE))
+        logger.log("BPE codes ({} merges) copied to the experiment directory.".format(experiment.bpe))
 
     experiment.src_vocab_size = len(SRC.vocab)
     experiment.trg_vocab_size = len(TRG.vocab)
-    data_logger = Logger(path=experiment_path, file_name="data.log")
-    translation_logger = Logger(path=experiment_path, file_name="train_translations.log")
+    data_logger = Logger(path=experiment_path, file_name="data.log", buffered=True)
+    translation_logger = Logger(path=experiment_path, file_name="train_translations.log", buffered=True)
+    loggers += [data_logger, translation_logger]
 
     samples_quantities = [170000, 1020, 1190]
     full_quantities = [0,5546,6471] #0 means whole training dataset
@@ -126,6 +218,9 @@ def main():
     tokens_bos_eos_pad_unk = [TRG.vocab.stoi[SOS_TOKEN], TRG.vocab.stoi[EOS_TOKEN], TRG.vocab.stoi[PAD_TOKEN], TRG.vocab.stoi[UNK_TOKEN]]
 
     model = get_nmt_model(experiment, tokens_bos_eos_pad_unk)
+    if experiment.pretrained:
+        init_pretrained_embeddings(model, SRC, TRG, src_lang, trg_lang, embedding=experiment.pretrained,
+                                   freeze=experiment.freeze_emb, logger=logger)
     print(model)
     model = model.to(experiment.get_device())
 
@@ -145,7 +240,8 @@ def main():
    # MIN_LR = 2e-07
     MIN_LR = float(np.float(experiment.lr).__mul__(np.float(0.001)))
     logger.log("Scheduler tolerance: {} epochs. Minimal learing rate: {}".format(SCHEDULER_PATIENCE, MIN_LR))
-    scheduler = CustomReduceLROnPlateau(optimizer, 'max', patience=SCHEDULER_PATIENCE, verbose=True, min_lr=MIN_LR, factor=0.1)
+    scheduler_mode = 'min' if experiment.val_metric == "ppl" else 'max'
+    scheduler = CustomReduceLROnPlateau(optimizer, scheduler_mode, patience=SCHEDULER_PATIENCE, verbose=True, min_lr=MIN_LR, factor=0.1)
 
 
     logger.log('|src_vocab| = {}, |trg_vocab| = {}, Data Loading Time: {}.'.format(len(SRC.vocab), len(TRG.vocab),
@@ -154,9 +250,18 @@ def main():
     logger.log('CLI-ARGS ' + ' '.join(sys.argv), stdout=False)
     logger.log('Args: {}\nOPTIM: {}\nLR: {}\nSCHED: {}\nMODEL: {}\n'.format(experiment.get_args(), optimizer, experiment.lr, vars(scheduler), model), stdout=False)
     logger.log(f'Trainable parameters: {count_trainable_params(model):,}')
+    model_memory = memory_stats(model, optimizer, experiment.get_device(), k=0)
+    logger.log_metrics(dict({"phase": "model"}, **model_memory))
+    logger.log("Memory after model creation: {}".format(format_memory(model_memory)))
 
     logger.pickle_obj(experiment.get_dict(), "experiment")
 
+    resume_state = None
+    if experiment.resume:
+        resume_state = load_latest_checkpoint(experiment_path, device=experiment.get_device())
+        if resume_state is None:
+            logger.log("No checkpoint found in {}. Training starts from the beginning.".format(experiment_path))
+
     start_time = time.time()
 
     # Train the model
@@ -166,7 +271,13 @@ def main():
                                 optimizer=optimizer, scheduler=scheduler, epochs=experiment.epochs, SRC=SRC, TRG=TRG,
                                 logger=logger, device=experiment.get_device(), tr_logger=translation_logger,
                                 samples_iter=samples_iter, check_translations_every=log_every,
-                                beam_size=experiment.val_beam_size, clip_value=experiment.get_clip_value())
+                                beam_size=experiment.val_beam_size, clip_value=experiment.get_clip_value(),
+                                async_validation=experiment.async_val, val_metric=experiment.val_metric,
+                                ppl_every=experiment.ppl_every, bleu_every=experiment.bleu_every,
+                                keep_checkpoints=experiment.keep_checkpoints,
+                                checkpoint_every=experiment.checkpoint_every, resume_state=resume_state,
+                                profile_steps=experiment.profile, profile_modules=experiment.profile_modules,
+                                memory_snapshot=experiment.memory_snapshot)
 
     # Uncomment following lines if you want to pickle metric results and/or plot bleus and losses
     #nltk_bleu_metric = Metric("nltk_bleu", list(bleu.values())[0])
@@ -180,32 +291,51 @@ def main():
 
     # Test the model on the test dataset
 
+    val_bleus = bleu.get("nltk", [])
+    results = {"path": experiment_path, "val_bleu": max(val_bleus) if val_bleus else None, "test_bleu": dict(),
+               "stopped_early": metrics["stopped_early"]}
+    if not evaluate:
+        return results
+
+    # References are cached once and reused by every beam size
+    test_scorer = get_bleu_scorer(TRG)
+
     # Beam 1
     logger.log("Validation of test set")
     beam_size = 1
     logger.log("Prediction of test set - Beam size: {}".format(beam_size))
-    bleu = beam_predict(model, val_iter, experiment.get_device(), beam_size, TRG, max_len=max_len)
+    bleu = beam_predict(model, val_iter, experiment.get_device(), beam_size, TRG, max_len=max_len,
+                        bleu_scorer=test_scorer)
     logger.log(f'\t Test. (nltk) BLEU: {bleu:.3f}')
+    logger.log_metrics({"test_bleu": bleu, "beam": beam_size})
+    results["test_bleu"][beam_size] = bleu
 
     # Beam 5
     beam_size = 5
     logger.log("Prediction of test set - Beam size: {}".format(beam_size))
-    bleu = beam_predict(model, val_iter, experiment.get_device(), beam_size, TRG, max_len=max_len)
+    bleu = beam_predict(model, val_iter, experiment.get_device(), beam_size, TRG, max_len=max_len,
+                        bleu_scorer=test_scorer)
     logger.log(f'\t Test. (nltk) BLEU: {bleu:.3f}')
+    logger.log_metrics({"test_bleu": bleu, "beam": beam_size})
+    results["test_bleu"][beam_size] = bleu
 
     # Beam 10
     beam_size = 10
     logger.log("Prediction of test set - Beam size: {}".format(beam_size))
-    bleu = beam_predict(model, val_iter, experiment.get_device(), beam_size, TRG, max_len=max_len)
+    bleu = beam_predict(model, val_iter, experiment.get_device(), beam_size, TRG, max_len=max_len,
+                        bleu_scorer=test_scorer)
     logger.log(f'\t Test. (nltk) BLEU: {bleu:.3f}')
+    logger.log_metrics({"test_bleu": bleu, "beam": beam_size})
+    results["test_bleu"][beam_size] = bleu
 
     # Translate some sentences
-    final_translation = Logger(file_name="final_translations.log", path=experiment_path)
+    final_translation = Logger(file_name="final_translations.log", path=experiment_path, buffered=True)
+    loggers.append(final_translation)
     check_translation(samples=samples_iter, model=model, SRC=SRC, TRG=TRG, logger=final_translation, persist=True)
 
     logger.log('Finished in {}'.format(convert_time_unit(time.time() - start_time)))
 
-    return
+    return results
 
 if __name__ == '__main__':
     print(' '.join(sys.argv))
@@ -14,8 +14,11 @@ import sys
 import torch
 
 from project.model.models import get_nmt_model
+from project.utils.utils_functions import str2bool
 from project.utils.utils_logging import Logger
+from project.utils.utils_profiling import ModuleProfiler
 from project.utils.utils_tokenizers import get_custom_tokenizer
+from project.utils.utils_bpe import BPE, BPE_CODES_FILE
 from project.utils.constants import SOS_TOKEN, EOS_TOKEN, PAD_TOKEN, UNK_TOKEN
 from project.utils.experiment import Experiment
 from project.utils.utils_train_preprocessing import get_vocabularies_and_iterators
@@ -25,7 +28,7 @@ UTF8Reader = codecs.getreader('utf8')
 sys.stdin = UTF8Reader(sys.stdin)
 
 
-def translate(path="", predict_from_file="", beam_size=5):
+def translate(path="", predict_from_file="", beam_size=5, stats_every=100, profile_modules=False):
     use_cuda = True if torch.cuda.is_available() else False
     device = "cuda" if use_cuda else "cpu"
     FIXED_WORD_LEVEL_LEN = 30
@@ -47,7 +50,7 @@ def translate(path="", predict_from_file="", beam_size=5):
         return False
 
     logger_file_name = experiment.rnn_type+"_live_translations.log"
-    logger = Logger(path_to_exp,file_name=logger_file_name)
+    logger = Logger(path_to_exp, file_name=logger_file_name, buffered=True)
 
     try:
         SRC_vocab = torch.load(os.path.join(path_to_exp, "src.pkl"))
@@ -61,9 +64,16 @@ def translate(path="", predict_from_file="", beam_size=5):
 
     tok_level = "w"
 
-    src_tokenizer = get_custom_tokenizer(experiment.get_src_lang(), "w", prepro=True)
-    trg_tokenizer = get_custom_tokenizer(experiment.get_trg_lang(), "w", prepro=True)
-    MAX_LEN = FIXED_WORD_LEVEL_LEN
+    bpe = None
+    if experiment.bpe > 0:
+        # the subwords missing in the joint vocabulary are split again
+        bpe = BPE.from_file(os.path.join(path_to_exp, BPE_CODES_FILE), vocabulary=SRC_vocab.vocab.itos)
+        logger.log("BPE merges: {}".format(len(bpe)))
+
+    src_tokenizer = get_custom_tokenizer(experiment.get_src_lang(), "w", prepro=True, bpe=bpe)
+    trg_tokenizer = get_custom_tokenizer(experiment.get_trg_lang(), "w", prepro=True, bpe=bpe)
+    # a word is made of one or more subwords
+    MAX_LEN = FIXED_WORD_LEVEL_LEN if bpe is None else 2 * FIXED_WORD_LEVEL_LEN
 
     SRC_vocab.tokenize = src_tokenizer.tokenize
     TRG_vocab.tokenize = trg_tokenizer.tokenize
@@ -89,7 +99,11 @@ def translate(path="", predict_from_file="", beam_size=5):
     logger.log("Live translation: {}".format(datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")), stdout=False)
     logger.log("Beam width: {}".format(beam_size))
 
-    translator = Translator(model, SRC_vocab, TRG_vocab, logger, src_tokenizer, device, beam_size, max_len=MAX_LEN)
+    translator = Translator(model, SRC_vocab, TRG_vocab, logger, src_tokenizer, device, beam_size, max_len=MAX_LEN,
+                            stats_every=stats_every, trg_tokenizer=trg_tokenizer)
+    module_profiler = None
+    if profile_modules:
+        module_profiler = ModuleProfiler(model, sync_cuda=use_cuda).attach()
 
     if predict_from_file:
         translator.predict_from_text(predict_from_file)
@@ -99,6 +113,9 @@ def translate(path="", predict_from_file="", beam_size=5):
             try:
                 try:
                     input_sequence = input("SRC  >>> ")
+                    if input_sequence.strip().lower() == "#stats":
+                        translator.log_stats(stdout=True)
+                        continue
                     if input_sequence.lower().startswith("#"):
                         bs = input_sequence.split("#")[1]
                         try:
@@ -111,7 +128,9 @@ def translate(path="", predict_from_file="", beam_size=5):
                     print("An error has occurred: {}. Please restart program!".format(e))
                     return False
                 # Check if it is quit case
-                if input_sequence == 'q' or input_sequence == 'quit': break
+                if input_sequence == 'q' or input_sequence == 'quit':
+                    translator.log_stats()
+                    break
                 translator.set_beam_size(beam_size)
                 out = translator.predict_sentence(input_sequence)
                 if out:
@@ -121,6 +140,11 @@ def translate(path="", predict_from_file="", beam_size=5):
             except KeyError:
                 print("Error: Encountered unknown word.")
 
+    if module_profiler:
+        module_profiler.detach()
+        module_profiler.save(path_to_exp, file_name="module_profile_translation.log")
+        logger.log("Module profile:\n{}".format(module_profiler.table()))
+
     return [experiment, model, SRC_vocab, TRG_vocab, src_tokenizer, trg_tokenizer, logger]
 
 
@@ -131,10 +155,15 @@ def translation_parser():
     parser.add_argument('--file', type=str, default="",
                         help="Translate from file. Please provide path to file e.g. ./translations.txt ")
     parser.add_argument('--beam', type=int, default=5, help="Model beam size.")
+    parser.add_argument('--stats_every', type=int, default=100,
+                        help="Log the translation latency statistics every N translations. Use 0 to log them only at the end.")
+    parser.add_argument('--profile_modules', type=str2bool, default=False,
+                        help="Accumulate time, calls and estimated FLOPs of the model submodules, saved as module_profile_translation.log in the experiment directory. Default: False")
     return parser
 
 
 if __name__ == '__main__':
     parser = translation_parser().parse_args()
     #parser.path = BEST_BASELINE_TIED
-    _ = translate(path=parser.path, predict_from_file=parser.file, beam_size = parser.beam)
\ No newline at end of file
+    _ = translate(path=parser.path, predict_from_file=parser.file, beam_size = parser.beam,
+                  stats_every=parser.stats_every, profile_modules=parser.profile_modules)
\ No newline at end of file